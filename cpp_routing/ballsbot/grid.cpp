@@ -1,3 +1,4 @@
+#include <algorithm>
 #include <cmath>
 #include <vector>
 #include <queue>
@@ -8,12 +9,58 @@
 #include "geometry.h"
 #include "point_cloud.h"
 
-const double kVoxelSize = 0.1;
-const size_t kVoxelsPerCell = 10;
-const double kCellSize = kVoxelsPerCell * kVoxelSize;
 const double kWeightDonorDistance = 1.2;
 
-using Voxels = std::vector<std::vector<int>>;
+BitPlane::BitPlane(std::initializer_list<std::initializer_list<bool>> rows) {
+    Resize(rows.size());
+    size_t y = 0;
+    for (const auto& row : rows) {
+        if (row.size() != size_) {
+            throw std::invalid_argument("BitPlane must be square");
+        }
+        size_t x = 0;
+        for (bool value : row) {
+            Set(x, y, value);
+            ++x;
+        }
+        ++y;
+    }
+}
+
+void BitPlane::Resize(size_t size) {
+    size_ = size;
+    words_per_row_ = (size + 63) / 64;
+    words_.assign(words_per_row_ * size, 0);
+}
+
+void BitPlane::Fill(bool value) {
+    if (!value) {
+        std::fill(words_.begin(), words_.end(), 0);
+        return;
+    }
+    std::fill(words_.begin(), words_.end(), ~uint64_t(0));
+    if (size_ % 64 != 0) {  // keep bits after the end of a row cleared
+        uint64_t last_word_mask = (uint64_t(1) << (size_ % 64)) - 1;
+        for (size_t y = 0; y < size_; ++y) {
+            words_[(y + 1) * words_per_row_ - 1] &= last_word_mask;
+        }
+    }
+}
+
+size_t BitPlane::CountInRow(size_t y, size_t x_begin, size_t x_end) const {
+    size_t result = 0;
+    const uint64_t* row = &words_[y * words_per_row_];
+    while (x_begin < x_end) {
+        size_t word_index = x_begin / 64;
+        size_t bit_begin = x_begin % 64;
+        size_t bit_end = std::min<size_t>(64, bit_begin + (x_end - x_begin));
+        uint64_t mask = bit_end == 64 ? ~uint64_t(0) : (uint64_t(1) << bit_end) - 1;
+        mask &= ~((uint64_t(1) << bit_begin) - 1);
+        result += __builtin_popcountll(row[word_index] & mask);
+        x_begin += bit_end - bit_begin;
+    }
+    return result;
+}
 
 struct VoxelIndexes {
     size_t x, y;
@@ -61,7 +108,7 @@ std::ostream& operator<<(std::ostream& out,
     return out;
 }
 
-void MarkHiddenVoxels(Voxels* voxels, size_t start_x, size_t start_y, size_t center_shift) {
+void MarkHiddenVoxels(VoxelPlanes* voxels, size_t start_x, size_t start_y, size_t center_shift) {
     std::queue<VoxelIndexes> queue;
     queue.emplace(start_x, start_y);
     std::unordered_set<VoxelIndexes> seen;
@@ -80,7 +127,7 @@ void MarkHiddenVoxels(Voxels* voxels, size_t start_x, size_t start_y, size_t cen
         seen.insert(indexes);
         Point cell_center = {indexes.x + 0.5, indexes.y + 0.5};
 
-        if (voxels->operator[](indexes.y)[indexes.x] > 0) {
+        if (voxels->occupied.Get(indexes.x, indexes.y)) {
             auto line = GetLinearCoefficients(car_position, cell_center);
             auto d = Distance(car_position, cell_center);
             lines.emplace_back(line, d);
@@ -89,7 +136,7 @@ void MarkHiddenVoxels(Voxels* voxels, size_t start_x, size_t start_y, size_t cen
             for (auto a_line : lines) {
                 auto w_big = PointToLineDistance(cell_center, a_line.line);
                 if (w_big * a_line.d / d_big <= w_max) {
-                    voxels->operator[](indexes.y)[indexes.x] = -1;
+                    voxels->free.Set(indexes.x, indexes.y, false);
                     break;
                 }
             }
@@ -129,38 +176,100 @@ void MarkHiddenVoxels(Voxels* voxels, size_t start_x, size_t start_y, size_t cen
     }
 }
 
-Voxels CloudToVoxels(const PointCloud& points, double half_width = 8.) {
-    size_t size_in_voxels = 2 * int(round(half_width / kVoxelSize));
-    Voxels result(size_in_voxels);
-    for (size_t i = 0; i < size_in_voxels; ++i) {
-        result[i].resize(size_in_voxels);
+const size_t kShadowBufferBins = 4096;
+
+// same visibility rule as MarkHiddenVoxels, but voxels are visited ring by ring from the start
+// and occupied voxels of previous rings are kept as angular intervals instead of a list of lines
+void MarkHiddenVoxelsWithShadows(VoxelPlanes* voxels, size_t start_x, size_t start_y,
+                                 size_t center_shift, ShadowBuffer* shadows) {
+    int size = static_cast<int>(voxels->size());
+    int step_x = start_x < center_shift ? -1 : 1;
+    int step_y = start_y < center_shift ? -1 : 1;
+    double car_position = double(center_shift);
+    double w_max = sqrt(2 * 0.5 * 0.5);
+
+    auto for_each_in_ring = [&](int ring, auto visitor) {
+        for (int i = 0; i <= ring; ++i) {
+            int x = int(start_x) + step_x * i;
+            int y = int(start_y) + step_y * ring;
+            if (x >= 0 && x < size && y >= 0 && y < size) {
+                visitor(x, y);
+            }
+        }
+        for (int i = 0; i < ring; ++i) {
+            int x = int(start_x) + step_x * ring;
+            int y = int(start_y) + step_y * i;
+            if (x >= 0 && x < size && y >= 0 && y < size) {
+                visitor(x, y);
+            }
+        }
+    };
+
+    shadows->Clear();
+    for (int ring = 0; ring < size; ++ring) {
+        for_each_in_ring(ring, [&](int x, int y) {
+            if (voxels->free.Get(x, y) &&
+                shadows->IsShadowed(atan2(y + 0.5 - car_position, x + 0.5 - car_position))) {
+                voxels->free.Set(x, y, false);
+            }
+        });
+        for_each_in_ring(ring, [&](int x, int y) {
+            if (voxels->occupied.Get(x, y)) {
+                double dx = x + 0.5 - car_position;
+                double dy = y + 0.5 - car_position;
+                double d = sqrt(dx * dx + dy * dy);
+                double half_width = d <= w_max ? M_PI / 2. : asin(w_max / d);
+                shadows->Cast(atan2(dy, dx), half_width);
+            }
+        });
     }
+}
+
+void CloudToVoxels(const PointCloud& points, double half_width, double voxel_size,
+                   VisibilityMode visibility_mode, VoxelPlanes* result, ShadowBuffer* shadows) {
+    size_t size_in_voxels = 2 * int(round(half_width / voxel_size));
+    result->counts.assign(size_in_voxels * size_in_voxels, 0);
+    result->occupied.Resize(size_in_voxels);
+    result->free.Resize(size_in_voxels);
+    result->free.Fill(true);
 
     for (auto a_point : points) {
-        int cell_x = int(round((a_point.x + half_width) / kVoxelSize));
+        int cell_x = int(round((a_point.x + half_width) / voxel_size));
         if (cell_x < 0) {
             cell_x = 0;
         } else if (cell_x >= int(size_in_voxels)) {
             cell_x = size_in_voxels - 1;
         }
 
-        int cell_y = int(round((a_point.y + half_width) / kVoxelSize));
+        int cell_y = int(round((a_point.y + half_width) / voxel_size));
         if (cell_y < 0) {
             cell_y = 0;
         } else if (cell_y >= int(size_in_voxels)) {
             cell_y = size_in_voxels - 1;
         }
 
-        ++result[cell_y][cell_x];
+        auto& count = result->counts[cell_y * size_in_voxels + cell_x];
+        if (count < UINT8_MAX) {
+            ++count;
+        }
+        result->occupied.Set(cell_x, cell_y, true);
+        result->free.Set(cell_x, cell_y, false);
     }
     size_t center_shift = int(size_in_voxels / 2);
+    if (visibility_mode == VisibilityMode::kShadowBuffer) {
+        shadows->Resize(kShadowBufferBins);
+    }
     for (size_t i = 0; i < 2; ++i) {
         for (size_t j = 0; j < 2; ++j) {
-            MarkHiddenVoxels(&result, center_shift + i - 1, center_shift + j - 1, center_shift);
+            if (visibility_mode == VisibilityMode::kBfs) {
+                MarkHiddenVoxels(result, center_shift + i - 1, center_shift + j - 1,
+                                 center_shift);
+            } else {
+                MarkHiddenVoxelsWithShadows(result, center_shift + i - 1, center_shift + j - 1,
+                                            center_shift, shadows);
+            }
         }
     }
-
-    return result;
 }
 
 void FilterDisconnectedCells(FreeCells* cells) {
@@ -172,24 +281,24 @@ void FilterDisconnectedCells(FreeCells* cells) {
         }
     }
 
-    std::unordered_set<VoxelIndexes> seen;
+    BitPlane seen(cells->size());
     while (!queue.empty()) {
         auto indexes = queue.front();
         queue.pop();
 
-        if (seen.find(indexes) != seen.end() || indexes.x >= cells->size() ||
-            indexes.y >= cells->size()) {
+        if (indexes.x >= cells->size() || indexes.y >= cells->size() ||
+            seen.Get(indexes.x, indexes.y)) {
             continue;
         }
-        seen.insert(indexes);
+        seen.Set(indexes.x, indexes.y, true);
 
         if (indexes.x < center_shift) {
             if (indexes.y < center_shift) {  // left down
-                if (cells->operator[](indexes.y)[indexes.x] &&
-                    !(cells->operator[](indexes.y + 1)[indexes.x] ||
-                      cells->operator[](indexes.y + 1)[indexes.x + 1] ||
-                      cells->operator[](indexes.y)[indexes.x + 1])) {
-                    cells->operator[](indexes.y)[indexes.x] = false;
+                if (cells->Get(indexes.x, indexes.y) &&
+                    !(cells->Get(indexes.x, indexes.y + 1) ||
+                      cells->Get(indexes.x + 1, indexes.y + 1) ||
+                      cells->Get(indexes.x + 1, indexes.y))) {
+                    cells->Set(indexes.x, indexes.y, false);
                 }
                 if (indexes.x > 0) {
                     queue.emplace(indexes.x - 1, indexes.y);
@@ -201,11 +310,11 @@ void FilterDisconnectedCells(FreeCells* cells) {
                     queue.emplace(indexes.x, indexes.y - 1);
                 }
             } else {  // left up
-                if (cells->operator[](indexes.y)[indexes.x] &&
-                    !(cells->operator[](indexes.y - 1)[indexes.x] ||
-                      cells->operator[](indexes.y - 1)[indexes.x + 1] ||
-                      cells->operator[](indexes.y)[indexes.x + 1])) {
-                    cells->operator[](indexes.y)[indexes.x] = false;
+                if (cells->Get(indexes.x, indexes.y) &&
+                    !(cells->Get(indexes.x, indexes.y - 1) ||
+                      cells->Get(indexes.x + 1, indexes.y - 1) ||
+                      cells->Get(indexes.x + 1, indexes.y))) {
+                    cells->Set(indexes.x, indexes.y, false);
                 }
                 if (indexes.x > 0) {
                     queue.emplace(indexes.x - 1, indexes.y);
@@ -215,11 +324,11 @@ void FilterDisconnectedCells(FreeCells* cells) {
             }
         } else {
             if (indexes.y < center_shift) {  // right down
-                if (cells->operator[](indexes.y)[indexes.x] &&
-                    !(cells->operator[](indexes.y + 1)[indexes.x] ||
-                      cells->operator[](indexes.y + 1)[indexes.x - 1] ||
-                      cells->operator[](indexes.y)[indexes.x - 1])) {
-                    cells->operator[](indexes.y)[indexes.x] = false;
+                if (cells->Get(indexes.x, indexes.y) &&
+                    !(cells->Get(indexes.x, indexes.y + 1) ||
+                      cells->Get(indexes.x - 1, indexes.y + 1) ||
+                      cells->Get(indexes.x - 1, indexes.y))) {
+                    cells->Set(indexes.x, indexes.y, false);
                 }
                 queue.emplace(indexes.x + 1, indexes.y);
                 if (indexes.y > 0) {
@@ -227,11 +336,11 @@ void FilterDisconnectedCells(FreeCells* cells) {
                     queue.emplace(indexes.x, indexes.y - 1);
                 }
             } else {  // right up
-                if (cells->operator[](indexes.y)[indexes.x] &&
-                    !(cells->operator[](indexes.y - 1)[indexes.x] ||
-                      cells->operator[](indexes.y - 1)[indexes.x - 1] ||
-                      cells->operator[](indexes.y)[indexes.x - 1])) {
-                    cells->operator[](indexes.y)[indexes.x] = false;
+                if (cells->Get(indexes.x, indexes.y) &&
+                    !(cells->Get(indexes.x, indexes.y - 1) ||
+                      cells->Get(indexes.x - 1, indexes.y - 1) ||
+                      cells->Get(indexes.x - 1, indexes.y))) {
+                    cells->Set(indexes.x, indexes.y, false);
                 }
                 queue.emplace(indexes.x + 1, indexes.y);
                 queue.emplace(indexes.x + 1, indexes.y + 1);
@@ -241,119 +350,199 @@ void FilterDisconnectedCells(FreeCells* cells) {
     }
 }
 
-FreeCellsResult CloudToFreeCells(const PointCloud& source_points, Pose pose) {
-    size_t half_width = 4. * kCellSize;
-    size_t size_in_cells = 2 * int(round((half_width / kCellSize)));
+FreeCellsResult CloudToFreeCells(const PointCloud& source_points, Pose pose,
+                                 VisibilityMode visibility_mode) {
+    FreeCellsWorkspace workspace;
+    return CloudToFreeCells(source_points, pose, visibility_mode, &workspace);
+}
+
+FreeCellsResult CloudToFreeCells(const PointCloud& source_points, Pose pose,
+                                 VisibilityMode visibility_mode, FreeCellsWorkspace* workspace,
+                                 const GridConfig& config) {
+    double cell_size = config.CellSize();
+    size_t voxels_per_cell = config.voxels_per_cell;
+    double half_width = config.extent;
+    size_t size_in_cells = 2 * int(round((half_width / cell_size)));
     FreeCells result(size_in_cells);
-    for (size_t i = 0; i < size_in_cells; ++i) {
-        result[i].resize(size_in_cells);
-    }
 
     CloudTransformation transformation = {0., 0., pose.teta};
-    auto points = ApplyTransformation(source_points, transformation);
+    auto& points = workspace->points;
+    points.resize(source_points.size());
+    ApplyTransformation(source_points.data(), source_points.size(), transformation, points.data());
 
     double square_part = 0.45;
-    if (kCellSize > 1.) {
-        square_part /= kCellSize * kCellSize;
+    if (cell_size > 1.) {
+        square_part /= cell_size * cell_size;
     }
-    auto voxels = CloudToVoxels(points, half_width);
+    auto& voxels = workspace->voxels;
+    CloudToVoxels(points, half_width, config.voxel_size, visibility_mode, &voxels,
+                  &workspace->shadows);
     for (size_t cell_y = 0; cell_y < size_in_cells; ++cell_y) {
+        size_t voxel_y_begin = cell_y * voxels_per_cell;
+        size_t voxel_y_end = std::min(voxel_y_begin + voxels_per_cell, voxels.size());
         for (size_t cell_x = 0; cell_x < size_in_cells; ++cell_x) {
-            size_t voxels_count = 0;
+            size_t voxel_x_begin = cell_x * voxels_per_cell;
+            size_t voxel_x_end = std::min(voxel_x_begin + voxels_per_cell, voxels.size());
+            if (voxel_y_begin >= voxel_y_end || voxel_x_begin >= voxel_x_end) {
+                continue;
+            }
+            size_t voxels_count = (voxel_y_end - voxel_y_begin) * (voxel_x_end - voxel_x_begin);
             size_t free_voxels = 0;
-            for (size_t voxel_y_o = 0; voxel_y_o < kVoxelsPerCell; ++voxel_y_o) {
-                size_t voxel_y = voxel_y_o + cell_y * kVoxelsPerCell;
-                if (voxel_y >= voxels.size()) {
-                    break;
-                }
-                for (size_t voxel_x_o = 0; voxel_x_o < kVoxelsPerCell; ++voxel_x_o) {
-                    size_t voxel_x = voxel_x_o + cell_x * kVoxelsPerCell;
-                    if (voxel_x >= voxels.size()) {
-                        break;
-                    }
-                    ++voxels_count;
-                    if (voxels[voxel_y][voxel_x] == 0) {
-                        ++free_voxels;
-                    }
-                }
+            for (size_t voxel_y = voxel_y_begin; voxel_y < voxel_y_end; ++voxel_y) {
+                free_voxels += voxels.free.CountInRow(voxel_y, voxel_x_begin, voxel_x_end);
             }
-            if (voxels_count > 0 && double(free_voxels) / voxels_count >= square_part) {
-                result[cell_y][cell_x] = true;
+            if (double(free_voxels) / voxels_count >= square_part) {
+                result.Set(cell_x, cell_y, true);
             }
         }
     }
     FilterDisconnectedCells(&result);
 
     int half_size_in_cells = int(size_in_cells / 2.);
-    FreeCellsResult result_struct = {result, int(round(pose.x / kCellSize)) - half_size_in_cells,
-                                     int(round(pose.y / kCellSize)) - half_size_in_cells};
+    FreeCellsResult result_struct = {result, int(round(pose.x / cell_size)) - half_size_in_cells,
+                                     int(round(pose.y / cell_size)) - half_size_in_cells};
     return result_struct;
 }
 
-std::pair<GridKey, bool> GetCarCell(double x, double y) {
-    GridKey grid_key = {static_cast<int>(std::floor(x / kCellSize)),
-                        static_cast<int>(std::floor(y / kCellSize))};
-    bool inside_a_cell = Distance({(grid_key.x + 0.5) * kCellSize, (grid_key.y + 0.5) * kCellSize},
-                                  {x, y}) <= kCellSize * 0.75 / 2.;
+std::pair<GridKey, bool> GetCarCell(double x, double y, double cell_size) {
+    GridKey grid_key = {static_cast<int>(std::floor(x / cell_size)),
+                        static_cast<int>(std::floor(y / cell_size))};
+    bool inside_a_cell = Distance({(grid_key.x + 0.5) * cell_size, (grid_key.y + 0.5) * cell_size},
+                                  {x, y}) <= cell_size * 0.75 / 2.;
     std::pair<GridKey, bool> result = {grid_key, inside_a_cell};
     return result;
 }
 
-void Grid::UpdateGrid(PointCloud a_cloud, Pose a_pose) {
-    auto free_cells = CloudToFreeCells(a_cloud, a_pose);
+GridInfo* TiledCells::Find(GridKey grid_key) {
+    auto it = tiles_.find(TileKey(grid_key));
+    if (it == tiles_.end()) {
+        return nullptr;
+    }
+    size_t index = IndexInTile(grid_key);
+    if (!it->second->used[index]) {
+        return nullptr;
+    }
+    return &it->second->cells[index];
+}
+
+const GridInfo* TiledCells::Find(GridKey grid_key) const {
+    auto it = tiles_.find(TileKey(grid_key));
+    if (it == tiles_.end()) {
+        return nullptr;
+    }
+    size_t index = IndexInTile(grid_key);
+    if (!it->second->used[index]) {
+        return nullptr;
+    }
+    return &it->second->cells[index];
+}
+
+GridInfo& TiledCells::operator[](GridKey grid_key) {
+    auto& tile = tiles_[TileKey(grid_key)];
+    if (!tile) {
+        tile = std::make_unique<Tile>();
+    }
+    size_t index = IndexInTile(grid_key);
+    if (!tile->used[index]) {
+        tile->used[index] = true;
+        tile->cells[index] = {};
+        ++size_;
+    }
+    return tile->cells[index];
+}
+
+void TiledCells::Erase(GridKey grid_key) {
+    auto it = tiles_.find(TileKey(grid_key));
+    if (it == tiles_.end()) {
+        return;
+    }
+    size_t index = IndexInTile(grid_key);
+    if (!it->second->used[index]) {
+        return;
+    }
+    it->second->used[index] = false;
+    --size_;
+    if (it->second->used.none()) {
+        tiles_.erase(it);
+    }
+}
+
+std::unordered_map<GridKey, GridInfo> TiledCells::ToMap() const {
+    std::unordered_map<GridKey, GridInfo> result;
+    ForEach([&result](GridKey grid_key, const GridInfo& cell_info) {
+        result[grid_key] = cell_info;
+    });
+    return result;
+}
+
+size_t Grid::ExpiresAt(const GridInfo& cell_info) const {
+    if (cell_info.was_at != -1) {
+        return cell_info.was_at + config_.was_in_memory + 1;
+    } else if (cell_info.seen <= config_.min_seen) {
+        return 0;
+    } else {
+        return cell_info.seen_at + config_.seen_memory + 1;
+    }
+}
+
+void Grid::ScheduleExpiry(GridKey grid_key, const GridInfo& cell_info) {
+    expiry_.Schedule(grid_key, ExpiresAt(cell_info), counter_);
+}
+
+void Grid::UpdateGrid(const PointCloud& a_cloud, Pose a_pose) {
+    std::lock_guard<std::mutex> lock(mutex_);
+    auto free_cells = CloudToFreeCells(a_cloud, a_pose, visibility_mode_, &workspace_, config_);
     auto shift_x = free_cells.shift_in_cells_x;
     auto shift_y = free_cells.shift_in_cells_y;
 
     for (size_t cell_y = 0; cell_y < free_cells.cells.size(); ++cell_y) {
         for (size_t cell_x = 0; cell_x < free_cells.cells.size(); ++cell_x) {
             GridKey grid_key = {int(cell_x) + shift_x, int(cell_y) + shift_y};
-            if (free_cells.cells[cell_y][cell_x]) {
-                if (grid_.find(grid_key) == grid_.end()) {
-                    grid_[grid_key] = {};
+            if (free_cells.cells.Get(cell_x, cell_y)) {
+                auto& cell_info = grid_[grid_key];
+                cell_info.seen_at = counter_;
+                ++cell_info.seen;
+                ScheduleExpiry(grid_key, cell_info);
+            } else {
+                auto cell_info = grid_.Find(grid_key);
+                if (cell_info != nullptr && cell_info->was_at == -1 && cell_info->seen < 6) {
+                    --cell_info->seen;
+                    ScheduleExpiry(grid_key, *cell_info);
                 }
-                grid_[grid_key].seen_at = counter_;
-                ++grid_[grid_key].seen;
-            } else if (grid_.find(grid_key) != grid_.end() && grid_[grid_key].was_at == -1 &&
-                       grid_[grid_key].seen < 6) {
-                --grid_[grid_key].seen;
             }
         }
     }
 
-    auto car_cell = GetCarCell(a_pose.x, a_pose.y);
+    auto car_cell = GetCarCell(a_pose.x, a_pose.y, config_.CellSize());
     if (car_cell.second) {
         auto car_grid_key = car_cell.first;
-        if (grid_.find(car_grid_key) == grid_.end()) {
-            grid_[car_grid_key] = {int(counter_), 0};
+        auto cell_info = grid_.Find(car_grid_key);
+        if (cell_info == nullptr) {
+            cell_info = &grid_[car_grid_key];
+            *cell_info = {int(counter_), 0};
         }
-        grid_[car_grid_key].was_at = int(counter_);
+        cell_info->was_at = int(counter_);
+        ScheduleExpiry(car_grid_key, *cell_info);
     }
 
-    std::vector<GridKey> to_remove;
-    for (auto it : grid_) {
-        if (it.second.was_at != -1) {
-            if (it.second.was_at + WAS_IN_MEMORY < counter_) {
-                to_remove.push_back(it.first);
-            }
-        } else if (it.second.seen_at + SEEN_MEMORY < counter_) {
-            to_remove.push_back(it.first);
-        } else if (it.second.seen <= MIN_SEEN) {
-            to_remove.push_back(it.first);
+    auto& due = expiry_.Due(counter_);
+    for (auto grid_key : due) {
+        auto cell_info = grid_.Find(grid_key);
+        if (cell_info != nullptr && ExpiresAt(*cell_info) <= counter_) {
+            grid_.Erase(grid_key);
         }
     }
-    for (auto it : to_remove) {
-        grid_.erase(it);
-    }
+    due.clear();
 
     ++counter_;
 }
 
 double Grid::GetCellWeight(GridInfo cell_info) const {
     if (cell_info.was_at != -1) {
-        if (counter_ - cell_info.was_at < WAS_IN_MEMORY / 2.) {
+        if (counter_ - cell_info.was_at < config_.was_in_memory / 2.) {
             return 0.;
         } else {
-            return (counter_ - cell_info.was_at) / (4. * WAS_IN_MEMORY);
+            return (counter_ - cell_info.was_at) / (4. * config_.was_in_memory);
         }
     } else {
         return 1.;
@@ -361,136 +550,238 @@ double Grid::GetCellWeight(GridInfo cell_info) const {
 }
 
 double Grid::GetCellWeight(GridKey grid_key) const {
-    auto it = grid_.find(grid_key);
-    if (it != grid_.end()) {
-        return GetCellWeight(it->second);
+    std::lock_guard<std::mutex> lock(mutex_);
+    auto cell_info = grid_.Find(grid_key);
+    if (cell_info != nullptr) {
+        return GetCellWeight(*cell_info);
     } else {
         return 0.;
     }
 }
 
-std::vector<CellsToDirections> Grid::AssignCellsToDirections(Pose pose, CarInfo car_info) const {
+SectorLines::SectorLines(Pose pose, CarInfo car_info) {
     double shift = car_info.to_car_center;
-    Point center_point = {
+    center_point = {
         pose.x + shift * cos(pose.teta),
         pose.y + shift * sin(pose.teta),
     };
     shift = car_info.to_car_center + car_info.turn_radius / 2.;
-    Point front_point = {
+    front_point = {
         pose.x + shift * cos(pose.teta),
         pose.y + shift * sin(pose.teta),
     };
     shift = car_info.to_car_center - car_info.turn_radius / 2.;
-    Point rear_point = {
+    rear_point = {
         pose.x + shift * cos(pose.teta),
         pose.y + shift * sin(pose.teta),
     };
     shift = car_info.turn_radius;
-    Point right_point = {
+    right_point = {
         pose.x + shift * cos(pose.teta - M_PI / 2),
         pose.y + shift * sin(pose.teta - M_PI / 2),
     };
 
-    auto central_line = GetLinearCoefficients(front_point, rear_point);
-    auto central_normal = NormalToLineInPoint(central_line, center_point);
-    auto central_ns = GetTwoNRadiansLines(M_PI * 0.3, central_line, center_point);
-    auto front_normal = NormalToLineInPoint(central_line, front_point);
-    auto front_ns = GetTwoNRadiansLines(M_PI / 12., central_line, front_point);
-    auto rear_normal = NormalToLineInPoint(central_line, rear_point);
-    auto rear_ns = GetTwoNRadiansLines(M_PI / 12., central_line, rear_point);
+    central_line = GetLinearCoefficients(front_point, rear_point);
+    central_normal = NormalToLineInPoint(central_line, center_point);
+    central_ns = GetTwoNRadiansLines(M_PI * 0.3, central_line, center_point);
+    front_normal = NormalToLineInPoint(central_line, front_point);
+    front_ns = GetTwoNRadiansLines(M_PI / 12., central_line, front_point);
+    rear_normal = NormalToLineInPoint(central_line, rear_point);
+    rear_ns = GetTwoNRadiansLines(M_PI / 12., central_line, rear_point);
+}
 
-    std::vector<CellsToDirections> result;
-    for (auto it : grid_) {
-        int cell_x = it.first.x;
-        int cell_y = it.first.y;
-        Point cell_center = {
-            (cell_x + 0.5) * kCellSize,
-            (cell_y + 0.5) * kCellSize,
-        };
+size_t SectorLines::Classify(Point cell_center) const {
+    bool left_side = OnOtherSide(central_line, cell_center, right_point);
+    bool rear_side = OnOtherSide(central_normal, cell_center, front_point);
 
-        bool left_side = OnOtherSide(central_line, cell_center, right_point);
-        bool rear_side = OnOtherSide(central_normal, cell_center, front_point);
-
-        bool f1 = OnOtherSide(central_ns.first, cell_center, front_point);
-        bool f2 = OnOtherSide(central_ns.second, cell_center, front_point);
-        bool r1 = OnOtherSide(central_ns.first, cell_center, rear_point);
-        bool r2 = OnOtherSide(central_ns.second, cell_center, rear_point);
-
-        Direction sector_key;
-        if ((f1 && r2 && !f2 && !r1) || (!f1 && !r2 && f2 && r1)) {
-            if (left_side) {
-                if (rear_side) {
-                    sector_key = {-1., -1.};  // 3
-                } else {
-                    sector_key = {-1., 1.};  // 2
-                }
-            } else {
-                if (rear_side) {
-                    sector_key = {1., -1.};  // 7
-                } else {
-                    sector_key = {1., 1.};  // 8
-                }
-            }
-        } else if (rear_side) {
-            if (OnOtherSide(rear_normal, cell_center, front_point) &&
-                OnOtherSide(rear_ns.first, cell_center, front_point) &&
-                OnOtherSide(rear_ns.second, cell_center, front_point)) {
-                sector_key = {0., -1.};  // 5
-            } else if (left_side) {
-                sector_key = {-0.5, -1.};  // 4
-            } else {
-                sector_key = {0.5, -1.};  // 6
-            }
+    bool f1 = OnOtherSide(central_ns.first, cell_center, front_point);
+    bool f2 = OnOtherSide(central_ns.second, cell_center, front_point);
+    bool r1 = OnOtherSide(central_ns.first, cell_center, rear_point);
+    bool r2 = OnOtherSide(central_ns.second, cell_center, rear_point);
+
+    if ((f1 && r2 && !f2 && !r1) || (!f1 && !r2 && f2 && r1)) {
+        if (left_side) {
+            return rear_side ? 3 : 2;
         } else {
-            if (OnOtherSide(front_normal, cell_center, rear_point) &&
-                OnOtherSide(front_ns.first, cell_center, rear_point) &&
-                OnOtherSide(front_ns.second, cell_center, rear_point)) {
-                sector_key = {0., 1.};  // 0
-            } else if (left_side) {
-                sector_key = {-0.5, 1.};  // 1
-            } else {
-                sector_key = {0.5, 1.};  // 9
-            }
+            return rear_side ? 7 : 8;
         }
+    } else if (rear_side) {
+        if (OnOtherSide(rear_normal, cell_center, front_point) &&
+            OnOtherSide(rear_ns.first, cell_center, front_point) &&
+            OnOtherSide(rear_ns.second, cell_center, front_point)) {
+            return 5;
+        } else if (left_side) {
+            return 4;
+        } else {
+            return 6;
+        }
+    } else {
+        if (OnOtherSide(front_normal, cell_center, rear_point) &&
+            OnOtherSide(front_ns.first, cell_center, rear_point) &&
+            OnOtherSide(front_ns.second, cell_center, rear_point)) {
+            return 0;
+        } else if (left_side) {
+            return 1;
+        } else {
+            return 9;
+        }
+    }
+}
 
-        result.emplace_back(it.first, sector_key, Distance(cell_center, center_point));
+const double kStencilStep = 0.1;
+const int kStencilHalfSize = 120;  // 12 m around the car
+const uint8_t kStencilUnknown = UINT8_MAX;
+const uint8_t kStencilOnBoundary = UINT8_MAX - 1;
+
+bool LinesIntersection(LinearCoefficients one, LinearCoefficients two, Point* result) {
+    double det = one.a * two.b - two.a * one.b;
+    if (std::abs(det) < 1e-12) {
+        return false;
     }
+    result->x = (one.b * two.c - two.b * one.c) / det;
+    result->y = (two.a * one.c - one.a * two.c) / det;
+    return true;
+}
 
-    return result;
+void SectorStencil::SetPose(Pose pose, CarInfo car_info) {
+    if (!valid_ || car_info.to_car_center != car_info_.to_car_center ||
+        car_info.turn_radius != car_info_.turn_radius) {
+        Reset(car_info);
+    }
+    pose_ = pose;
+    cos_teta_ = cos(pose.teta);
+    sin_teta_ = sin(pose.teta);
+    pose_lines_ = SectorLines(pose, car_info);
 }
 
-const std::unordered_map<Direction, size_t> kSectorKeys = {
-    {{0., 1.}, 0},     //
-    {{-0.5, 1.}, 1},   //
-    {{-1., 1.}, 2},    //
-    {{-1., -1.}, 3},   //
-    {{-0.5, -1.}, 4},  //
-    {{0., -1.}, 5},    //
-    {{0.5, -1.}, 6},   //
-    {{1., -1.}, 7},    //
-    {{1., 1.}, 8},     //
-    {{0.5, 1.}, 9},    //
-};
+size_t SectorStencil::Classify(Point cell_center) {
+    double dx = cell_center.x - pose_.x;
+    double dy = cell_center.y - pose_.y;
+    int x = static_cast<int>(std::lround((dx * cos_teta_ + dy * sin_teta_) / kStencilStep));
+    int y = static_cast<int>(std::lround((dy * cos_teta_ - dx * sin_teta_) / kStencilStep));
+    if (std::abs(x) >= kStencilHalfSize || std::abs(y) >= kStencilHalfSize) {
+        return pose_lines_.Classify(cell_center);
+    }
+
+    auto& sector = sectors_[Index(x, y)];
+    if (sector == kStencilUnknown) {
+        sector = ClassifyQuantum(x, y);
+    }
+    if (sector == kStencilOnBoundary) {
+        return pose_lines_.Classify(cell_center);
+    }
+    return sector;
+}
 
-std::unordered_map<size_t, Direction> sector_keys_reversed;
+size_t SectorStencil::Index(int x, int y) {
+    return (y + kStencilHalfSize) * (2 * kStencilHalfSize + 1) + (x + kStencilHalfSize);
+}
 
-std::vector<Direction> GetWeightAcceptors(const Direction current_donor,
-                                          const DirectionsWeights& all_donors) {
-    if (sector_keys_reversed.empty()) {
-        for (auto it : kSectorKeys) {
-            sector_keys_reversed[it.second] = it.first;
+uint8_t SectorStencil::ClassifyQuantum(int x, int y) const {
+    // a quantum is cached only when all its corners fall into one sector, the ones crossed by
+    // a sector border are classified exactly for every cell
+    size_t sector = car_frame_lines_.Classify({(x - 0.5) * kStencilStep, (y - 0.5) * kStencilStep});
+    for (auto corner : {std::make_pair(0.5, -0.5), std::make_pair(-0.5, 0.5),
+                        std::make_pair(0.5, 0.5)}) {
+        Point a_point = {(x + corner.first) * kStencilStep, (y + corner.second) * kStencilStep};
+        if (car_frame_lines_.Classify(a_point) != sector) {
+            return kStencilOnBoundary;
+        }
+    }
+    return static_cast<uint8_t>(sector);
+}
+
+void SectorStencil::Reset(CarInfo car_info) {
+    size_t side = 2 * kStencilHalfSize + 1;
+    sectors_.assign(side * side, kStencilUnknown);
+    car_info_ = car_info;
+    car_frame_lines_ = SectorLines({0., 0., 0.}, car_info);
+    valid_ = true;
+
+    // sector borders may end inside a quantum without separating its corners, so the quanta
+    // around every crossing of the sector lines are never cached
+    const auto& lines = car_frame_lines_;
+    std::vector<LinearCoefficients> all_lines = {
+        lines.central_line,  lines.central_normal, lines.central_ns.first, lines.central_ns.second,
+        lines.front_normal,  lines.front_ns.first, lines.front_ns.second,  lines.rear_normal,
+        lines.rear_ns.first, lines.rear_ns.second,
+    };
+    for (size_t i = 0; i < all_lines.size(); ++i) {
+        for (size_t j = i + 1; j < all_lines.size(); ++j) {
+            Point crossing;
+            if (!LinesIntersection(all_lines[i], all_lines[j], &crossing)) {
+                continue;
+            }
+            int cx = static_cast<int>(std::lround(crossing.x / kStencilStep));
+            int cy = static_cast<int>(std::lround(crossing.y / kStencilStep));
+            for (int y = cy - 1; y <= cy + 1; ++y) {
+                for (int x = cx - 1; x <= cx + 1; ++x) {
+                    if (std::abs(x) < kStencilHalfSize && std::abs(y) < kStencilHalfSize) {
+                        sectors_[Index(x, y)] = kStencilOnBoundary;
+                    }
+                }
+            }
         }
     }
+}
+
+const std::array<Direction, 10> kSectorDirections = {{
+    {0., 1.},     // 0
+    {-0.5, 1.},   // 1
+    {-1., 1.},    // 2
+    {-1., -1.},   // 3
+    {-0.5, -1.},  // 4
+    {0., -1.},    // 5
+    {0.5, -1.},   // 6
+    {1., -1.},    // 7
+    {1., 1.},     // 8
+    {0.5, 1.},    // 9
+}};
+
+const std::unordered_map<Direction, size_t> kSectorKeys = [] {
+    std::unordered_map<Direction, size_t> result;
+    for (size_t i = 0; i < kSectorDirections.size(); ++i) {
+        result[kSectorDirections[i]] = i;
+    }
+    return result;
+}();
 
+std::vector<CellsToDirections> Grid::AssignCellsToDirections(Pose pose, CarInfo car_info) const {
+    double shift = car_info.to_car_center;
+    Point center_point = {
+        pose.x + shift * cos(pose.teta),
+        pose.y + shift * sin(pose.teta),
+    };
+
+    double cell_size = config_.CellSize();
+    sector_stencil_.SetPose(pose, car_info);
+
+    std::vector<CellsToDirections> result;
+    result.reserve(grid_.Size());
+    grid_.ForEach([&](GridKey grid_key, const GridInfo& cell_info) {
+        Point cell_center = {
+            (grid_key.x + 0.5) * cell_size,
+            (grid_key.y + 0.5) * cell_size,
+        };
+        auto sector = sector_stencil_.Classify(cell_center);
+        result.emplace_back(grid_key, cell_info, kSectorDirections[sector],
+                            Distance(cell_center, center_point));
+    });
+
+    return result;
+}
+
+std::vector<Direction> GetWeightAcceptors(const Direction current_donor,
+                                          const DirectionsWeights& all_donors) {
     size_t a_number = kSectorKeys.at(current_donor);
     std::vector<Direction> result;
 
-    Direction cw_sibling = sector_keys_reversed.at((a_number + 1) % 10);
+    Direction cw_sibling = kSectorDirections[(a_number + 1) % 10];
     if (all_donors.find(cw_sibling) == all_donors.end()) {
         result.push_back(cw_sibling);
     }
 
-    Direction ccw_sibling = sector_keys_reversed.at((a_number + 9) % 10);
+    Direction ccw_sibling = kSectorDirections[(a_number + 9) % 10];
     if (all_donors.find(ccw_sibling) == all_donors.end()) {
         result.push_back(ccw_sibling);
     }
@@ -500,6 +791,7 @@ std::vector<Direction> GetWeightAcceptors(const Direction current_donor,
 
 DirectionsWeights Grid::GetDirectionsWeights(Pose pose, CarInfo car_info,
                                              FreeDistances free_distances) const {
+    std::lock_guard<std::mutex> lock(mutex_);
     DirectionsWeights result;
     for (auto it : kSectorKeys) {
         result[it.first] = 0.;
@@ -508,7 +800,7 @@ DirectionsWeights Grid::GetDirectionsWeights(Pose pose, CarInfo car_info,
     auto cell_to_direction = AssignCellsToDirections(pose, car_info);
 
     for (auto it : cell_to_direction) {
-        double weight = GetCellWeight(grid_.at(it.grid_key));
+        double weight = GetCellWeight(it.cell_info);
         double dist = it.distance;
         if (dist != 0.) {
             weight /= dist;
@@ -556,6 +848,7 @@ DirectionsWeights Grid::GetDirectionsWeights(Pose pose, CarInfo car_info,
 
 std::vector<std::vector<size_t>> Grid::GetSectorsMap(Pose pose, CarInfo car_info,
                                                      size_t half_size) const {
+    std::lock_guard<std::mutex> lock(mutex_);
     size_t a_size = 2 * half_size;
     std::vector<std::vector<size_t>> result(a_size);
     for (size_t i = 0; i < a_size; ++i) {
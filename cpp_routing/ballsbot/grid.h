@@ -1,8 +1,17 @@
 #pragma once
 
+#include <algorithm>
+#include <array>
+#include <bitset>
+#include <cmath>
+#include <cstdint>
+#include <initializer_list>
+#include <memory>
+#include <mutex>
 #include <unordered_map>
 #include <vector>
 #include "common.h"
+#include "geometry.h"
 #include "point_cloud.h"
 
 struct Pose {
@@ -27,9 +36,11 @@ namespace std {
 template <>
 struct hash<GridKey> {
     std::size_t operator()(GridKey const& s) const noexcept {
-        std::size_t h1 = std::hash<int>{}(s.x);
-        std::size_t h2 = std::hash<int>{}(s.y);
-        return h1 ^ (h2 << 1);
+        uint64_t h = (uint64_t(uint32_t(s.x)) << 32) | uint32_t(s.y);
+        h ^= h >> 33;
+        h *= 0xff51afd7ed558ccdULL;
+        h ^= h >> 33;
+        return h;
     }
 };
 }  // namespace std
@@ -78,37 +89,290 @@ struct GridInfo {
     }
 };
 
-using FreeCells = std::vector<std::vector<bool>>;
+// dense storage of GridInfo in square tiles allocated on demand
+class TiledCells {
+public:
+    static const int kTileSideBits = 4;
+    static const int kTileSide = 1 << kTileSideBits;
+    static const size_t kTileCells = kTileSide * kTileSide;
+
+    GridInfo* Find(GridKey grid_key);
+    const GridInfo* Find(GridKey grid_key) const;
+
+    // inserts a default GridInfo if there is no such cell
+    GridInfo& operator[](GridKey grid_key);
+
+    void Erase(GridKey grid_key);
+
+    template <typename Visitor>
+    void ForEach(Visitor visitor) const;
+
+    size_t Size() const {
+        return size_;
+    }
+
+    std::unordered_map<GridKey, GridInfo> ToMap() const;
+
+private:
+    struct Tile {
+        std::array<GridInfo, kTileCells> cells;
+        std::bitset<kTileCells> used;
+    };
+
+    static GridKey TileKey(GridKey grid_key) {
+        return {grid_key.x >> kTileSideBits, grid_key.y >> kTileSideBits};
+    }
+
+    static size_t IndexInTile(GridKey grid_key) {
+        return (grid_key.y & (kTileSide - 1)) * kTileSide + (grid_key.x & (kTileSide - 1));
+    }
+
+    static GridKey CellKey(GridKey tile_key, size_t index) {
+        return {tile_key.x * kTileSide + int(index % kTileSide),
+                tile_key.y * kTileSide + int(index / kTileSide)};
+    }
+
+    std::unordered_map<GridKey, std::unique_ptr<Tile>> tiles_;
+    size_t size_ = 0;
+};
+
+template <typename Visitor>
+void TiledCells::ForEach(Visitor visitor) const {
+    for (const auto& it : tiles_) {
+        const auto& tile = *it.second;
+        for (size_t i = 0; i < kTileCells; ++i) {
+            if (tile.used[i]) {
+                visitor(CellKey(it.first, i), tile.cells[i]);
+            }
+        }
+    }
+}
+
+// timing wheel of cells keyed by the tick they expire at,
+// entries are checked lazily so rescheduling a cell does not need to remove the old entry
+class ExpiryWheel {
+public:
+    explicit ExpiryWheel(size_t horizon) : buckets_(horizon + 1) {
+    }
+
+    // expires_at must be less than counter + horizon, earlier ticks mean the current one
+    void Schedule(GridKey grid_key, size_t expires_at, size_t counter) {
+        if (expires_at < counter) {
+            expires_at = counter;
+        }
+        buckets_[expires_at % buckets_.size()].push_back(grid_key);
+    }
+
+    // returns the cells that may expire at counter, the caller must clear them
+    std::vector<GridKey>& Due(size_t counter) {
+        return buckets_[counter % buckets_.size()];
+    }
+
+private:
+    std::vector<std::vector<GridKey>> buckets_;
+};
+
+// square plane of bits packed row by row into 64-bit words
+class BitPlane {
+public:
+    BitPlane(size_t size = 0) {
+        Resize(size);
+    }
+
+    BitPlane(std::initializer_list<std::initializer_list<bool>> rows);
+
+    // keeps allocated memory when the size is the same, all bits are cleared
+    void Resize(size_t size);
+
+    void Fill(bool value);
+
+    size_t size() const {
+        return size_;
+    }
+
+    bool Get(size_t x, size_t y) const {
+        return (words_[y * words_per_row_ + x / 64] >> (x % 64)) & 1;
+    }
+
+    void Set(size_t x, size_t y, bool value) {
+        uint64_t mask = uint64_t(1) << (x % 64);
+        auto& word = words_[y * words_per_row_ + x / 64];
+        if (value) {
+            word |= mask;
+        } else {
+            word &= ~mask;
+        }
+    }
+
+    // number of set bits in [x_begin, x_end) of row y
+    size_t CountInRow(size_t y, size_t x_begin, size_t x_end) const;
+
+    bool operator==(const BitPlane& other) const {
+        return size_ == other.size_ && words_ == other.words_;
+    }
+
+private:
+    size_t size_ = 0;
+    size_t words_per_row_ = 0;
+    std::vector<uint64_t> words_;
+};
+
+using FreeCells = BitPlane;
+
+// per voxel point counts plus occupied and free (neither occupied nor hidden) bits
+struct VoxelPlanes {
+    std::vector<uint8_t> counts;
+    BitPlane occupied;
+    BitPlane free;
+
+    size_t size() const {
+        return free.size();
+    }
+};
+
+// sizes of cells and of the area updated by every scan, for how long cells are remembered
+struct GridConfig {
+    double voxel_size = 0.1;
+    size_t voxels_per_cell = 10;
+    double extent = 4.;  // half width of the square around the car updated by a scan, meters
+    size_t seen_memory = 100;  // 50 -> 12.5 sec when 4 fps
+    size_t was_in_memory = 200;
+    int min_seen = 0;
+
+    double CellSize() const {
+        return voxels_per_cell * voxel_size;
+    }
+};
+
+// angular bins of directions hidden behind occupied voxels, see VisibilityMode::kShadowBuffer
+class ShadowBuffer {
+public:
+    // keeps the bins when their count is the same
+    void Resize(size_t bins_count) {
+        if (bins_.size() != bins_count) {
+            bins_.assign(bins_count, false);
+        }
+    }
+
+    void Clear() {
+        std::fill(bins_.begin(), bins_.end(), false);
+    }
+
+    // shadows all directions within half_width radians from angle
+    void Cast(double angle, double half_width) {
+        int first_bin = BinIndex(angle - half_width);
+        int last_bin = BinIndex(angle + half_width);
+        int bins_count = static_cast<int>(bins_.size());
+        if (last_bin < first_bin) {
+            last_bin += bins_count;
+        }
+        for (int i = first_bin; i <= last_bin; ++i) {
+            bins_[i % bins_count] = true;
+        }
+    }
+
+    bool IsShadowed(double angle) const {
+        return bins_[BinIndex(angle)];
+    }
+
+private:
+    int BinIndex(double angle) const {
+        double part = (angle + M_PI) / (2. * M_PI);
+        part -= std::floor(part);
+        int result = static_cast<int>(part * bins_.size());
+        return std::min(result, static_cast<int>(bins_.size()) - 1);
+    }
+
+    std::vector<bool> bins_;
+};
+
+// buffers reused by CloudToFreeCells between calls
+struct FreeCellsWorkspace {
+    PointCloud points;
+    VoxelPlanes voxels;
+    ShadowBuffer shadows;  // allocated on the first call in kShadowBuffer mode
+};
 
 struct FreeCellsResult {
     FreeCells cells;
     int shift_in_cells_x, shift_in_cells_y;
 };
 
-FreeCellsResult CloudToFreeCells(const PointCloud& source_points, Pose pose);
+// how voxels hidden behind obstacles are found:
+// kBfs checks every free voxel against all occupied voxels met before (reference implementation),
+// kShadowBuffer casts angular shadows of occupied voxels ring by ring in linear time
+enum class VisibilityMode { kBfs, kShadowBuffer };
+
+FreeCellsResult CloudToFreeCells(const PointCloud& source_points, Pose pose,
+                                 VisibilityMode visibility_mode = VisibilityMode::kShadowBuffer);
+
+FreeCellsResult CloudToFreeCells(const PointCloud& source_points, Pose pose,
+                                 VisibilityMode visibility_mode, FreeCellsWorkspace* workspace,
+                                 const GridConfig& config = GridConfig());
 
 struct CellsToDirections {
     GridKey grid_key;
+    GridInfo cell_info;
     Direction direction;
     double distance;
 
-    CellsToDirections(GridKey grid_key, Direction direction, double distance)
-        : grid_key(grid_key), direction(direction), distance(distance) {
+    CellsToDirections(GridKey grid_key, GridInfo cell_info, Direction direction, double distance)
+        : grid_key(grid_key), cell_info(cell_info), direction(direction), distance(distance) {
     }
 };
 
+struct SectorLines {
+    Point center_point, front_point, rear_point, right_point;
+    LinearCoefficients central_line, central_normal, front_normal, rear_normal;
+    std::pair<LinearCoefficients, LinearCoefficients> central_ns, front_ns, rear_ns;
+
+    SectorLines() = default;
+    SectorLines(Pose pose, CarInfo car_info);
+
+    size_t Classify(Point cell_center) const;
+};
+
+// Sector numbers of positions in the car frame, valid for any pose of the same car.
+class SectorStencil {
+public:
+    void SetPose(Pose pose, CarInfo car_info);
+    size_t Classify(Point cell_center);
+
+private:
+    static size_t Index(int x, int y);
+    uint8_t ClassifyQuantum(int x, int y) const;
+    void Reset(CarInfo car_info);
+
+    bool valid_ = false;
+    CarInfo car_info_ = {0., 0.};
+    Pose pose_ = {0., 0., 0.};
+    double cos_teta_ = 1., sin_teta_ = 0.;
+    SectorLines car_frame_lines_, pose_lines_;
+    std::vector<uint8_t> sectors_;
+};
+
 using FreeDistances = std::vector<std::pair<Direction, double>>;
 
+// All public methods lock the grid, so they may be called from threads not holding the GIL.
 class Grid {
 public:
-    const size_t SEEN_MEMORY = 100;  // 50 -> 12.5 sec when 4 fps
-    const size_t WAS_IN_MEMORY = 200;
-    const int MIN_SEEN = 0;
+    explicit Grid(const GridConfig& config = GridConfig())
+        : config_(config),
+          counter_(0),
+          grid_(),
+          expiry_(std::max(config.seen_memory, config.was_in_memory) + 2) {
+    }
+
+    void UpdateGrid(const PointCloud& a_cloud, Pose a_pose);
 
-    Grid() : counter_(0), grid_() {
+    void SetVisibilityMode(VisibilityMode visibility_mode) {
+        std::lock_guard<std::mutex> lock(mutex_);
+        visibility_mode_ = visibility_mode;
     }
 
-    void UpdateGrid(PointCloud a_cloud, Pose a_pose);
+    const GridConfig& Config() const {
+        return config_;
+    }
 
     double GetCellWeight(GridKey grid_key) const;
 
@@ -116,7 +380,8 @@ public:
                                            FreeDistances free_distances) const;
 
     std::unordered_map<GridKey, GridInfo> DebugGetGrid() const {
-        return this->grid_;
+        std::lock_guard<std::mutex> lock(mutex_);
+        return this->grid_.ToMap();
     }
 
     std::vector<std::vector<size_t>> GetSectorsMap(Pose pose, CarInfo car_info,
@@ -124,8 +389,17 @@ public:
 
 private:
     double GetCellWeight(GridInfo cell_info) const;
+    size_t ExpiresAt(const GridInfo& cell_info) const;
     std::vector<CellsToDirections> AssignCellsToDirections(Pose pose, CarInfo car_info) const;
 
+    void ScheduleExpiry(GridKey grid_key, const GridInfo& cell_info);
+
+    const GridConfig config_;
+    mutable std::mutex mutex_;
     size_t counter_;
-    std::unordered_map<GridKey, GridInfo> grid_;
+    TiledCells grid_;
+    ExpiryWheel expiry_;
+    VisibilityMode visibility_mode_ = VisibilityMode::kShadowBuffer;
+    FreeCellsWorkspace workspace_;
+    mutable SectorStencil sector_stencil_;
 };
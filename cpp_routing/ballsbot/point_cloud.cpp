@@ -3,8 +3,13 @@
 #include "point_cloud.h"
 
 PointCloud ApplyTransformation(const PointCloud& source_cloud, CloudTransformation transformation) {
-    PointCloud result = source_cloud;
+    PointCloud result(source_cloud.size());
+    ApplyTransformation(source_cloud.data(), source_cloud.size(), transformation, result.data());
+    return result;
+}
 
+void ApplyTransformation(const Point* source_points, size_t points_count,
+                         CloudTransformation transformation, Point* result_points) {
     double rotate11 = cos(transformation.dteta);
     double rotate12 = -sin(transformation.dteta);
     double rotate21 = sin(transformation.dteta);
@@ -13,11 +18,9 @@ PointCloud ApplyTransformation(const PointCloud& source_cloud, CloudTransformati
     double move11 = transformation.dx;
     double move21 = transformation.dy;
 
-    for (size_t i = 0; i < source_cloud.size(); ++i) {
-        auto a_point = source_cloud[i];
-        result[i].x = rotate11 * a_point.x + rotate12 * a_point.y + move11;
-        result[i].y = rotate21 * a_point.x + rotate22 * a_point.y + move21;
+    for (size_t i = 0; i < points_count; ++i) {
+        auto a_point = source_points[i];
+        result_points[i].x = rotate11 * a_point.x + rotate12 * a_point.y + move11;
+        result_points[i].y = rotate21 * a_point.x + rotate22 * a_point.y + move21;
     }
-
-    return result;
 }
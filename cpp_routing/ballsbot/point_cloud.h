@@ -14,3 +14,6 @@ struct CloudTransformation {
 using PointCloud = std::vector<Point>;
 
 PointCloud ApplyTransformation(const PointCloud& source_cloud, CloudTransformation transformation);
+
+void ApplyTransformation(const Point* source_points, size_t points_count,
+                         CloudTransformation transformation, Point* result_points);
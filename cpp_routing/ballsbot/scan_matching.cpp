@@ -0,0 +1,358 @@
+#include <algorithm>
+#include <cmath>
+#include "scan_matching.h"
+
+const double kKernelSigmas = 3.;
+const double kGrowthMargin = 1.;  // meters added around a growing field, fewer reallocations
+
+LikelihoodField::LikelihoodField(const PointCloud& reference, double resolution, double sigma)
+    : LikelihoodField(resolution, sigma) {
+    AddCloud(reference);
+}
+
+void LikelihoodField::Cover(double min_x, double min_y, double max_x, double max_y) {
+    if (Empty()) {
+        min_x_ = min_x - kGrowthMargin;
+        min_y_ = min_y - kGrowthMargin;
+        width_ = int(std::ceil((max_x + kGrowthMargin - min_x_) / resolution_)) + 1;
+        height_ = int(std::ceil((max_y + kGrowthMargin - min_y_) / resolution_)) + 1;
+        values_.assign(size_t(width_) * height_, 0.f);
+        return;
+    }
+    auto cells_to_grow = [this](double distance) {
+        return int(std::ceil((distance + kGrowthMargin) / resolution_));
+    };
+    double field_max_x = min_x_ + width_ * resolution_;
+    double field_max_y = min_y_ + height_ * resolution_;
+    int grow_left = min_x < min_x_ ? cells_to_grow(min_x_ - min_x) : 0;
+    int grow_down = min_y < min_y_ ? cells_to_grow(min_y_ - min_y) : 0;
+    int grow_right = max_x >= field_max_x ? cells_to_grow(max_x - field_max_x) : 0;
+    int grow_up = max_y >= field_max_y ? cells_to_grow(max_y - field_max_y) : 0;
+    if (grow_left == 0 && grow_down == 0 && grow_right == 0 && grow_up == 0) {
+        return;
+    }
+
+    int width = width_ + grow_left + grow_right;
+    int height = height_ + grow_down + grow_up;
+    std::vector<float> values(size_t(width) * height, 0.f);
+    for (int y = 0; y < height_; ++y) {
+        std::copy(values_.begin() + size_t(y) * width_, values_.begin() + size_t(y + 1) * width_,
+                  values.begin() + size_t(y + grow_down) * width + grow_left);
+    }
+    values_.swap(values);
+    min_x_ -= grow_left * resolution_;
+    min_y_ -= grow_down * resolution_;
+    width_ = width;
+    height_ = height;
+}
+
+void LikelihoodField::AddCloud(const PointCloud& cloud) {
+    if (cloud.empty()) {
+        return;
+    }
+    double margin = kKernelSigmas * sigma_;
+    double min_x = cloud[0].x, min_y = cloud[0].y, max_x = cloud[0].x, max_y = cloud[0].y;
+    for (auto a_point : cloud) {
+        min_x = std::min(min_x, a_point.x);
+        min_y = std::min(min_y, a_point.y);
+        max_x = std::max(max_x, a_point.x);
+        max_y = std::max(max_y, a_point.y);
+    }
+    Cover(min_x - margin, min_y - margin, max_x + margin, max_y + margin);
+
+    int kernel_radius = int(std::ceil(margin / resolution_));
+    double inv_two_sigma2 = 1. / (2. * sigma_ * sigma_);
+    for (auto a_point : cloud) {
+        int center_x = CellX(a_point.x);
+        int center_y = CellY(a_point.y);
+        for (int y = std::max(0, center_y - kernel_radius);
+             y <= std::min(height_ - 1, center_y + kernel_radius); ++y) {
+            double cell_y = min_y_ + (y + 0.5) * resolution_ - a_point.y;
+            for (int x = std::max(0, center_x - kernel_radius);
+                 x <= std::min(width_ - 1, center_x + kernel_radius); ++x) {
+                double cell_x = min_x_ + (x + 0.5) * resolution_ - a_point.x;
+                double distance2 = cell_x * cell_x + cell_y * cell_y;
+                float value = float(std::exp(-distance2 * inv_two_sigma2));
+                auto& cell = values_[size_t(y) * width_ + x];
+                cell = std::max(cell, value);
+            }
+        }
+    }
+}
+
+double LikelihoodField::At(Point a_point) const {
+    double x = (a_point.x - min_x_) / resolution_ - 0.5;
+    double y = (a_point.y - min_y_) / resolution_ - 0.5;
+    int x0 = int(std::floor(x));
+    int y0 = int(std::floor(y));
+    double fx = x - x0;
+    double fy = y - y0;
+    return (1. - fy) * ((1. - fx) * Value(x0, y0) + fx * Value(x0 + 1, y0)) +
+           fy * ((1. - fx) * Value(x0, y0 + 1) + fx * Value(x0 + 1, y0 + 1));
+}
+
+double LikelihoodField::Score(const Point* points, size_t points_count, double dx,
+                              double dy) const {
+    if (points_count == 0 || values_.empty()) {
+        return 0.;
+    }
+    double shift_x = (dx - min_x_) / resolution_;
+    double shift_y = (dy - min_y_) / resolution_;
+    double inv_resolution = 1. / resolution_;
+    double total = 0.;
+    for (size_t i = 0; i < points_count; ++i) {
+        int x = int(std::floor(points[i].x * inv_resolution + shift_x));
+        int y = int(std::floor(points[i].y * inv_resolution + shift_y));
+        if (x >= 0 && y >= 0 && x < width_ && y < height_) {
+            total += values_[size_t(y) * width_ + x];
+        }
+    }
+    return total / points_count;
+}
+
+double LikelihoodField::InterpolatedScore(const Point* points, size_t points_count, double dx,
+                                          double dy) const {
+    if (points_count == 0 || values_.empty()) {
+        return 0.;
+    }
+    double total = 0.;
+    for (size_t i = 0; i < points_count; ++i) {
+        total += At({points[i].x + dx, points[i].y + dy});
+    }
+    return total / points_count;
+}
+
+PrecomputationGrid::PrecomputationGrid(const LikelihoodField& field, int window)
+    : window_(window), width_(field.Width() + window - 1), height_(field.Height() + window - 1) {
+    // row maxima of [x, x + window) first, then column maxima of them
+    std::vector<float> rows(size_t(width_) * field.Height(), 0.f);
+    for (int y = 0; y < field.Height(); ++y) {
+        for (int x = 0; x < width_; ++x) {
+            float value = 0.f;
+            for (int k = 0; k < window; ++k) {
+                value = std::max(value, float(field.Value(x - window + 1 + k, y)));
+            }
+            rows[size_t(y) * width_ + x] = value;
+        }
+    }
+    values_.assign(size_t(width_) * height_, 0.f);
+    for (int y = 0; y < height_; ++y) {
+        for (int x = 0; x < width_; ++x) {
+            float value = 0.f;
+            for (int k = 0; k < window; ++k) {
+                int row = y - window + 1 + k;
+                if (row >= 0 && row < field.Height()) {
+                    value = std::max(value, rows[size_t(row) * width_ + x]);
+                }
+            }
+            values_[size_t(y) * width_ + x] = value;
+        }
+    }
+}
+
+void ScanMatcher::SetReference(const PointCloud& reference) {
+    std::lock_guard<std::mutex> lock(mutex_);
+    field_.Clear();
+    field_.AddCloud(reference);
+    pyramid_valid_ = false;
+}
+
+void ScanMatcher::AddToReference(const PointCloud& reference) {
+    std::lock_guard<std::mutex> lock(mutex_);
+    field_.AddCloud(reference);
+    pyramid_valid_ = false;
+}
+
+double ScanMatcher::Score(const PointCloud& cloud, CloudTransformation transformation) const {
+    std::lock_guard<std::mutex> lock(mutex_);
+    return CloudScore(cloud, transformation);
+}
+
+double ScanMatcher::CloudScore(const PointCloud& cloud, CloudTransformation transformation) const {
+    PointCloud rotated(cloud.size());
+    ApplyTransformation(cloud.data(), cloud.size(), {0., 0., transformation.dteta},
+                        rotated.data());
+    return field_.InterpolatedScore(rotated.data(), rotated.size(), transformation.dx,
+                                    transformation.dy);
+}
+
+std::vector<double> ScanMatcher::ScoreBatch(
+    const PointCloud& cloud, const std::vector<CloudTransformation>& candidates) const {
+    std::lock_guard<std::mutex> lock(mutex_);
+    std::vector<double> result(candidates.size());
+    PointCloud rotated(cloud.size());
+    bool rotated_valid = false;
+    double rotated_by = 0.;
+    for (size_t i = 0; i < candidates.size(); ++i) {
+        auto candidate = candidates[i];
+        if (!rotated_valid || candidate.dteta != rotated_by) {
+            ApplyTransformation(cloud.data(), cloud.size(), {0., 0., candidate.dteta},
+                                rotated.data());
+            rotated_valid = true;
+            rotated_by = candidate.dteta;
+        }
+        result[i] = field_.InterpolatedScore(rotated.data(), rotated.size(), candidate.dx,
+                                             candidate.dy);
+    }
+    return result;
+}
+
+ScanMatch ScanMatcher::Match(const PointCloud& cloud, CloudTransformation initial_guess) {
+    std::lock_guard<std::mutex> lock(mutex_);
+    if (cloud.empty() || field_.Empty()) {
+        return {initial_guess, 0., false};
+    }
+    ScanMatch result = config_.branch_and_bound_depth == 0
+                           ? ExhaustiveSearch(cloud, initial_guess)
+                           : BranchAndBound(cloud, initial_guess);
+    if (result.score <= 0.) {
+        return result;
+    }
+    result.score = CloudScore(cloud, result.transformation);
+    Refine(cloud, &result);
+    return result;
+}
+
+ScanMatch ScanMatcher::ExhaustiveSearch(const PointCloud& cloud,
+                                        CloudTransformation initial_guess) const {
+    ScanMatch result = {initial_guess, 0., false};
+    int linear_steps = int(std::round(config_.linear_window / config_.resolution));
+    int angular_steps = int(std::round(config_.angular_window / config_.angular_step));
+    int best_i = 0, best_j = 0, best_k = 0;
+    PointCloud rotated(cloud.size());
+    for (int k = -angular_steps; k <= angular_steps; ++k) {
+        double dteta = initial_guess.dteta + k * config_.angular_step;
+        ApplyTransformation(cloud.data(), cloud.size(), {0., 0., dteta}, rotated.data());
+        for (int j = -linear_steps; j <= linear_steps; ++j) {
+            double dy = initial_guess.dy + j * config_.resolution;
+            for (int i = -linear_steps; i <= linear_steps; ++i) {
+                double dx = initial_guess.dx + i * config_.resolution;
+                double score = field_.Score(rotated.data(), rotated.size(), dx, dy);
+                if (score > result.score) {
+                    result = {{dx, dy, dteta}, score, false};
+                    best_i = i;
+                    best_j = j;
+                    best_k = k;
+                }
+            }
+        }
+    }
+    result.converged = result.score > 0. && std::abs(best_i) < linear_steps &&
+                       std::abs(best_j) < linear_steps && std::abs(best_k) < angular_steps;
+    return result;
+}
+
+double ScanMatcher::CellsScore(const std::vector<Cell>& cells, size_t level, int x, int y) const {
+    const auto& grid = pyramid_[level];
+    double total = 0.;
+    for (auto cell : cells) {
+        total += grid.Value(cell.x + x, cell.y + y);
+    }
+    return total / cells.size();
+}
+
+void ScanMatcher::BranchAndBoundStep(const std::vector<std::vector<Cell>>& cells, size_t level,
+                                     std::vector<Candidate>& candidates, Candidate* best) const {
+    std::sort(candidates.begin(), candidates.end(),
+              [](const Candidate& one, const Candidate& two) { return one.score > two.score; });
+    int linear_steps = int(std::round(config_.linear_window / config_.resolution));
+    for (const auto& candidate : candidates) {
+        if (candidate.score <= best->score) {
+            break;  // the rest are bounded by even lower scores
+        }
+        if (level == 0) {
+            *best = candidate;
+            break;
+        }
+        int half = 1 << (level - 1);
+        std::vector<Candidate> children;
+        for (int a = 0; a < 2; ++a) {
+            for (int b = 0; b < 2; ++b) {
+                int x = candidate.x + a * half;
+                int y = candidate.y + b * half;
+                if (x > linear_steps || y > linear_steps) {
+                    continue;
+                }
+                children.push_back(
+                    {candidate.angle, x, y, CellsScore(cells[candidate.angle], level - 1, x, y)});
+            }
+        }
+        BranchAndBoundStep(cells, level - 1, children, best);
+    }
+}
+
+ScanMatch ScanMatcher::BranchAndBound(const PointCloud& cloud, CloudTransformation initial_guess) {
+    size_t depth = config_.branch_and_bound_depth;
+    if (!pyramid_valid_) {
+        pyramid_.clear();
+        for (size_t level = 0; level <= depth; ++level) {
+            pyramid_.emplace_back(field_, 1 << level);
+        }
+        pyramid_valid_ = true;
+    }
+
+    int linear_steps = int(std::round(config_.linear_window / config_.resolution));
+    int angular_steps = int(std::round(config_.angular_window / config_.angular_step));
+    std::vector<std::vector<Cell>> cells(2 * angular_steps + 1);
+    PointCloud rotated(cloud.size());
+    for (int k = -angular_steps; k <= angular_steps; ++k) {
+        double dteta = initial_guess.dteta + k * config_.angular_step;
+        ApplyTransformation(cloud.data(), cloud.size(), {0., 0., dteta}, rotated.data());
+        auto& angle_cells = cells[k + angular_steps];
+        angle_cells.reserve(rotated.size());
+        for (auto a_point : rotated) {
+            angle_cells.push_back({field_.CellX(a_point.x + initial_guess.dx),
+                                   field_.CellY(a_point.y + initial_guess.dy)});
+        }
+    }
+
+    int step = 1 << depth;
+    std::vector<Candidate> candidates;
+    for (int angle = 0; angle < int(cells.size()); ++angle) {
+        for (int y = -linear_steps; y <= linear_steps; y += step) {
+            for (int x = -linear_steps; x <= linear_steps; x += step) {
+                candidates.push_back({angle, x, y, CellsScore(cells[angle], depth, x, y)});
+            }
+        }
+    }
+    Candidate best = {angular_steps, 0, 0, 0.};
+    BranchAndBoundStep(cells, depth, candidates, &best);
+
+    int k = best.angle - angular_steps;
+    return {{initial_guess.dx + best.x * config_.resolution,
+             initial_guess.dy + best.y * config_.resolution,
+             initial_guess.dteta + k * config_.angular_step},
+            best.score,
+            best.score > 0. && std::abs(best.x) < linear_steps &&
+                std::abs(best.y) < linear_steps && std::abs(k) < angular_steps};
+}
+
+void ScanMatcher::Refine(const PointCloud& cloud, ScanMatch* result) const {
+    double linear_step = config_.resolution / 2.;
+    double angular_step = config_.angular_step / 2.;
+    for (size_t step = 0; step < config_.refine_steps; ++step) {
+        bool improved = true;
+        while (improved) {
+            improved = false;
+            const CloudTransformation best = result->transformation;
+            const CloudTransformation candidates[] = {
+                {best.dx + linear_step, best.dy, best.dteta},
+                {best.dx - linear_step, best.dy, best.dteta},
+                {best.dx, best.dy + linear_step, best.dteta},
+                {best.dx, best.dy - linear_step, best.dteta},
+                {best.dx, best.dy, best.dteta + angular_step},
+                {best.dx, best.dy, best.dteta - angular_step},
+            };
+            for (auto candidate : candidates) {
+                double score = CloudScore(cloud, candidate);
+                if (score > result->score) {
+                    result->transformation = candidate;
+                    result->score = score;
+                    improved = true;
+                }
+            }
+        }
+        linear_step /= 2.;
+        angular_step /= 2.;
+    }
+}
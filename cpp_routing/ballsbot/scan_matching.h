@@ -0,0 +1,153 @@
+#pragma once
+
+#include <cmath>
+#include <mutex>
+#include <vector>
+#include "common.h"
+#include "point_cloud.h"
+
+struct ScanMatcherConfig {
+    double resolution = 0.05;     // of the likelihood field, meters
+    double sigma = 0.1;           // of the gaussian around reference points, meters
+    double linear_window = 0.3;   // searched around the initial guess, meters
+    double angular_window = 0.2;  // radians
+    double angular_step = 0.01;
+    size_t refine_steps = 3;      // halvings of the search steps after the exhaustive search
+    // levels of the precomputation pyramid, 0 scores every candidate of the search window
+    size_t branch_and_bound_depth = 3;
+};
+
+// probability of a point to belong to the reference clouds, precomputed on a square grid
+// which grows when clouds outside of it are added
+class LikelihoodField {
+public:
+    explicit LikelihoodField(double resolution = 0.05, double sigma = 0.1)
+        : resolution_(resolution), sigma_(sigma) {
+    }
+    LikelihoodField(const PointCloud& reference, double resolution, double sigma);
+
+    void AddCloud(const PointCloud& cloud);
+
+    void Clear() {
+        values_.clear();
+        width_ = height_ = 0;
+    }
+
+    bool Empty() const {
+        return values_.empty();
+    }
+
+    // bilinear interpolation between cell centers, 0 outside of the field
+    double At(Point a_point) const;
+
+    // mean likelihood of points moved by (dx, dy), values of the cells the points fall into
+    double Score(const Point* points, size_t points_count, double dx, double dy) const;
+
+    // the same with interpolated values, slower but smooth for the refinement
+    double InterpolatedScore(const Point* points, size_t points_count, double dx, double dy) const;
+
+    int CellX(double x) const {
+        return int(std::floor((x - min_x_) / resolution_));
+    }
+
+    int CellY(double y) const {
+        return int(std::floor((y - min_y_) / resolution_));
+    }
+
+    int Width() const {
+        return width_;
+    }
+
+    int Height() const {
+        return height_;
+    }
+
+    double Value(int x, int y) const {
+        if (x < 0 || y < 0 || x >= width_ || y >= height_) {
+            return 0.;
+        }
+        return values_[size_t(y) * width_ + x];
+    }
+
+private:
+    void Cover(double min_x, double min_y, double max_x, double max_y);
+
+    double resolution_, sigma_;
+    double min_x_ = 0., min_y_ = 0.;
+    int width_ = 0, height_ = 0;
+    std::vector<float> values_;
+};
+
+// max of the field cells [x, x + window) x [y, y + window) for every cell (x, y),
+// so scoring a translation bounds the scores of the window x window finer translations from above
+class PrecomputationGrid {
+public:
+    PrecomputationGrid(const LikelihoodField& field, int window);
+
+    float Value(int x, int y) const {
+        x += window_ - 1;
+        y += window_ - 1;
+        if (x < 0 || y < 0 || x >= width_ || y >= height_) {
+            return 0.f;
+        }
+        return values_[size_t(y) * width_ + x];
+    }
+
+private:
+    int window_, width_, height_;
+    std::vector<float> values_;
+};
+
+struct ScanMatch {
+    CloudTransformation transformation;
+    double score;    // mean likelihood of the transformed cloud, 0..1
+    bool converged;  // false when the best transformation is on the border of the search window
+};
+
+// correlative scan matcher: branch and bound (or exhaustive) search around an initial guess
+// over a coarse-to-fine pyramid of the likelihood field, then local refinement.
+// All public methods lock the matcher, so they may be called from threads not holding the GIL.
+class ScanMatcher {
+public:
+    explicit ScanMatcher(const ScanMatcherConfig& config = ScanMatcherConfig())
+        : config_(config), field_(config.resolution, config.sigma) {
+    }
+
+    void SetReference(const PointCloud& reference);
+
+    // adds points to the reference without rebuilding the likelihood field
+    void AddToReference(const PointCloud& reference);
+
+    double Score(const PointCloud& cloud, CloudTransformation transformation) const;
+
+    std::vector<double> ScoreBatch(const PointCloud& cloud,
+                                   const std::vector<CloudTransformation>& candidates) const;
+
+    // transformation moving cloud onto the reference, see ApplyTransformation;
+    // rebuilds the pyramid after reference changes
+    ScanMatch Match(const PointCloud& cloud, CloudTransformation initial_guess);
+
+private:
+    struct Cell {
+        int x, y;
+    };
+
+    struct Candidate {
+        int angle, x, y;
+        double score;
+    };
+
+    double CloudScore(const PointCloud& cloud, CloudTransformation transformation) const;
+    ScanMatch ExhaustiveSearch(const PointCloud& cloud, CloudTransformation initial_guess) const;
+    ScanMatch BranchAndBound(const PointCloud& cloud, CloudTransformation initial_guess);
+    void BranchAndBoundStep(const std::vector<std::vector<Cell>>& cells, size_t level,
+                            std::vector<Candidate>& candidates, Candidate* best) const;
+    double CellsScore(const std::vector<Cell>& cells, size_t level, int x, int y) const;
+    void Refine(const PointCloud& cloud, ScanMatch* result) const;
+
+    ScanMatcherConfig config_;
+    mutable std::mutex mutex_;
+    LikelihoodField field_;
+    std::vector<PrecomputationGrid> pyramid_;
+    bool pyramid_valid_ = false;
+};
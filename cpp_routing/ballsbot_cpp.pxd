@@ -28,6 +28,15 @@ cdef extern from "ballsbot/grid.h":
         double throttle
 
 ctypedef vector[Point] PointCloud
+
+cdef extern from "ballsbot/point_cloud.h":
+    cdef struct CloudTransformation:
+        CloudTransformation(double, double, double)
+        double dx
+        double dy
+        double dteta
+
+    void ApplyTransformation(const Point*, size_t, CloudTransformation, Point*) nogil
 ctypedef unordered_map[Direction, double] DirectionsWeights
 ctypedef vector[pair[Direction, double]] FreeDistances
 
@@ -48,10 +57,48 @@ cdef extern from "ballsbot/grid.h":
         double to_car_center
         double turn_radius
 
+    cdef enum VisibilityMode "VisibilityMode":
+        kBfs "VisibilityMode::kBfs"
+        kShadowBuffer "VisibilityMode::kShadowBuffer"
+
+    cdef cppclass GridConfig:
+        double voxel_size
+        size_t voxels_per_cell
+        double extent
+        size_t seen_memory
+        size_t was_in_memory
+        int min_seen
+
     cdef cppclass _Grid "Grid":
         _Grid()
-        void UpdateGrid(PointCloud, Pose)
-        DirectionsWeights GetDirectionsWeights(Pose, CarInfo, FreeDistances)
+        _Grid(const GridConfig&)
+        void UpdateGrid(const PointCloud&, Pose) nogil
+        void SetVisibilityMode(VisibilityMode)
+        const GridConfig& Config()
+        DirectionsWeights GetDirectionsWeights(Pose, CarInfo, FreeDistances) nogil
         double GetCellWeight(GridKey)
-        vector[vector[size_t]] GetSectorsMap(Pose, CarInfo, double)
+        vector[vector[size_t]] GetSectorsMap(Pose, CarInfo, double) except + nogil
+
+
+cdef extern from "ballsbot/scan_matching.h":
+    cdef cppclass ScanMatcherConfig:
+        double resolution
+        double sigma
+        double linear_window
+        double angular_window
+        double angular_step
+        size_t refine_steps
+        size_t branch_and_bound_depth
+
+    cdef struct ScanMatch:
+        CloudTransformation transformation
+        double score
+        bint converged
 
+    cdef cppclass _ScanMatcher "ScanMatcher":
+        _ScanMatcher(const ScanMatcherConfig&)
+        void SetReference(const PointCloud&) nogil
+        void AddToReference(const PointCloud&) nogil
+        double Score(const PointCloud&, CloudTransformation) nogil
+        vector[double] ScoreBatch(const PointCloud&, const vector[CloudTransformation]&) nogil
+        ScanMatch Match(const PointCloud&, CloudTransformation) nogil
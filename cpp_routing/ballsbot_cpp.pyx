@@ -1,11 +1,16 @@
 # distutils: language=c++
 # cython: language_level=3
+# cython: binding=False
+# binding=False keeps functions and methods builtin ones, so cProfile sees their calls as native ones
 
 import pathlib
+import numpy
+from cpython.buffer cimport PyObject_CheckBuffer
 from libcpp.vector cimport vector
 from libcpp.string cimport string
 from ballsbot_cpp cimport Point, Distance, Direction, PointCloud, DirectionsWeights, \
-    Pose, CarInfo, GridKey, _Grid, FreeDistances
+    Pose, CarInfo, GridKey, GridConfig, _Grid, FreeDistances, CloudTransformation, ApplyTransformation, \
+    kBfs, kShadowBuffer, ScanMatcherConfig, ScanMatch, _ScanMatcher
 
 def distance(p1_raw, p2_raw):
     cdef Point p1
@@ -18,29 +23,121 @@ def distance(p1_raw, p2_raw):
 
     return Distance(p1, p2)
 
+cdef const double[:, ::1] _as_points_buffer(a_cloud):
+    """
+    returns a (N, 2) C-contiguous float64 view of a_cloud, converted when needed; empty clouds may have any shape
+    """
+    points = numpy.ascontiguousarray(a_cloud, dtype=numpy.float64)
+    if points.size == 0:
+        return points.reshape((0, 2))
+    if points.ndim != 2 or points.shape[1] != 2:
+        raise ValueError('a cloud of (N, 2) points expected')
+    return points
+
+cdef PointCloud _to_point_cloud(a_cloud) except *:
+    cdef const double[:, ::1] points_buffer
+    cdef PointCloud cpp_cloud
+    cdef const Point* points
+    cdef size_t n
+    if PyObject_CheckBuffer(a_cloud):  # numpy arrays of any dtype and layout, lists go point by point
+        points_buffer = _as_points_buffer(a_cloud)
+        n = points_buffer.shape[0]
+        if n > 0:
+            points = <const Point*> &points_buffer[0, 0]
+            cpp_cloud.assign(points, points + n)
+        return cpp_cloud
+
+    n = len(a_cloud)
+    cpp_cloud.resize(n)
+    for i in range(n):
+        cpp_cloud[i].x = a_cloud[i][0]
+        cpp_cloud[i].y = a_cloud[i][1]
+    return cpp_cloud
+
+cdef CloudTransformation _to_transformation(transformation) except *:
+    cdef CloudTransformation result
+    result.dx = transformation[0]
+    result.dy = transformation[1]
+    result.dteta = transformation[2]
+    return result
+
+def apply_transformation(a_cloud, transformation):
+    """
+    rotates by dteta and moves by (dx, dy), returns (N, 2) float64 numpy array
+    """
+    cdef const double[:, ::1] points_buffer = _as_points_buffer(a_cloud)
+
+    cdef CloudTransformation cpp_transformation = _to_transformation(transformation)
+
+    cdef size_t n = points_buffer.shape[0]
+    result = numpy.empty((n, 2), dtype=numpy.float64)
+    cdef double[:, ::1] result_buffer = result
+    cdef const Point* source
+    cdef Point* destination
+    if n > 0:
+        source = <const Point*> &points_buffer[0, 0]
+        destination = <Point*> &result_buffer[0, 0]
+        with nogil:
+            ApplyTransformation(source, n, cpp_transformation, destination)
+    return result
+
 cdef class Grid:
-    cdef _Grid thisobj
     cdef _Grid *thisptr
 
-    def __cinit__(self):
-        self.thisptr = &self.thisobj
+    def __cinit__(self, visibility_mode='shadow_buffer', cell_size=1., voxel_size=0.1, extent=4.,
+                  seen_memory=100, was_in_memory=200, min_seen=0):
+        """
+        visibility_mode: 'shadow_buffer' (default) or 'bfs' (reference implementation)
+        cell_size: meters, a multiple of voxel_size
+        extent: half width of the square around the car updated by every scan, meters
+        seen_memory, was_in_memory: for how many updates seen and visited cells are remembered
+        """
+        if visibility_mode not in ('bfs', 'shadow_buffer'):
+            raise ValueError('unknown visibility_mode {}'.format(visibility_mode))
+        voxels_per_cell = int(round(cell_size / voxel_size))
+        if voxels_per_cell < 1 or abs(voxels_per_cell * voxel_size - cell_size) > 1e-9:
+            raise ValueError('cell_size must be a multiple of voxel_size')
+        if extent < cell_size:
+            raise ValueError('extent must be at least cell_size')
+
+        cdef GridConfig config
+        config.voxel_size = voxel_size
+        config.voxels_per_cell = voxels_per_cell
+        config.extent = extent
+        config.seen_memory = seen_memory
+        config.was_in_memory = was_in_memory
+        config.min_seen = min_seen
+        self.thisptr = new _Grid(config)
+        self.thisptr.SetVisibilityMode(kBfs if visibility_mode == 'bfs' else kShadowBuffer)
 
     def __dealloc__(self):
-        pass
+        del self.thisptr
+
+    @property
+    def config(self):
+        cdef GridConfig config = self.thisptr.Config()
+        return {
+            'cell_size': config.voxels_per_cell * config.voxel_size,
+            'voxel_size': config.voxel_size,
+            'extent': config.extent,
+            'seen_memory': config.seen_memory,
+            'was_in_memory': config.was_in_memory,
+            'min_seen': config.min_seen,
+        }
 
     def update_grid(self, a_cloud, a_pose):
-        cdef size_t n = len(a_cloud)
-        cdef PointCloud cpp_cloud = PointCloud(n)
-        for i in range(n):
-            cpp_cloud.at(i).x = a_cloud[i][0]
-            cpp_cloud.at(i).y = a_cloud[i][1]
+        """
+        a_cloud is a C-contiguous (N, 2) float64 buffer (fast path) or a sequence of [x, y]
+        """
+        cdef PointCloud cpp_cloud = _to_point_cloud(a_cloud)
 
         cdef Pose cpp_pose
         cpp_pose.x = a_pose['x']
         cpp_pose.y = a_pose['y']
         cpp_pose.teta = a_pose['teta']
 
-        self.thisobj.UpdateGrid(cpp_cloud, cpp_pose)
+        with nogil:
+            self.thisptr.UpdateGrid(cpp_cloud, cpp_pose)
 
     def get_directions_weights(self, a_pose, car_info, free_distances):
         cdef CarInfo cpp_car_info
@@ -58,8 +155,9 @@ cdef class Grid:
             cpp_free_distances[i].first.throttle = pair[0][1]
             cpp_free_distances[i].second = pair[1]
 
-        cdef DirectionsWeights cpp_result = self.thisobj.GetDirectionsWeights(
-            cpp_pose, cpp_car_info, cpp_free_distances)
+        cdef DirectionsWeights cpp_result
+        with nogil:
+            cpp_result = self.thisptr.GetDirectionsWeights(cpp_pose, cpp_car_info, cpp_free_distances)
         result = {}
         for it in cpp_result:
             key = (it.first.steering, it.first.throttle)
@@ -78,8 +176,9 @@ cdef class Grid:
 
         cdef double cpp_half_size = half_size
 
-        cdef vector[vector[size_t]] cpp_result = self.thisobj.GetSectorsMap(
-            cpp_pose, cpp_car_info, cpp_half_size)
+        cdef vector[vector[size_t]] cpp_result
+        with nogil:
+            cpp_result = self.thisptr.GetSectorsMap(cpp_pose, cpp_car_info, cpp_half_size)
         result = [[y for y in x] for x in cpp_result]
 
         return result
@@ -88,8 +187,97 @@ cdef class Grid:
         cdef GridKey cpp_grid_key
         cpp_grid_key.x = grid_key[0]
         cpp_grid_key.y = grid_key[1]
-        return self.thisobj.GetCellWeight(cpp_grid_key)
+        return self.thisptr.GetCellWeight(cpp_grid_key)
+
+cdef class ScanMatcher:
+    """
+    correlative scan matcher over a likelihood field of the reference clouds,
+    branch and bound over a pyramid of the field finds the same best match as the exhaustive search;
+    the methods lock the matcher, so it may be shared between threads
+    """
+    cdef _ScanMatcher *thisptr
+
+    def __cinit__(self, resolution=0.05, sigma=0.1, linear_window=0.3, angular_window=0.2,
+                  angular_step=0.01, refine_steps=3, branch_and_bound_depth=3):
+        """
+        resolution: of the likelihood field, meters
+        linear_window, angular_window: searched around the initial guess, meters and radians
+        branch_and_bound_depth: pyramid levels, 0 for the exhaustive search
+        """
+        cdef ScanMatcherConfig config
+        config.resolution = resolution
+        config.sigma = sigma
+        config.linear_window = linear_window
+        config.angular_window = angular_window
+        config.angular_step = angular_step
+        config.refine_steps = refine_steps
+        config.branch_and_bound_depth = branch_and_bound_depth
+        self.thisptr = new _ScanMatcher(config)
+
+    def __dealloc__(self):
+        del self.thisptr
+
+    def set_reference(self, a_cloud):
+        cdef PointCloud cpp_cloud = _to_point_cloud(a_cloud)
+        with nogil:
+            self.thisptr.SetReference(cpp_cloud)
+
+    def add_to_reference(self, a_cloud):
+        """
+        adds a cloud to the likelihood field, the field grows when needed
+        """
+        cdef PointCloud cpp_cloud = _to_point_cloud(a_cloud)
+        with nogil:
+            self.thisptr.AddToReference(cpp_cloud)
+
+    def score(self, a_cloud, transformation):
+        """
+        mean likelihood, 0..1, of a_cloud moved by transformation (dx, dy, dteta)
+        """
+        cdef PointCloud cpp_cloud = _to_point_cloud(a_cloud)
+        cdef CloudTransformation cpp_transformation = _to_transformation(transformation)
+        cdef double result
+        with nogil:
+            result = self.thisptr.Score(cpp_cloud, cpp_transformation)
+        return result
+
+    def score_batch(self, a_cloud, candidates):
+        """
+        candidates: (K, 3) of (dx, dy, dteta), returns (K,) float64 array of scores like score(),
+        candidates sorted by dteta share rotations of the cloud
+        """
+        cdef PointCloud cpp_cloud = _to_point_cloud(a_cloud)
+        cdef const double[:, ::1] candidates_buffer = numpy.ascontiguousarray(
+            candidates, dtype=numpy.float64).reshape((-1, 3))
+        cdef vector[CloudTransformation] cpp_candidates
+        cdef const CloudTransformation* transformations
+        cdef size_t n = candidates_buffer.shape[0]
+        if n > 0:
+            transformations = <const CloudTransformation*> &candidates_buffer[0, 0]
+            cpp_candidates.assign(transformations, transformations + n)
+        cdef vector[double] cpp_result
+        with nogil:
+            cpp_result = self.thisptr.ScoreBatch(cpp_cloud, cpp_candidates)
+        result = numpy.empty((n,), dtype=numpy.float64)
+        cdef double[::1] result_buffer = result
+        for i in range(n):
+            result_buffer[i] = cpp_result[i]
+        return result
+
+    def match(self, a_cloud, initial_guess):
+        """
+        returns (dx, dy, dteta, converged, score) of the transformation moving a_cloud onto the reference,
+        see apply_transformation; converged is False when the match is on the border of the search window
+        """
+        cdef PointCloud cpp_cloud = _to_point_cloud(a_cloud)
+        cdef CloudTransformation cpp_initial_guess = _to_transformation(initial_guess)
+        cdef ScanMatch result
+        with nogil:
+            result = self.thisptr.Match(cpp_cloud, cpp_initial_guess)
+        return (result.transformation.dx, result.transformation.dy, result.transformation.dteta,
+                result.converged, result.score)
 
+# a grid shared by the module-level functions, kept for old callers; prefer own Grid instances
 grid = None
 
 def update_grid(a_cloud, a_pose):
@@ -56,6 +56,7 @@ module = [
         [
             "ballsbot_cpp.pyx",
             "ballsbot/geometry.cpp", "ballsbot/point_cloud.cpp", "ballsbot/grid.cpp",
+            "ballsbot/scan_matching.cpp",
         ],
         language="c++",
         **ext_args
@@ -1,8 +1,11 @@
 #include <catch.hpp>
+#include <algorithm>
 #include <cmath>
+#include <random>
 #include "ballsbot/point_cloud.h"
 #include "ballsbot/geometry.h"
 #include "ballsbot/grid.h"
+#include "ballsbot/scan_matching.h"
 
 bool EqualClouds(const PointCloud& one, const PointCloud& two) {
     if (one.size() != two.size()) {
@@ -39,6 +42,23 @@ TEST_CASE("point_cloud/ApplyTransformation") {
     REQUIRE(EqualClouds(got_cloud, result_cloud));
 }
 
+TEST_CASE("point_cloud/ApplyTransformation raw buffers") {
+    PointCloud source_cloud = {{9.638796779052058, -2.845616878136827},
+                               {9.525724052658141, 6.021487279142978},
+                               {-7.831982480139892, -1.4612510995393677}};
+    CloudTransformation transformation = {-0.09925784079102673, 1.8323492497082166,
+                                          4.452297288078437};
+
+    PointCloud got_cloud(source_cloud.size());
+    ApplyTransformation(source_cloud.data(), source_cloud.size(), transformation,
+                        got_cloud.data());
+    REQUIRE(EqualClouds(got_cloud, ApplyTransformation(source_cloud, transformation)));
+
+    PointCloud in_place = source_cloud;
+    ApplyTransformation(in_place.data(), in_place.size(), transformation, in_place.data());
+    REQUIRE(EqualClouds(got_cloud, in_place));
+}
+
 TEST_CASE("geometry/Distance") {
     {
         Point one = {1., 1.};
@@ -581,6 +601,465 @@ TEST_CASE("grid/CloudToFreeCells") {
     REQUIRE(expected == CloudToFreeCells(cloud, pose));
 }
 
+TEST_CASE("grid/BitPlane") {
+    BitPlane plane(70);
+    REQUIRE(70 == plane.size());
+    REQUIRE(0 == plane.CountInRow(3, 0, 70));
+
+    plane.Set(0, 3, true);
+    plane.Set(63, 3, true);
+    plane.Set(64, 3, true);
+    plane.Set(69, 3, true);
+    REQUIRE(plane.Get(63, 3));
+    REQUIRE(!plane.Get(62, 3));
+    REQUIRE(!plane.Get(63, 2));
+    REQUIRE(4 == plane.CountInRow(3, 0, 70));
+    REQUIRE(2 == plane.CountInRow(3, 60, 65));
+    REQUIRE(1 == plane.CountInRow(3, 64, 65));
+    REQUIRE(0 == plane.CountInRow(3, 1, 63));
+
+    plane.Set(63, 3, false);
+    REQUIRE(3 == plane.CountInRow(3, 0, 70));
+
+    plane.Fill(true);
+    REQUIRE(70 == plane.CountInRow(69, 0, 70));
+    REQUIRE(10 == plane.CountInRow(0, 55, 65));
+
+    BitPlane other(70);
+    other.Fill(true);
+    REQUIRE(plane == other);
+    other.Set(5, 5, false);
+    REQUIRE(!(plane == other));
+
+    plane.Resize(3);
+    REQUIRE(BitPlane({{false, false, false}, {false, false, false}, {false, false, false}}) == plane);
+    plane.Set(1, 0, true);
+    REQUIRE(BitPlane({{false, true, false}, {false, false, false}, {false, false, false}}) == plane);
+}
+
+TEST_CASE("grid/CloudToFreeCells visibility modes") {
+    Pose pose = {0., 0., 0.};
+    PointCloud cloud;
+    for (size_t i = 0; i <= 40; ++i) {
+        cloud.push_back({1.5, -2. + 0.1 * i});  // a wall in front of the car
+    }
+
+    auto bfs = CloudToFreeCells(cloud, pose, VisibilityMode::kBfs);
+    auto shadows = CloudToFreeCells(cloud, pose, VisibilityMode::kShadowBuffer);
+    REQUIRE(bfs == shadows);
+
+    size_t size = shadows.cells.size();
+    size_t center = size / 2;
+    REQUIRE(shadows.cells.Get(center, center));
+    for (size_t x = center + 2; x < size; ++x) {  // behind the wall
+        REQUIRE(!shadows.cells.Get(x, center));
+        REQUIRE(!shadows.cells.Get(x, center - 1));
+    }
+    for (size_t x = 0; x < center; ++x) {  // nothing behind the car
+        REQUIRE(shadows.cells.Get(x, center));
+    }
+}
+
+TEST_CASE("grid/TiledCells") {
+    TiledCells cells;
+    REQUIRE(cells.Find({0, 0}) == nullptr);
+
+    std::vector<GridKey> keys = {{0, 0}, {-1, -1}, {15, 16}, {-16, 3}, {-17, -33}, {100, -100}};
+    for (size_t i = 0; i < keys.size(); ++i) {
+        cells[keys[i]] = {int(i), int(i) + 1};
+    }
+    REQUIRE(keys.size() == cells.Size());
+    for (size_t i = 0; i < keys.size(); ++i) {
+        REQUIRE(cells.Find(keys[i]) != nullptr);
+        REQUIRE(GridInfo(int(i), int(i) + 1) == *cells.Find(keys[i]));
+    }
+    REQUIRE(cells.Find({1, 0}) == nullptr);
+    REQUIRE(cells.Find({-1, 0}) == nullptr);
+
+    std::unordered_map<GridKey, GridInfo> expected;
+    for (size_t i = 0; i < keys.size(); ++i) {
+        expected[keys[i]] = {int(i), int(i) + 1};
+    }
+    REQUIRE(expected == cells.ToMap());
+
+    cells.Erase({15, 16});
+    cells.Erase({15, 16});
+    cells.Erase({1, 1});
+    REQUIRE(keys.size() - 1 == cells.Size());
+    REQUIRE(cells.Find({15, 16}) == nullptr);
+    REQUIRE(cells.Find({-16, 3}) != nullptr);
+
+    for (auto grid_key : keys) {
+        cells.Erase(grid_key);
+    }
+    REQUIRE(0 == cells.Size());
+    REQUIRE(cells.ToMap().empty());
+}
+
+TEST_CASE("grid/ExpiryWheel") {
+    ExpiryWheel wheel(10);
+    wheel.Schedule({1, 1}, 5, 0);
+    wheel.Schedule({2, 2}, 10, 0);
+    wheel.Schedule({3, 3}, 0, 4);
+
+    REQUIRE(wheel.Due(0).empty());
+    REQUIRE(std::vector<GridKey>{{3, 3}} == wheel.Due(4));
+    wheel.Due(4).clear();
+    REQUIRE(std::vector<GridKey>{{1, 1}} == wheel.Due(5));
+    wheel.Due(5).clear();
+    REQUIRE(std::vector<GridKey>{{2, 2}} == wheel.Due(10));
+    wheel.Due(10).clear();
+
+    wheel.Schedule({4, 4}, 20, 12);
+    REQUIRE(std::vector<GridKey>{{4, 4}} == wheel.Due(20));
+}
+
+TEST_CASE("grid/Grid expiry") {
+    Grid grid;
+    PointCloud cloud;
+    for (size_t i = 0; i < 100; ++i) {
+        double angle = i * 2. * M_PI / 100.;
+        cloud.push_back({3.5 * cos(angle), 3.5 * sin(angle)});
+    }
+
+    grid.UpdateGrid(cloud, {0.5, 0.5, 0.});
+    auto seen_cells = grid.DebugGetGrid();
+    REQUIRE(!seen_cells.empty());
+    REQUIRE(seen_cells.at({0, 0}).was_at == 0);
+
+    PointCloud far_away_cloud;
+    for (size_t i = 1; i <= grid.Config().was_in_memory; ++i) {
+        grid.UpdateGrid(far_away_cloud, {1000.5, 1000.5, 0.});
+        auto current_cells = grid.DebugGetGrid();
+        if (i <= grid.Config().seen_memory) {
+            REQUIRE(current_cells.find({1, 1}) != current_cells.end());
+        } else {
+            REQUIRE(current_cells.find({1, 1}) == current_cells.end());
+        }
+        REQUIRE(current_cells.find({0, 0}) != current_cells.end());
+    }
+    grid.UpdateGrid(far_away_cloud, {1000.5, 1000.5, 0.});
+    auto current_cells = grid.DebugGetGrid();
+    REQUIRE(current_cells.find({0, 0}) == current_cells.end());
+}
+
+TEST_CASE("grid/Grid expiry with seen memory longer than was in memory") {
+    GridConfig config;
+    config.seen_memory = 30;
+    config.was_in_memory = 5;
+    Grid grid(config);
+    PointCloud cloud;
+    for (size_t i = 0; i < 100; ++i) {
+        double angle = i * 2. * M_PI / 100.;
+        cloud.push_back({3.5 * cos(angle), 3.5 * sin(angle)});
+    }
+
+    grid.UpdateGrid(cloud, {0.5, 0.5, 0.});
+    PointCloud far_away_cloud;
+    for (size_t i = 1; i <= config.seen_memory + 1; ++i) {
+        grid.UpdateGrid(far_away_cloud, {1000.5, 1000.5, 0.});
+        auto current_cells = grid.DebugGetGrid();
+        if (i <= config.was_in_memory) {
+            REQUIRE(current_cells.find({0, 0}) != current_cells.end());
+        } else {
+            REQUIRE(current_cells.find({0, 0}) == current_cells.end());
+        }
+        if (i <= config.seen_memory) {
+            REQUIRE(current_cells.find({1, 1}) != current_cells.end());
+        } else {
+            REQUIRE(current_cells.find({1, 1}) == current_cells.end());
+        }
+    }
+    REQUIRE(grid.GetCellWeight(GridKey{1, 1}) == 0.);
+}
+
+TEST_CASE("grid/Grid config") {
+    GridConfig config;
+    config.voxels_per_cell = 5;
+    config.extent = 2.;
+    config.seen_memory = 3;
+    config.was_in_memory = 6;
+    Grid grid(config);
+    Grid default_grid;
+    PointCloud cloud;
+    for (size_t i = 0; i < 100; ++i) {
+        double angle = i * 2. * M_PI / 100.;
+        cloud.push_back({1.7 * cos(angle), 1.7 * sin(angle)});
+    }
+
+    grid.UpdateGrid(cloud, {0.25, 0.25, 0.});
+    default_grid.UpdateGrid(cloud, {0.25, 0.25, 0.});
+    auto cells = grid.DebugGetGrid();
+    REQUIRE(cells.at({0, 0}).was_at == 0);
+    REQUIRE(cells.find({3, 0}) != cells.end());  // 1.5..2 m away, half meter cells
+    REQUIRE(cells.size() > default_grid.DebugGetGrid().size());
+    for (auto it : cells) {
+        REQUIRE(std::abs(it.first.x) <= 4);
+        REQUIRE(std::abs(it.first.y) <= 4);
+    }
+
+    PointCloud far_away_cloud;
+    for (size_t i = 0; i <= config.was_in_memory; ++i) {
+        grid.UpdateGrid(far_away_cloud, {1000.25, 1000.25, 0.});
+    }
+    cells = grid.DebugGetGrid();
+    REQUIRE(cells.find({0, 0}) == cells.end());
+    REQUIRE(cells.find({3, 0}) == cells.end());
+    REQUIRE(!default_grid.DebugGetGrid().empty());
+}
+
+// the unordered_map bookkeeping Grid had before tiles and the expiry wheel
+struct ReferenceGrid {
+    GridConfig config;
+    size_t counter = 0;
+    std::unordered_map<GridKey, GridInfo> cells;
+
+    void Update(const PointCloud& cloud, Pose pose) {
+        FreeCellsWorkspace workspace;
+        auto free_cells =
+            CloudToFreeCells(cloud, pose, VisibilityMode::kShadowBuffer, &workspace, config);
+        for (size_t cell_y = 0; cell_y < free_cells.cells.size(); ++cell_y) {
+            for (size_t cell_x = 0; cell_x < free_cells.cells.size(); ++cell_x) {
+                GridKey grid_key = {int(cell_x) + free_cells.shift_in_cells_x,
+                                    int(cell_y) + free_cells.shift_in_cells_y};
+                auto it = cells.find(grid_key);
+                if (free_cells.cells.Get(cell_x, cell_y)) {
+                    auto& cell_info = cells[grid_key];
+                    cell_info.seen_at = counter;
+                    ++cell_info.seen;
+                } else if (it != cells.end() && it->second.was_at == -1 && it->second.seen < 6) {
+                    --it->second.seen;
+                }
+            }
+        }
+
+        double cell_size = config.CellSize();
+        GridKey car_key = {int(std::floor(pose.x / cell_size)), int(std::floor(pose.y / cell_size))};
+        if (Distance({(car_key.x + 0.5) * cell_size, (car_key.y + 0.5) * cell_size},
+                     {pose.x, pose.y}) <= cell_size * 0.75 / 2.) {
+            if (cells.find(car_key) == cells.end()) {
+                cells[car_key] = {int(counter), 0};
+            }
+            cells[car_key].was_at = int(counter);
+        }
+
+        std::vector<GridKey> to_remove;
+        for (const auto& it : cells) {
+            if (it.second.was_at != -1) {
+                if (it.second.was_at + config.was_in_memory < counter) {
+                    to_remove.push_back(it.first);
+                }
+            } else if (it.second.seen_at + config.seen_memory < counter ||
+                       it.second.seen <= config.min_seen) {
+                to_remove.push_back(it.first);
+            }
+        }
+        for (auto grid_key : to_remove) {
+            cells.erase(grid_key);
+        }
+        ++counter;
+    }
+};
+
+TEST_CASE("grid/Grid matches the reference on a random walk") {
+    GridConfig config;
+    config.seen_memory = 20;
+    config.was_in_memory = 40;
+    Grid grid(config);
+    ReferenceGrid reference;
+    reference.config = config;
+
+    PointCloud room;  // walls of a 10 x 10 m room and a pillar, world frame
+    for (int i = 0; i < 200; ++i) {
+        double t = i * 0.05;
+        room.push_back({t, 0.});
+        room.push_back({t, 10.});
+        room.push_back({0., t});
+        room.push_back({10., t});
+    }
+    for (int i = 0; i < 40; ++i) {
+        double angle = i * 2. * M_PI / 40.;
+        room.push_back({5. + 0.5 * cos(angle), 5. + 0.5 * sin(angle)});
+    }
+
+    std::mt19937 generator(42);
+    std::uniform_real_distribution<double> step(-0.4, 0.4);
+    std::uniform_real_distribution<double> turn(-0.5, 0.5);
+    Pose pose = {2., 2., 0.};
+    for (size_t i = 0; i < 700; ++i) {
+        pose.x = std::min(9.5, std::max(0.5, pose.x + step(generator)));
+        pose.y = std::min(9.5, std::max(0.5, pose.y + step(generator)));
+        pose.teta += turn(generator);
+        PointCloud cloud;  // car frame
+        for (auto point : room) {
+            double dx = point.x - pose.x, dy = point.y - pose.y;
+            cloud.push_back({dx * cos(pose.teta) + dy * sin(pose.teta),
+                             -dx * sin(pose.teta) + dy * cos(pose.teta)});
+        }
+
+        grid.UpdateGrid(cloud, pose);
+        reference.Update(cloud, pose);
+        auto cells = grid.DebugGetGrid();
+        REQUIRE(cells == reference.cells);
+    }
+}
+
+TEST_CASE("grid/SectorStencil") {
+    CarInfo car_info = {0.07, 0.88 / 2.};
+    SectorStencil stencil;
+    for (double teta : {0.3, 2., -2.6, -1.1}) {
+        Pose pose = {1., -2., teta};
+        SectorLines lines(pose, car_info);
+        stencil.SetPose(pose, car_info);
+        size_t mismatches = 0;
+        for (int y = -40; y <= 40; ++y) {
+            for (int x = -40; x <= 40; ++x) {
+                Point cell_center = {pose.x + x * 0.25 + 0.125, pose.y + y * 0.25 + 0.125};
+                if (stencil.Classify(cell_center) != lines.Classify(cell_center)) {
+                    ++mismatches;
+                }
+            }
+        }
+        REQUIRE(mismatches == 0);
+        Point far_away = {pose.x + 30., pose.y - 0.3};
+        REQUIRE(stencil.Classify(far_away) == lines.Classify(far_away));
+    }
+
+    stencil.SetPose({0., 0., 0.}, car_info);
+    SectorLines lines({0., 0., 0.}, car_info);
+    for (int y = -40; y <= 40; ++y) {
+        for (int x = -40; x <= 40; ++x) {
+            Point cell_center = {x * 0.25 + 0.05, y * 0.25 + 0.05};
+            REQUIRE(stencil.Classify(cell_center) == lines.Classify(cell_center));
+        }
+    }
+}
+
+TEST_CASE("scan_matching/LikelihoodField") {
+    LikelihoodField field({{0., 0.}, {1., 0.}}, 0.05, 0.1);
+    REQUIRE(field.At({0.01, 0.01}) > 0.9);
+    REQUIRE(field.At({1.01, 0.01}) > 0.9);
+    REQUIRE(field.At({0.5, 0.}) < 0.01);
+    REQUIRE(field.At({5., 5.}) == 0.);
+    REQUIRE(LikelihoodField().Empty());
+
+    PointCloud cloud = {{-0.99, 0.01}, {0.01, 0.01}};
+    REQUIRE(field.Score(cloud.data(), cloud.size(), 1., 0.) > 0.9);
+    REQUIRE(field.Score(cloud.data(), cloud.size(), 0., 0.) < 0.5);
+}
+
+PointCloud RoomCloud() {
+    PointCloud result;
+    for (double a = -3.; a < 3.; a += 0.05) {
+        result.push_back({a, -2.});
+        result.push_back({a, 2.5});
+    }
+    for (double a = -2.; a < 2.5; a += 0.05) {
+        result.push_back({-3., a});
+        result.push_back({3., a});
+    }
+    for (double a = 0.; a < 1.; a += 0.05) {  // a box breaking the symmetry
+        result.push_back({1. + a, 0.5});
+        result.push_back({1., 0.5 + a});
+    }
+    return result;
+}
+
+TEST_CASE("scan_matching/ScanMatcher") {
+    auto reference = RoomCloud();
+    ScanMatcher matcher;
+    matcher.SetReference(reference);
+
+    CloudTransformation truth = {0.12, -0.07, 0.05};
+    CloudTransformation inverse = {
+        -(truth.dx * cos(truth.dteta) + truth.dy * sin(truth.dteta)),
+        truth.dx * sin(truth.dteta) - truth.dy * cos(truth.dteta),
+        -truth.dteta,
+    };
+    auto cloud = ApplyTransformation(reference, inverse);
+    REQUIRE(EqualClouds(reference, ApplyTransformation(cloud, truth)));
+
+    auto match = matcher.Match(cloud, {0., 0., 0.});
+    REQUIRE(match.converged);
+    REQUIRE(match.score > 0.9);
+    REQUIRE(std::abs(match.transformation.dx - truth.dx) < 0.02);
+    REQUIRE(std::abs(match.transformation.dy - truth.dy) < 0.02);
+    REQUIRE(std::abs(match.transformation.dteta - truth.dteta) < 0.01);
+    REQUIRE(match.score >= matcher.Score(cloud, truth) - 0.01);
+
+    auto far_away = matcher.Match(cloud, {1.5, 0., 0.});
+    REQUIRE(!far_away.converged);
+
+    ScanMatcher empty;
+    REQUIRE(!empty.Match(cloud, {0., 0., 0.}).converged);
+}
+
+TEST_CASE("scan_matching/LikelihoodField AddCloud") {
+    auto reference = RoomCloud();
+    PointCloud left, right;
+    for (auto a_point : reference) {
+        (a_point.x < 0. ? left : right).push_back(a_point);
+    }
+    LikelihoodField whole(reference, 0.05, 0.1);
+    LikelihoodField incremental(left, 0.05, 0.1);
+    REQUIRE(incremental.At({2.95, 0.}) == 0.);
+    incremental.AddCloud(right);
+    for (double y = -2.5; y < 3.; y += 0.13) {
+        for (double x = -3.5; x < 3.5; x += 0.11) {
+            REQUIRE(std::abs(whole.At({x, y}) - incremental.At({x, y})) < 1e-6);
+        }
+    }
+}
+
+TEST_CASE("scan_matching/PrecomputationGrid") {
+    LikelihoodField field(RoomCloud(), 0.05, 0.1);
+    PrecomputationGrid grid(field, 4);
+    for (int y = -3; y < field.Height(); y += 7) {
+        for (int x = -3; x < field.Width(); x += 5) {
+            double expected = 0.;
+            for (int j = 0; j < 4; ++j) {
+                for (int i = 0; i < 4; ++i) {
+                    expected = std::max(expected, field.Value(x + i, y + j));
+                }
+            }
+            REQUIRE(std::abs(grid.Value(x, y) - expected) < 1e-6);
+        }
+    }
+}
+
+TEST_CASE("scan_matching/ScanMatcher branch and bound") {
+    auto reference = RoomCloud();
+    ScanMatcherConfig exhaustive_config;
+    exhaustive_config.branch_and_bound_depth = 0;
+    exhaustive_config.refine_steps = 0;
+    ScanMatcher exhaustive(exhaustive_config);
+    exhaustive.SetReference(reference);
+    ScanMatcherConfig config;
+    config.refine_steps = 0;
+    ScanMatcher fast(config);
+    fast.SetReference(reference);
+
+    for (double dteta : {-0.15, -0.03, 0.08}) {
+        auto cloud = ApplyTransformation(reference, {0.17, -0.21, dteta});
+        for (CloudTransformation guess : {CloudTransformation(0., 0., 0.),
+                                          CloudTransformation(-0.1, 0.2, -dteta)}) {
+            auto one = exhaustive.Match(cloud, guess);
+            auto two = fast.Match(cloud, guess);
+            REQUIRE(std::abs(one.score - two.score) < 1e-9);
+            REQUIRE(one.converged == two.converged);
+        }
+    }
+
+    auto cloud = ApplyTransformation(reference, {0.1, 0.05, 0.02});
+    std::vector<CloudTransformation> candidates = {
+        {0., 0., 0.}, {-0.1, -0.05, -0.02}, {0.3, 0., 0.}};
+    auto scores = fast.ScoreBatch(cloud, candidates);
+    REQUIRE(scores.size() == 3);
+    for (size_t i = 0; i < candidates.size(); ++i) {
+        REQUIRE(scores[i] == fast.Score(cloud, candidates[i]));
+    }
+}
+
 //TEST_CASE("grid/Grid empty one") {
 //    Grid grid;
 //    DirectionsWeights expected = {
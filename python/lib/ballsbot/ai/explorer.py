@@ -1,10 +1,13 @@
 from math import pi
 import json
+from time import time
 
-from ballsbot.lidar import Lidar
+import numpy as np
+
+from ballsbot.lidar import Lidar, LidarScan
 from ballsbot.servos import get_controls
 from ballsbot.utils import keep_rps, run_as_thread
-from ballsbot.geometry import distance
+from ballsbot.tracing import get_tracer
 from ballsbot.odometry import Odometry
 from ballsbot.imu import IMU_Threaded
 from ballsbot.tracking import TrackerLight
@@ -37,7 +40,12 @@ class Explorer:
     DETECTION_MAX_DISTANCE_FROM_CENTER_Y = 0.25
     DETECTION_CLOSE_ENOUGH = 0.15 * 0.15
 
-    def __init__(self, test_run=False, profile_mocks=None):
+    def __init__(self, test_run=False, profile_mocks=None, grid_config=None, pose_graph=None):
+        """
+        grid_config: optional ballsbot_cpp.Grid keyword arguments, e.g. {'cell_size': 0.5, 'seen_memory': 50}
+        pose_graph: optional ballsbot.posegraph.PoseGraphOptimizer, gets the tracker poses with lidar scans
+            and corrects the poses the grid is updated with
+        """
         if profile_mocks is None:
             self.lidar = Lidar(test_run)
         else:
@@ -46,7 +54,8 @@ class Explorer:
         self.BODY_POSITION = self.lidar.calibration_to_xywh(self.lidar.calibration)
         self.test_run = test_run
 
-        self.grid = ballsbot_cpp
+        self.grid = ballsbot_cpp.Grid(**(grid_config or {}))
+        self.pose_graph = pose_graph
 
         if not test_run:
             self.car_controls = get_controls()
@@ -63,7 +72,7 @@ class Explorer:
             self.imu = None
             self.odometry = profile_mocks['odometry']
             self.tracker = profile_mocks['tracker']
-            self.detector = None
+            self.detector = profile_mocks.get('detector')
             self.distance_sensors = None
 
         self.track_info = []
@@ -73,17 +82,18 @@ class Explorer:
         self.cached_direction = None
         self.cached_weights = None
         self.prev_seen_class = "no one"
+        self.tracer = get_tracer('explorer')
 
-    def run(self, save_track_info=False):
+    def run(self, save_track_info=False, track_writer=None):
+        """
+        track_writer: optional ballsbot.track_log.TrackWriter, streams the same frames as track_info to disk
+        """
         def tracker_run():
             self.tracker.start()
 
-        def detector_run():
-            self.detector.start()
-
         if not self.test_run:
             run_as_thread(tracker_run)
-            run_as_thread(detector_run)
+            self.detector.start()
             if self.distance_sensors is not None:
                 self.distance_sensors.start()
 
@@ -91,22 +101,39 @@ class Explorer:
         direction = {'steering': 0., 'throttle': self.STOP}
         steps_with_direction = 0
         keep_for = 0
+        traced_scan_ts = None
         while True:
-            ts = keep_rps(ts, fps=4)
+            ts = keep_rps(ts, fps=4, tracer=self.tracer)
+            self.tracer.begin()
             prev_direction = direction
             if keep_for <= 0:
                 direction, keep_for = self._get_next_move(direction, steps_with_direction)
+                self.tracer.mark('decision')
             keep_for -= 1
             # print('direction: {}, turn: {}, speed {:0.4f}'.format(
             #     direction['throttle'], direction['steering'], self.odometry.get_speed()
             # ))
             self._follow_direction(direction)
+            self.tracer.mark('actuation')
+            scan_ts = getattr(self.lidar, 'points_ts', None)
+            if scan_ts is not None and scan_ts != traced_scan_ts and self.tracer.enabled:
+                self.tracer.record('scan_to_actuation', time() - scan_ts)  # the scan has just been used
+                traced_scan_ts = scan_ts
+            self.tracer.end()
 
             if save_track_info:
                 self.track_info.append({
                     'speed': self.cached_speed,
                     'pose': self.cached_pose,
-                    'points': self.cached_points,
+                    'points': None if self.cached_points is None else self.cached_points.to_radial_points(),
+                    'direction': self.cached_direction,
+                    'weights': self.cached_weights,
+                })
+            if track_writer is not None:
+                track_writer.append({
+                    'speed': self.cached_speed,
+                    'pose': self.cached_pose,
+                    'points': self.lidar.get_radial_lidar_points(columnar=True),
                     'direction': self.cached_direction,
                     'weights': self.cached_weights,
                 })
@@ -116,162 +143,102 @@ class Explorer:
             else:
                 steps_with_direction = 0
 
-    def _can_move_straight_forward(self, nearby_points):
-        min_y = self.BODY_POSITION['y'] - self.FEAR_DISTANCE
-        max_y = self.BODY_POSITION['y'] + self.BODY_POSITION['h'] + self.FEAR_DISTANCE
-        min_x = self.BODY_POSITION['x'] + self.BODY_POSITION['w']
-        max_x = min_x + self.CHECK_RADIUS
-        stop_x = min_x + self._get_stop_distance()
-        min_x -= self.INNER_OFFSET
-
-        nearest_x = max_x
-        for a_point in nearby_points:
-            if min_x < a_point[0] < max_x and min_y <= a_point[1] <= max_y:
-                if a_point[0] < stop_x:
-                    return 0.
-                elif nearest_x > a_point[0]:
-                    nearest_x = a_point[0]
-        return nearest_x
-
-    def _can_move_straight_backward(self, nearby_points):
+    def _get_free_distances(self, nearby_points):
+        """
+        nearby_points: (N, 2) array of cartesian points
+        returns {(st, tr): free distance, ...}, 0. when a direction is blocked
+        """
+        xs = nearby_points[:, 0]
+        ys = nearby_points[:, 1]
+        stop_distance = self._get_stop_distance()
+        front_x = self.BODY_POSITION['x'] + self.BODY_POSITION['w']
+        rear_x = self.BODY_POSITION['x']
+
         min_y = self.BODY_POSITION['y'] - self.FEAR_DISTANCE
         max_y = self.BODY_POSITION['y'] + self.BODY_POSITION['h'] + self.FEAR_DISTANCE
-        max_x = self.BODY_POSITION['x']
-        min_x = max_x - self.CHECK_RADIUS
-        stop_x = max_x - self._get_stop_distance()
-        max_x += self.INNER_OFFSET
-
-        nearest_x = min_x
-        for a_point in nearby_points:
-            if min_x < a_point[0] < max_x and min_y <= a_point[1] <= max_y:
-                if a_point[0] > stop_x:
-                    return 0.
-                elif nearest_x < a_point[0]:
-                    nearest_x = a_point[0]
-        return -nearest_x
-
-    def _filter_right_points(self, nearby_points):
-        left_center, right_center, column_radius = self._get_columns()
-        outer_radius = column_radius + 2 * (self.HALF_CAR_WIDTH + self.FEAR_DISTANCE)
-
-        def on_a_curve(a_point):
-            return distance(right_center, a_point) < outer_radius
+        straight = (min_y <= ys) & (ys <= max_y)
 
-        return list(filter(on_a_curve, nearby_points))
-
-    def _filter_left_points(self, nearby_points):
         left_center, right_center, column_radius = self._get_columns()
         outer_radius = column_radius + 2 * (self.HALF_CAR_WIDTH + self.FEAR_DISTANCE)
+        left = self._distances_to(left_center, xs, ys) < outer_radius
+        right = self._distances_to(right_center, xs, ys) < outer_radius
 
-        def on_a_curve(a_point):
-            return distance(left_center, a_point) < outer_radius
-
-        return list(filter(on_a_curve, nearby_points))
-
-    def _filter_a_bit_left_points(self, nearby_points):
-        left_center = [0, self.A_BIT_CENTER_Y]
-        center_radius = self.A_BIT_CENTER_Y
-        outer_radius = center_radius + self.HALF_CAR_WIDTH + self.FEAR_DISTANCE
-        inner_radius = center_radius - self.HALF_CAR_WIDTH - self.FEAR_DISTANCE
-
-        def on_a_curve(a_point):
-            return inner_radius < distance(left_center, a_point) < outer_radius
-
-        return list(filter(on_a_curve, nearby_points))
-
-    def _filter_a_bit_right_points(self, nearby_points):
-        right_center = [0, -self.A_BIT_CENTER_Y]
-        center_radius = self.A_BIT_CENTER_Y
-        outer_radius = center_radius + self.HALF_CAR_WIDTH + self.FEAR_DISTANCE
-        inner_radius = center_radius - self.HALF_CAR_WIDTH - self.FEAR_DISTANCE
-
-        def on_a_curve(a_point):
-            return inner_radius < distance(right_center, a_point) < outer_radius
+        outer_radius = self.A_BIT_CENTER_Y + self.HALF_CAR_WIDTH + self.FEAR_DISTANCE
+        inner_radius = self.A_BIT_CENTER_Y - self.HALF_CAR_WIDTH - self.FEAR_DISTANCE
+        a_bit_left_distances = self._distances_to([0, self.A_BIT_CENTER_Y], xs, ys)
+        a_bit_left = (inner_radius < a_bit_left_distances) & (a_bit_left_distances < outer_radius)
+        a_bit_right_distances = self._distances_to([0, -self.A_BIT_CENTER_Y], xs, ys)
+        a_bit_right = (inner_radius < a_bit_right_distances) & (a_bit_right_distances < outer_radius)
 
-        return list(filter(on_a_curve, nearby_points))
+        ahead = front_x - self.INNER_OFFSET < xs
+        behind = xs < rear_x + self.INNER_OFFSET
+        straight_ahead = straight & ahead & (xs < front_x + self.CHECK_RADIUS)
+        straight_behind = straight & behind & (rear_x - self.CHECK_RADIUS < xs)
 
-    def _can_move_some_forward(self, nearby_points, a_filter):
-        nearby_points = a_filter(nearby_points)
-        min_x = self.BODY_POSITION['x'] + self.BODY_POSITION['w']
-        max_x = min_x + self.CHECK_RADIUS
-        stop_x = min_x + self._get_stop_distance()
-        min_x -= self.INNER_OFFSET
+        def forward(mask):
+            return self._forward_free_distance(xs[mask], front_x, stop_distance)
 
-        nearest_x = max_x
-        for a_point in nearby_points:
-            if min_x < a_point[0]:
-                if a_point[0] < stop_x:
-                    return 0.
-                elif nearest_x > a_point[0]:
-                    nearest_x = a_point[0]
-        return nearest_x
+        def backward(mask):
+            return self._backward_free_distance(xs[mask], rear_x, stop_distance)
 
-    def _can_move_right_forward(self, nearby_points):
-        return self._can_move_some_forward(nearby_points, self._filter_right_points)
-
-    def _can_move_left_forward(self, nearby_points):
-        return self._can_move_some_forward(nearby_points, self._filter_left_points)
-
-    def _can_move_a_bit_right_forward(self, nearby_points):
-        return self._can_move_some_forward(nearby_points, self._filter_a_bit_right_points)
-
-    def _can_move_a_bit_left_forward(self, nearby_points):
-        return self._can_move_some_forward(nearby_points, self._filter_a_bit_left_points)
-
-    def _can_move_some_backward(self, nearby_points, a_filter):
-        nearby_points = a_filter(nearby_points)
-        max_x = self.BODY_POSITION['x']
-        min_x = max_x - self.CHECK_RADIUS
-        stop_x = max_x - self._get_stop_distance()
-        max_x += self.INNER_OFFSET
-
-        nearest_x = min_x
-        for a_point in nearby_points:
-            if a_point[0] < max_x:
-                if a_point[0] > stop_x:
-                    return 0.
-                elif nearest_x < a_point[0]:
-                    nearest_x = a_point[0]
-        return -nearest_x
-
-    def _can_move_right_backward(self, nearby_points):
-        return self._can_move_some_backward(nearby_points, self._filter_right_points)
-
-    def _can_move_left_backward(self, nearby_points):
-        return self._can_move_some_backward(nearby_points, self._filter_left_points)
-
-    def _can_move_a_bit_right_backward(self, nearby_points):
-        return self._can_move_some_backward(nearby_points, self._filter_a_bit_right_points)
+        return {
+            (0., 1.): forward(straight_ahead),
+            (self.RIGHT, 1.): forward(right & ahead),
+            (self.LEFT, 1.): forward(left & ahead),
+            (self.A_BIT_RIGHT, 1.): forward(a_bit_right & ahead),
+            (self.A_BIT_LEFT, 1.): forward(a_bit_left & ahead),
+            (0., -1.): backward(straight_behind),
+            (self.RIGHT, -1.): backward(right & behind),
+            (self.LEFT, -1.): backward(left & behind),
+            (self.A_BIT_RIGHT, -1.): backward(a_bit_right & behind),
+            (self.A_BIT_LEFT, -1.): backward(a_bit_left & behind),
+        }
 
-    def _can_move_a_bit_left_backward(self, nearby_points):
-        return self._can_move_some_backward(nearby_points, self._filter_a_bit_left_points)
+    @staticmethod
+    def _distances_to(center, xs, ys):
+        dx = xs - center[0]
+        dy = ys - center[1]
+        return np.sqrt(dx * dx + dy * dy)
+
+    def _forward_free_distance(self, xs, front_x, stop_distance):
+        if len(xs) == 0:
+            return front_x + self.CHECK_RADIUS
+        nearest_x = float(xs.min())
+        if nearest_x < front_x + stop_distance:
+            return 0.
+        return min(nearest_x, front_x + self.CHECK_RADIUS)
+
+    def _backward_free_distance(self, xs, rear_x, stop_distance):
+        if len(xs) == 0:
+            return -(rear_x - self.CHECK_RADIUS)
+        nearest_x = float(xs.max())
+        if nearest_x > rear_x - stop_distance:
+            return 0.
+        return -max(nearest_x, rear_x - self.CHECK_RADIUS)
 
     def _get_can_move_map(self, debug_radial_points=None):
-        nearby_points = self._get_nearby_points(debug_radial_points)
+        nearby_scan = self._get_nearby_points(debug_radial_points)
+        self.tracer.mark('lidar')
+        ranges = nearby_scan.ranges
+        angles = nearby_scan.angles
 
         if self.distance_sensors is not None:
             distances = self.distance_sensors.get_distances()
+            extra_ranges = []
+            extra_angles = []
             for direction_name, angle in {'front': 0., 'rear': pi}.items():
                 a_distance = distances.get(direction_name)
                 if a_distance is not None:
-                    a_distance /= 1000.  # to meters
-                    nearby_points.append({'distance': a_distance, 'angle': angle})
+                    extra_ranges.append(a_distance / 1000.)  # to meters
+                    extra_angles.append(angle)
                     # print('{} {:0.03f}'.format(direction_name, a_distance))
+            if extra_ranges:
+                ranges = np.concatenate((ranges, extra_ranges))
+                angles = np.concatenate((angles, extra_angles))
 
-        nearby_points = self._filter_nearby_points(nearby_points)
-
-        return {
-            (0., 1.): self._can_move_straight_forward(nearby_points),
-            (self.RIGHT, 1.): self._can_move_right_forward(nearby_points),
-            (self.LEFT, 1.): self._can_move_left_forward(nearby_points),
-            (self.A_BIT_RIGHT, 1.): self._can_move_a_bit_right_forward(nearby_points),
-            (self.A_BIT_LEFT, 1.): self._can_move_a_bit_left_forward(nearby_points),
-            (0., -1.): self._can_move_straight_backward(nearby_points),
-            (self.RIGHT, -1.): self._can_move_right_backward(nearby_points),
-            (self.LEFT, -1.): self._can_move_left_backward(nearby_points),
-            (self.A_BIT_RIGHT, -1.): self._can_move_a_bit_right_backward(nearby_points),
-            (self.A_BIT_LEFT, -1.): self._can_move_a_bit_left_backward(nearby_points),
-        }
+        result = self._get_free_distances(self._prepare_nearby_cloud(ranges, angles))
+        self.tracer.mark('can_move')
+        return result
 
     def _get_next_move(self, prev_direction, steps_with_direction):
         self.cached_direction = self.odometry.get_direction()
@@ -288,7 +255,12 @@ class Explorer:
 
         can_move = self._get_can_move_map()
         self.cached_pose = self.tracker.get_current_pose()
-        self.grid.update_grid(self.lidar.get_lidar_points(), self.cached_pose)
+        points = self.lidar.get_lidar_points(columnar=True)
+        if self.pose_graph is not None:
+            self.pose_graph.add_scan(self.cached_pose, points)
+            self.cached_pose = self.pose_graph.correct(self.cached_pose)
+        self.grid.update_grid(points, self.cached_pose)
+        self.tracer.mark('update_grid')
 
         if prev_direction['throttle'] == self.FORWARD_THROTTLE \
                 and len(list(filter(lambda x: x[0][1] == 1. and x[1] > 0., can_move.items()))) == 0:
@@ -304,6 +276,7 @@ class Explorer:
             {'to_car_center': self.FROM_LIDAR_TO_CENTER, 'turn_radius': self.TURN_DIAMETER / 2.},
             can_move
         )
+        self.tracer.mark('directions_weights')
 
         detected_object = self.detector.get_seen_object()
         if detected_object is None:
@@ -375,64 +348,65 @@ class Explorer:
                self.TURN_DIAMETER - self.HALF_CAR_WIDTH - self.FEAR_DISTANCE
 
     def _get_nearby_points(self, debug_radial_points=None):
+        """
+        returns LidarScan
+        """
         range_limit = self.CHECK_RADIUS + self.HALF_CAR_WIDTH + self.FEAR_DISTANCE
         range_limit += abs(self.FROM_LIDAR_TO_CENTER)
         if debug_radial_points is None:
-            nearby_points = self.lidar.get_radial_lidar_points(range_limit, cached=False)
+            nearby_points = self.lidar.get_radial_lidar_points(range_limit, cached=False, columnar=True)
         else:
-            nearby_points = list(filter(lambda x: x['distance'] <= range_limit, debug_radial_points))
-        self.cached_points = self.lidar.get_radial_lidar_points()  # cached, no limit
+            nearby_points = LidarScan.from_radial_points(debug_radial_points).limit(range_limit)
+        self.cached_points = self.lidar.get_radial_lidar_points(columnar=True)  # no limit, as LidarScan
         return nearby_points
 
-    def _filter_nearby_points(self, nearby_points):
-        nearby_points = list(filter(self._ellipse_like_range_filter, nearby_points))
+    def _prepare_nearby_cloud(self, ranges, angles):
+        """
+        ranges, angles: radial arrays
+        returns (N, 2) array of cartesian points within the ellipse-like check range,
+        except the ones inside the turn columns and on the car body
+        """
+        ranges = np.asarray(ranges, dtype=np.float64)
+        angles = np.asarray(angles, dtype=np.float64)
+        mask = ranges < self._ellipse_like_range_limits(angles)
+        ranges = ranges[mask]
+        angles = angles[mask]
+        xs = ranges * np.cos(angles)
+        ys = ranges * np.sin(angles)
 
-        nearby_points = self.lidar.radial_points_to_cartesian(nearby_points)
         left_center, right_center, column_radius = self._get_columns()
+        in_left_column = (ys > 0.) & (
+            (self._distances_to(left_center, xs, ys) < column_radius)
+            | (ys > left_center[1])
+            & (left_center[0] - column_radius < xs) & (xs < left_center[0] + column_radius)
+        )
+        in_right_column = (ys < 0.) & (
+            (self._distances_to(right_center, xs, ys) < column_radius)
+            | (ys < right_center[1])
+            & (right_center[0] - column_radius < xs) & (xs < right_center[0] + column_radius)
+        )
+        on_a_car = (self.BODY_POSITION['x'] + self.INNER_OFFSET <= xs) \
+            & (xs <= self.BODY_POSITION['x'] + self.BODY_POSITION['w'] - self.INNER_OFFSET) \
+            & (self.BODY_POSITION['y'] + self.INNER_OFFSET <= ys) \
+            & (ys <= self.BODY_POSITION['y'] + self.BODY_POSITION['h'] - self.INNER_OFFSET)
+
+        mask = ~(in_left_column | in_right_column | on_a_car)
+        result = np.empty((int(np.count_nonzero(mask)), 2), dtype=np.float64)
+        result[:, 0] = xs[mask]
+        result[:, 1] = ys[mask]
+        return result
 
-        def not_in_columns_and_a_car(a_point):
-            if a_point[1] > 0.:
-                if distance(left_center, a_point) < column_radius:
-                    return False
-                elif a_point[1] > left_center[1] \
-                        and left_center[0] - column_radius < a_point[0] < left_center[0] + column_radius:
-                    return False
-            elif a_point[1] < 0.:
-                if distance(right_center, a_point) < column_radius:
-                    return False
-                elif a_point[1] < right_center[1] \
-                        and right_center[0] - column_radius < a_point[0] < right_center[0] + column_radius:
-                    return False
-
-            if self.BODY_POSITION['x'] + self.INNER_OFFSET <= a_point[0] <= \
-                    self.BODY_POSITION['x'] + self.BODY_POSITION['w'] - self.INNER_OFFSET \
-                    and self.BODY_POSITION['y'] + self.INNER_OFFSET <= a_point[1] <= \
-                    self.BODY_POSITION['y'] + self.BODY_POSITION['h'] - self.INNER_OFFSET:
-                return False
-
-            return True
-
-        return list(filter(not_in_columns_and_a_car, nearby_points))
-
-    def _ellipse_like_range_filter(self, a_point):
-        angle = a_point['angle']
-        angle %= 2 * pi
-        if angle < 0:
-            angle = -angle
-
-        if pi / 2 <= angle <= 3 * pi / 2:
-            lidar_to_center = 0.
-        else:
-            lidar_to_center = self.FROM_LIDAR_TO_CENTER
+    def _ellipse_like_range_limits(self, angles):
+        angles = np.mod(angles, 2 * pi)
+        lidar_to_center = np.where(
+            (pi / 2 <= angles) & (angles <= 3 * pi / 2), 0., self.FROM_LIDAR_TO_CENTER
+        )
 
-        if angle >= pi:
-            angle -= pi
-        if angle > pi / 2:
-            angle = pi - angle
+        angles = np.where(angles >= pi, angles - pi, angles)
+        angles = np.where(angles > pi / 2, pi - angles, angles)
 
-        range_limit = self.CHECK_RADIUS + self.FEAR_DISTANCE \
-                      + self.HALF_CAR_WIDTH * angle + lidar_to_center * (pi / 2 - angle)
-        return a_point['distance'] < range_limit
+        return self.CHECK_RADIUS + self.FEAR_DISTANCE \
+            + self.HALF_CAR_WIDTH * angles + lidar_to_center * (pi / 2 - angles)
 
     def _follow_direction(self, direction):
         self.car_controls['steering'].run(direction['steering'])
@@ -445,6 +419,16 @@ class Explorer:
         else:
             return self.STOP_DISTANCE
 
+    def dump_tracing(self, file_path=None):
+        """
+        returns per-stage latency percentiles and keep_rps overruns of the main loop, writes json if file_path given
+        """
+        result = self.tracer.to_dict()
+        if file_path is not None:
+            with open(file_path, 'w') as a_file:
+                a_file.write(json.dumps(result))
+        return result
+
     def track_info_to_a_file(self, file_path):
         with open(file_path, 'w') as a_file:
             a_file.write(json.dumps(self.track_info))
@@ -2,10 +2,10 @@ import json
 
 import ballsbot.utils as ballsbot_utils
 
-ballsbot_utils.keep_rps = lambda ts, fps: ts
+ballsbot_utils.keep_rps = lambda ts, fps, tracer=None: ts
 
 from ballsbot.ai.explorer import Explorer
-from ballsbot.lidar import Lidar
+from ballsbot.lidar import Lidar, LidarScan
 
 
 class TrackFeedBase:
@@ -15,21 +15,38 @@ class TrackFeedBase:
     def next_frame(self):
         raise NotImplementedError()
 
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        self.close()
+
 
 class LidarMock:
     def __init__(self, feed):
         self.lidar = Lidar(True)
         self.calibration = None
         self.feed = feed
+        self.cached_scan = (None, None)
 
     def calibration_to_xywh(self, _):
         return self.lidar.calibration_to_xywh(self.lidar.calibration)
 
-    def get_lidar_points(self):
-        return self.radial_points_to_cartesian(self.get_radial_lidar_points(False))
+    def get_lidar_points(self, columnar=False):
+        return self.radial_points_to_cartesian(self.get_radial_lidar_points(columnar=columnar))
 
-    def get_radial_lidar_points(self, range_limit=None, cached=False):
-        return self.feed.get_current_frame()['points']
+    def get_radial_lidar_points(self, range_limit=None, cached=False, columnar=False):
+        points = self.feed.get_current_frame()['points']
+        if isinstance(points, LidarScan):
+            return points if columnar else points.to_radial_points()
+        if columnar:
+            if self.cached_scan[0] is not points:
+                self.cached_scan = (points, LidarScan.from_radial_points(points))
+            return self.cached_scan[1]
+        return points
 
     def radial_points_to_cartesian(self, points):
         return self.lidar.radial_points_to_cartesian(points)
@@ -39,8 +56,10 @@ class CarControlsMock:
     def __init__(self, feed):
         self.feed = feed
         self.counter = 0
+        self.commands = []
 
-    def run(self, _):
+    def run(self, value):
+        self.commands.append(value)
         self.counter += 1
         if self.counter == 2:
             self.counter = 0
@@ -66,11 +85,20 @@ class TrackerMock:
         return self.feed.get_current_frame()['pose']
 
 
-def get_mocked_bot(feed):
+class DetectorMock:
+    def __init__(self, feed):
+        self.feed = feed
+
+    def get_seen_object(self):
+        return self.feed.get_current_frame().get('seen_object')
+
+
+def get_mocked_bot(feed, grid_config=None):
     car_controls = CarControlsMock(feed)
     return Explorer(profile_mocks={
         'lidar': LidarMock(feed),
         'car_controls': {'steering': car_controls, 'throttle': car_controls},
         'odometry': OdometryMock(feed),
         'tracker': TrackerMock(feed),
-    })
+        'detector': DetectorMock(feed),
+    }, grid_config=grid_config)
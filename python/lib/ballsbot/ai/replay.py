@@ -0,0 +1,379 @@
+from concurrent.futures import ProcessPoolExecutor
+from time import time
+import cProfile
+import hashlib
+import json
+import pstats
+
+from ballsbot.ai.explorer_mock import get_mocked_bot, TrackFeedBase
+from ballsbot.track_log import TrackReader, is_track_log
+from ballsbot.tracing import Tracer
+
+
+class StopReplay(Exception):
+    pass
+
+
+class JsonTrackFeed(TrackFeedBase):
+    """
+    frames of a saved Explorer.track_info
+    """
+
+    def __init__(self, track_info):
+        self.track_info = track_info
+        self.frame_number = 0
+
+    @classmethod
+    def from_file(cls, file_path):
+        with open(file_path, 'r') as hf:
+            return cls(json.loads(hf.read()))
+
+    def get_current_frame(self):
+        return self.track_info[self.frame_number]
+
+    def next_frame(self):
+        self.frame_number += 1
+        if self.frame_number == len(self.track_info):
+            raise StopReplay()
+
+
+class BinaryTrackFeed(TrackFeedBase):
+    """
+    frames [start, stop) of a ballsbot.track_log file, decoded lazily from the memory-mapped log
+    """
+
+    def __init__(self, reader, start=0, stop=None, owns_reader=False):
+        """
+        owns_reader: close() closes the reader too
+        """
+        self.reader = reader
+        self.owns_reader = owns_reader
+        self.start = start
+        self.stop = len(reader) if stop is None else min(stop, len(reader))
+        self.frame_number = start
+        self.current_frame = None
+
+    @classmethod
+    def from_file(cls, file_path, start=0, stop=None):
+        return cls(TrackReader(file_path), start, stop, owns_reader=True)
+
+    def close(self):
+        self.current_frame = None
+        if self.owns_reader:
+            self.reader.close()
+
+    def __len__(self):
+        return max(0, self.stop - self.start)
+
+    def window(self, start, stop):
+        """
+        returns a feed of frames [start, stop) sharing the reader, for use from the same thread,
+        the reader is closed by this feed only
+        """
+        return BinaryTrackFeed(self.reader, start, stop)
+
+    def seek(self, frame_number):
+        self.frame_number = frame_number
+        self.current_frame = None
+
+    def seek_ts(self, ts):
+        """
+        moves to the first frame recorded at or after ts
+        """
+        self.seek(max(self.start, self.reader.find_frame(ts)))
+
+    def get_current_frame(self):
+        if self.current_frame is None:
+            if self.frame_number >= self.stop:
+                raise StopReplay()
+            self.current_frame = self.reader.get_frame(self.frame_number)
+        return self.current_frame
+
+    def next_frame(self):
+        self.seek(self.frame_number + 1)
+        if self.frame_number >= self.stop:
+            raise StopReplay()
+
+
+def split_into_windows(frames_count, windows_count):
+    """
+    returns [(start, stop), ...] covering frames_count frames with windows_count nearly equal windows
+    """
+    bounds = [frames_count * i // windows_count for i in range(windows_count + 1)]
+    return [(start, stop) for start, stop in zip(bounds[:-1], bounds[1:]) if stop > start]
+
+
+def open_track(file_path):
+    """
+    returns (frames count, feed factory) for a track log or a json Explorer.track_info recording,
+    track logs are opened lazily by every feed, json recordings are loaded once
+    """
+    if is_track_log(file_path):
+        with TrackReader(file_path) as reader:
+            frames_count = len(reader)
+        return frames_count, lambda: BinaryTrackFeed.from_file(file_path)
+    with open(file_path, 'r') as hf:
+        track_info = json.loads(hf.read())
+    return len(track_info), lambda: JsonTrackFeed(track_info)
+
+
+def replay_track(feed, save_track_info=False, grid_config=None):
+    """
+    runs a mocked Explorer with a new grid over all frames of the feed, returns the bot
+    """
+    bot = get_mocked_bot(feed, grid_config)
+    bot.tracer.reset()
+    try:
+        bot.run(save_track_info=save_track_info)
+    except StopReplay:
+        pass
+    return bot
+
+
+def decisions_digest(bot):
+    """
+    sha1 of all (steering, throttle) commands sent during the replay
+    """
+    commands = bot.car_controls['throttle'].commands
+    return hashlib.sha1(json.dumps(commands).encode('utf-8')).hexdigest()
+
+
+def _is_native(function_key):
+    return function_key[0] == '~'  # cProfile's file name for C functions: ballsbot_cpp, numpy, builtins
+
+
+def profile_functions(make_feed, top=20):
+    """
+    returns native and python time of one replay, split by function, seconds
+    """
+    profiler = cProfile.Profile()
+    with make_feed() as feed:
+        profiler.enable()
+        replay_track(feed)
+        profiler.disable()
+
+    stats = pstats.Stats(profiler).stats
+    native = {'total_s': 0., 'functions': []}
+    python = {'total_s': 0., 'functions': []}
+    for function_key, (_, calls, own_time, _, _) in stats.items():
+        side = native if _is_native(function_key) else python
+        side['total_s'] += own_time
+        side['functions'].append({
+            'function': pstats.func_std_string(function_key),
+            'calls': calls,
+            'own_s': own_time,
+        })
+    for side in (native, python):
+        side['functions'] = sorted(side['functions'], key=lambda x: x['own_s'], reverse=True)[:top]
+    return {'native': native, 'python': python}
+
+
+def benchmark_track(frames_count, make_feed, repeats=3, profile=True):
+    """
+    returns per-stage latency percentiles of the best of repeats (by p50 tick), the decisions digest
+    and, when profile is set, the native vs python split of an extra profiled replay
+    """
+    runs = []
+    digests = set()
+    for _ in range(repeats):
+        with make_feed() as feed:
+            bot = replay_track(feed)
+        runs.append(bot.dump_tracing()['stages'])
+        digests.add(decisions_digest(bot))
+
+    result = {
+        'frames': frames_count,
+        'stages': min(runs, key=lambda x: x.get('tick', {}).get('p50_ms') or 0.),
+        'decisions': sorted(digests)[0] if len(digests) == 1 else None,  # None: replay is not deterministic
+    }
+    if profile:
+        result['functions'] = profile_functions(make_feed)
+    return result
+
+
+def benchmark(track_paths, repeats=3, profile=True):
+    """
+    returns {track path: benchmark_track result}
+    """
+    result = {}
+    for track_path in track_paths:
+        frames_count, make_feed = open_track(track_path)
+        result[track_path] = benchmark_track(frames_count, make_feed, repeats=repeats, profile=profile)
+    return result
+
+
+def compare_with_baseline(result, baseline, tolerance=0.2, percentiles=('p50_ms', 'p95_ms')):
+    """
+    returns a list of regressions: stages slower than baseline by more than tolerance, changed decisions
+    """
+    regressions = []
+    for track_path, track_result in result.items():
+        track_baseline = baseline.get(track_path)
+        if track_baseline is None:
+            continue
+        if track_baseline.get('decisions') != track_result.get('decisions'):
+            regressions.append({'track': track_path, 'stage': None, 'what': 'decisions changed'})
+        for stage, stats in track_result['stages'].items():
+            baseline_stats = track_baseline['stages'].get(stage)
+            if baseline_stats is None:
+                continue
+            for percentile in percentiles:
+                new_value = stats.get(percentile)
+                old_value = baseline_stats.get(percentile)
+                if new_value is not None and old_value and new_value > old_value * (1. + tolerance):
+                    regressions.append({
+                        'track': track_path,
+                        'stage': stage,
+                        'what': percentile,
+                        'baseline': old_value,
+                        'value': new_value,
+                    })
+    return regressions
+
+
+def _best_direction(weights):
+    if not weights:
+        return None
+    return max(weights, key=weights.get)
+
+
+def replay_session(job):
+    """
+    job: {'track', 'start', 'stop', 'warmup', 'grid_config'}, replays frames [start - warmup, stop)
+    of the track and reports ticks of [start, stop) only; json recordings may give {'window', 'windows'}
+    instead of start and stop, so that only the worker parses them
+    returns {'track', 'start', 'commands': [(steering, throttle), ...], 'agreed', 'compared', 'tracer'}:
+    agreed of compared ticks chose the same best direction as the recording, warmup ticks are traced too
+    """
+    track_path = job['track']
+    if is_track_log(track_path):
+        begin = max(0, job['start'] - job['warmup'])
+        feed = BinaryTrackFeed.from_file(track_path, begin, job['stop'])
+        get_recorded_frame = feed.reader.get_frame
+    else:
+        track_info = JsonTrackFeed.from_file(track_path).track_info
+        if 'window' in job:
+            windows = split_into_windows(len(track_info), job['windows'])
+            start, stop = windows[job['window']] if job['window'] < len(windows) else (len(track_info),) * 2
+            job = dict(job, start=start, stop=stop)
+        if job['start'] >= job['stop']:  # fewer frames than windows
+            return {
+                'track': track_path, 'start': job['start'], 'commands': [], 'agreed': 0, 'compared': 0,
+                'tracer': Tracer('explorer'),
+            }
+        begin = max(0, job['start'] - job['warmup'])
+        feed = JsonTrackFeed(track_info[begin:job['stop']])
+        get_recorded_frame = track_info.__getitem__
+
+    with feed:
+        bot = replay_track(feed, save_track_info=True, grid_config=job.get('grid_config'))
+        skip = job['start'] - begin
+        commands = bot.car_controls['throttle'].commands
+        commands = [tuple(commands[i:i + 2]) for i in range(2 * skip, len(commands) - 1, 2)]
+
+        agreed = 0
+        compared = 0
+        for tick, replayed in enumerate(bot.track_info[skip:]):
+            recorded = _best_direction(get_recorded_frame(job['start'] + tick)['weights'])
+            if recorded is None or replayed['weights'] is None:
+                continue
+            compared += 1
+            if _best_direction(replayed['weights']) == recorded:
+                agreed += 1
+
+    tracer = Tracer(bot.tracer.name)
+    tracer.merge(bot.tracer)
+    return {
+        'track': track_path,
+        'start': job['start'],
+        'commands': commands,
+        'agreed': agreed,
+        'compared': compared,
+        'tracer': tracer,
+    }
+
+
+def _fraction(part, whole):
+    return part / whole if whole else None
+
+
+def run_replays(track_paths, processes=None, windows=1, warmup=20, grid_config=None):
+    """
+    replays every track (split into windows, each replayed after warmup frames of the previous one)
+    in a process pool, returns {'sessions': {track path: {'frames', 'decisions', 'commands',
+    'recorded_agreement', 'stages'}}, 'recorded_agreement', 'stages', 'frames', 'elapsed_s', ...}
+    """
+    started = time()
+    jobs = []
+    for track_path in track_paths:
+        job = {'track': track_path, 'warmup': warmup, 'grid_config': grid_config}
+        if not is_track_log(track_path):  # counted by the workers, parsing is as slow as replaying
+            jobs.extend(dict(job, window=i, windows=windows) for i in range(windows))
+            continue
+        with TrackReader(track_path) as reader:
+            frames_count = len(reader)
+        for start, stop in split_into_windows(frames_count, windows):
+            jobs.append(dict(job, start=start, stop=stop))
+    # json recordings (unknown length, parsed by every job) first, then the longest, for a shorter tail
+    jobs.sort(key=lambda x: x['stop'] - x['start'] if 'stop' in x else float('inf'), reverse=True)
+
+    with ProcessPoolExecutor(max_workers=processes) as executor:
+        replayed = list(executor.map(replay_session, jobs))
+
+    total_tracer = Tracer('explorer')
+    total_agreed = 0
+    total_compared = 0
+    sessions = {}
+    for track_path in track_paths:
+        windows_results = sorted((x for x in replayed if x['track'] == track_path), key=lambda x: x['start'])
+        tracer = Tracer('explorer')
+        commands = []
+        agreed = 0
+        compared = 0
+        for it in windows_results:
+            tracer.merge(it['tracer'])
+            commands.extend(it['commands'])
+            agreed += it['agreed']
+            compared += it['compared']
+        total_tracer.merge(tracer)
+        total_agreed += agreed
+        total_compared += compared
+        sessions[track_path] = {
+            'frames': len(commands),
+            'decisions': hashlib.sha1(json.dumps([x for it in commands for x in it]).encode('utf-8')).hexdigest(),
+            'commands': commands,
+            'recorded_agreement': _fraction(agreed, compared),
+            'stages': tracer.to_dict()['stages'],
+        }
+
+    return {
+        'sessions': sessions,
+        'recorded_agreement': _fraction(total_agreed, total_compared),
+        'stages': total_tracer.to_dict()['stages'],
+        'frames': sum(x['frames'] for x in sessions.values()),
+        'processes': processes,
+        'windows': windows,
+        'warmup': warmup,
+        'elapsed_s': time() - started,
+    }
+
+
+def decision_agreement(result, baseline):
+    """
+    returns ({track path: fraction of ticks with the same commands as in baseline}, overall fraction)
+    for tracks present in both run_replays results
+    """
+    sessions = {}
+    total_same = 0
+    total_compared = 0
+    for track_path, session in result['sessions'].items():
+        baseline_session = baseline['sessions'].get(track_path)
+        if baseline_session is None:
+            continue
+        pairs = list(zip(session['commands'], baseline_session['commands']))
+        same = sum(1 for new, old in pairs if list(new) == list(old))
+        compared = max(len(session['commands']), len(baseline_session['commands']))
+        sessions[track_path] = _fraction(same, compared)
+        total_same += same
+        total_compared += compared
+    return sessions, _fraction(total_same, total_compared)
@@ -1,4 +1,5 @@
-from math import pi, tan, atan
+from math import pi, tan, atan, atan2, sqrt
+import numpy as np
 
 from ballsbot.lidar import radial_to_cartesian
 from ballsbot.geometry import get_linear_coefs, distance, cross_point, get_radial_line
@@ -130,3 +131,167 @@ def get_g_room():
         angle += d_angle
 
     return points, radial_points, {'x': car_point[0], 'y': car_point[1], 'teta': car_teta}
+
+
+class SimulatedLaserScan:
+    """
+    LaserScan-like message of a simulated lidar, beams without a return have zero intensity
+    """
+
+    def __init__(self, angle_min, angle_increment, ranges, intensities):
+        self.angle_min = angle_min
+        self.angle_increment = angle_increment
+        self.angle_max = angle_min + angle_increment * len(ranges)
+        self.ranges = ranges
+        self.intensities = intensities
+
+    def get_angles(self):
+        return self.angle_min + np.arange(len(self.ranges)) * self.angle_increment
+
+    def to_radial_points(self):
+        mask = self.intensities > 0
+        return [
+            {'distance': d, 'angle': a}
+            for d, a in zip(self.ranges[mask].tolist(), self.get_angles()[mask].tolist())
+        ]
+
+
+class NoiseModel:
+    """
+    gaussian range noise and random dropouts, beams farther than max_range are lost
+    """
+
+    def __init__(self, range_sigma=0.01, dropout=0.02, max_range=12.):
+        self.range_sigma = range_sigma
+        self.dropout = dropout
+        self.max_range = max_range
+
+    def apply(self, ranges, rng):
+        """
+        returns noisy ranges and intensities
+        """
+        intensities = np.isfinite(ranges) & (ranges <= self.max_range)
+        if self.dropout > 0.:
+            intensities &= rng.random(len(ranges)) >= self.dropout
+        if self.range_sigma > 0.:
+            ranges = ranges + rng.normal(0., self.range_sigma, len(ranges))
+            intensities &= ranges > 0.
+        return ranges, intensities.astype(np.float32)
+
+
+class Scene:
+    """
+    a map as wall segments, (M, 4) array of x1, y1, x2, y2
+    """
+    MAX_PAIRS_PER_CHUNK = 1 << 21
+
+    def __init__(self, walls):
+        self.walls = np.asarray(walls, dtype=np.float64).reshape(-1, 4)
+
+    @classmethod
+    def from_polygons(cls, polygons):
+        """
+        polygons: [[[x, y], ...], ...], every polygon is closed
+        """
+        walls = []
+        for polygon in polygons:
+            for i, start in enumerate(polygon):
+                end = polygon[(i + 1) % len(polygon)]
+                walls.append([start[0], start[1], end[0], end[1]])
+        return cls(walls)
+
+    def cast_rays(self, x, y, angles):
+        """
+        returns distances from (x, y) to the nearest wall along world angles, inf when nothing is hit
+        """
+        angles = np.asarray(angles, dtype=np.float64)
+        result = np.full(len(angles), np.inf)
+        if len(self.walls) == 0:
+            return result
+
+        starts_x = self.walls[:, 0] - x
+        starts_y = self.walls[:, 1] - y
+        edges_x = self.walls[:, 2] - self.walls[:, 0]
+        edges_y = self.walls[:, 3] - self.walls[:, 1]
+
+        chunk = max(1, self.MAX_PAIRS_PER_CHUNK // len(self.walls))
+        for begin in range(0, len(angles), chunk):
+            dx = np.cos(angles[begin:begin + chunk])[:, None]
+            dy = np.sin(angles[begin:begin + chunk])[:, None]
+            with np.errstate(divide='ignore', invalid='ignore'):
+                denom = dx * edges_y - dy * edges_x
+                distances = (starts_x * edges_y - starts_y * edges_x) / denom
+                along_wall = (starts_x * dy - starts_y * dx) / denom
+            hit = (denom != 0.) & (distances > 0.) & (along_wall >= 0.) & (along_wall <= 1.)
+            result[begin:begin + chunk] = np.where(hit, distances, np.inf).min(axis=1)
+        return result
+
+    def scan(self, pose, beams=490, angle_min=-pi, noise=None, rng=None):
+        """
+        pose: {'x', 'y', 'teta'}, returns SimulatedLaserScan with angles in the car frame
+        """
+        angle_increment = 2. * pi / beams
+        angles = angle_min + np.arange(beams) * angle_increment
+        ranges = self.cast_rays(pose['x'], pose['y'], angles + pose['teta'])
+        if noise is None:
+            intensities = np.isfinite(ranges).astype(np.float32)
+        else:
+            if rng is None:
+                rng = np.random.default_rng()
+            ranges, intensities = noise.apply(ranges, rng)
+        return SimulatedLaserScan(angle_min, angle_increment, ranges.astype(np.float32), intensities)
+
+
+def get_long_room_scene():
+    return Scene.from_polygons([[[0., 0.], [4., 0.], [4., -2.], [0., -2.]]])
+
+
+def get_g_room_scene():
+    return Scene.from_polygons([[[0., 0.], [4., 0.], [4., -4.], [2., -4.], [2., -2.], [0., -2.]]])
+
+
+def get_trajectory(waypoints, speed=0.5, fps=4):
+    """
+    waypoints: [[x, y], ...], returns poses every 1 / fps seconds along the polyline, facing the movement
+    """
+    step = speed / fps
+    poses = []
+    for start, end in zip(waypoints[:-1], waypoints[1:]):
+        length = sqrt((end[0] - start[0]) ** 2 + (end[1] - start[1]) ** 2)
+        if length == 0.:
+            continue
+        teta = atan2(end[1] - start[1], end[0] - start[0])
+        steps_count = max(1, int(length / step))
+        for i in range(steps_count):
+            part = i / steps_count
+            poses.append({
+                'x': start[0] + (end[0] - start[0]) * part,
+                'y': start[1] + (end[1] - start[1]) * part,
+                'teta': teta,
+            })
+    if len(waypoints) > 0 and len(poses) > 0:
+        poses.append({'x': waypoints[-1][0], 'y': waypoints[-1][1], 'teta': poses[-1]['teta']})
+    return poses
+
+
+def get_track(scene, poses, beams=490, noise=None, seed=0, fps=4):
+    """
+    returns Explorer.track_info-like frames for the poses, replayable with explorer_mock
+    """
+    rng = np.random.default_rng(seed)
+    result = []
+    prev_pose = None
+    for pose in poses:
+        if prev_pose is None:
+            speed = 0.
+        else:
+            speed = sqrt((pose['x'] - prev_pose['x']) ** 2 + (pose['y'] - prev_pose['y']) ** 2) * fps
+        result.append({
+            'speed': speed,
+            'pose': dict(pose),
+            'points': scene.scan(pose, beams=beams, noise=noise, rng=rng).to_radial_points(),
+            'direction': 1. if speed > 0. else 0.,
+            'weights': None,
+        })
+        prev_pose = pose
+    return result
@@ -1,4 +1,5 @@
 import sys
+from time import time
 
 sys.path.append('/opt/ros/melodic/lib/python2.7/dist-packages')
 sys.path.append('/usr/lib/python2.7/dist-packages')
@@ -8,11 +9,25 @@ import rospy
 from ballsbot_detection.msg import DetectionsList
 
 
+class DetectionSlot:
+    __slots__ = ('ts', 'objects_detected', 'main_object_detected')
+
+    def __init__(self):
+        self.ts = None
+        self.objects_detected = []
+        self.main_object_detected = None
+
+
 class Detector:
+    RING_SIZE = 4
+    DETECTION_TIMEOUT = 5
+
     def __init__(self):
-        self.fps = 2
         self.objects_detected = None
         self.main_object_detected = None
+        self.slots = [DetectionSlot() for _ in range(self.RING_SIZE)]
+        self.next_slot = 0  # moved after the slot is filled, slots[next_slot - 1] is the latest one
+        self.subscriber = None
         self.object_classes = {
             'cat': 3,
             'dog': 2,  # cat
@@ -22,60 +37,85 @@ class Detector:
         }
 
     def start(self):
-        while True:
-            try:
-                data = rospy.wait_for_message('/cam_detections', DetectionsList, timeout=5)
-            except KeyboardInterrupt:
-                break
-            except rospy.exceptions.ROSException as e:
-                data = None
-            if data is not None:
-                detections = [{
-                    'object_class': x.object_class,
-                    'top_right': (x.top_right.x, x.top_right.y),
-                    'bottom_left': (x.bottom_left.x, x.bottom_left.y),
-                    'confidence': x.confidence,
-                } for x in data.data]
-            else:
-                detections = []
-
-            detections = list(filter(lambda x: x['object_class'] in self.object_classes, detections))
-
-            for an_object in detections:
-                an_object['hsize'] = an_object['top_right'][0] - an_object['bottom_left'][0]
-                an_object['vsize'] = an_object['top_right'][1] - an_object['bottom_left'][1]
-                an_object['size'] = an_object['hsize'] * an_object['vsize']
-                an_object['center'] = (
-                    an_object['bottom_left'][0] + an_object['hsize'] / 2.,
-                    an_object['bottom_left'][1] + an_object['vsize'] / 2.,
-                )
-
-            # add main object from prev frame if there is no object with this class in current
-            objects_detected = detections.copy()
-            if self.main_object_detected is not None:
-                seen_classes = set([x['object_class'] for x in detections])
-                if self.main_object_detected['object_class'] not in seen_classes \
-                        and len(list(filter(lambda x: x['object_class'] == self.main_object_detected['object_class'],
-                                            self.objects_detected))) != 0:
-                    detections.append(self.main_object_detected)
-
-            if len(detections) == 0:
-                self.main_object_detected = None
-            elif len(detections) == 1:
-                self.main_object_detected = detections[0]
-            else:
-                # first select class by max wight
-                # second select largest instance
-                self.main_object_detected = list(sorted(
-                    detections,
-                    key=lambda x: (self.object_classes[x['object_class']], x['size']),
-                    reverse=True
-                ))[0]
-
-            self.objects_detected = objects_detected
+        if self.subscriber is None:
+            self.subscriber = rospy.Subscriber('/cam_detections', DetectionsList, self._on_detections, queue_size=1)
+
+    def stop(self):
+        if self.subscriber is not None:
+            self.subscriber.unregister()
+            self.subscriber = None
+
+    def _on_detections(self, data):
+        detections = [{
+            'object_class': x.object_class,
+            'top_right': (x.top_right.x, x.top_right.y),
+            'bottom_left': (x.bottom_left.x, x.bottom_left.y),
+            'confidence': x.confidence,
+        } for x in data.data]
+        self._update(detections)
+
+    def _update(self, detections):
+        detections = list(filter(lambda x: x['object_class'] in self.object_classes, detections))
+
+        for an_object in detections:
+            an_object['hsize'] = an_object['top_right'][0] - an_object['bottom_left'][0]
+            an_object['vsize'] = an_object['top_right'][1] - an_object['bottom_left'][1]
+            an_object['size'] = an_object['hsize'] * an_object['vsize']
+            an_object['center'] = (
+                an_object['bottom_left'][0] + an_object['hsize'] / 2.,
+                an_object['bottom_left'][1] + an_object['vsize'] / 2.,
+            )
+
+        # add main object from prev frame if there is no object with this class in current
+        objects_detected = detections.copy()
+        if self.main_object_detected is not None:
+            seen_classes = set([x['object_class'] for x in detections])
+            if self.main_object_detected['object_class'] not in seen_classes \
+                    and len(list(filter(lambda x: x['object_class'] == self.main_object_detected['object_class'],
+                                        self.objects_detected))) != 0:
+                detections.append(self.main_object_detected)
+
+        if len(detections) == 0:
+            self.main_object_detected = None
+        elif len(detections) == 1:
+            self.main_object_detected = detections[0]
+        else:
+            # first select class by max wight
+            # second select largest instance
+            self.main_object_detected = list(sorted(
+                detections,
+                key=lambda x: (self.object_classes[x['object_class']], x['size']),
+                reverse=True
+            ))[0]
+
+        self.objects_detected = objects_detected
+
+        slot = self.slots[self.next_slot]
+        slot.ts = time()
+        slot.objects_detected = objects_detected
+        slot.main_object_detected = self.main_object_detected
+        self.next_slot = (self.next_slot + 1) % self.RING_SIZE
 
     def get_seen_object(self):
-        if self.main_object_detected is None:
+        """
+        returns the main object of the latest detections or None, the dict must not be modified
+        """
+        slot = self.slots[self.next_slot - 1]
+        if slot.ts is None or slot.main_object_detected is None or time() - slot.ts > self.DETECTION_TIMEOUT:
             return None
-        else:
-            return self.main_object_detected.copy()
+        return slot.main_object_detected
+
+    def get_recent_detections(self):
+        """
+        returns slots of the last RING_SIZE detections not older than DETECTION_TIMEOUT, the newest first;
+        the slots must not be modified
+        """
+        now = time()
+        newest = self.next_slot - 1
+        result = []
+        for i in range(self.RING_SIZE):
+            slot = self.slots[(newest - i) % self.RING_SIZE]
+            if slot.ts is None or now - slot.ts > self.DETECTION_TIMEOUT:
+                break
+            result.append(slot)
+        return result
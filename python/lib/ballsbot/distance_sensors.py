@@ -9,64 +9,80 @@ import rospy
 from ballsbot_laser_ranging_sensor.msg import LaserDistance
 from ballsbot.config import LASER_SENSOR_FRONT_ENABLED, LASER_SENSOR_REAR_ENABLED, \
     LASER_SENSOR_FRONT_OFFSET, LASER_SENSOR_REAR_OFFSET
-from ballsbot.utils import run_as_thread
 
 
 def has_distance_sensors():
     return LASER_SENSOR_FRONT_ENABLED or LASER_SENSOR_REAR_ENABLED
 
 
+class DistanceRing:
+    """
+    last readings of one sensor in a preallocated array with a running sum, written by the subscriber thread only
+    """
+
+    def __init__(self, size, shift):
+        self.shift = shift
+        self.values = np.zeros((size,), dtype=np.float64)
+        self.index = 0
+        self.total = None
+
+    def push(self, value):
+        if self.total is None:
+            self.values.fill(value)
+            self.total = value * len(self.values)
+        else:
+            self.total += value - self.values[self.index]
+            self.values[self.index] = value
+            self.index = (self.index + 1) % len(self.values)
+
+    def get_average(self):
+        total = self.total
+        if total is None:
+            return None
+        return total / len(self.values)
+
+
 class DistanceSensors:
     def __init__(self, autostart=True):
         self.distances = {}
         self.avg_points_count = 4
+        self.subscribers = []
+        self.result = {}
         if autostart:
             self.start()
 
     def start(self):
         if LASER_SENSOR_FRONT_ENABLED:
-            self.distances['front'] = {
-                'shift': LASER_SENSOR_FRONT_OFFSET,
-            }
-            run_as_thread(self.get_auto_update('front'))
+            self._subscribe('front', LASER_SENSOR_FRONT_OFFSET)
 
         if LASER_SENSOR_REAR_ENABLED:
-            self.distances['rear'] = {
-                'shift': LASER_SENSOR_REAR_OFFSET,
-            }
-            run_as_thread(self.get_auto_update('rear'))
-
-    def get_auto_update(self, direction):
-        def result():
-            while True:
-                try:
-                    data = rospy.wait_for_message('/laser_distance_' + direction, LaserDistance, timeout=5)
-                except KeyboardInterrupt:
-                    break
-                except rospy.exceptions.ROSException as e:
-                    data = None
-                if data is not None:
-                    it = self.distances[data.direction]
-                    if 'values' in it:
-                        it['values'][it['index']] = data.distance_in_mm
-                        it['index'] = (it['index'] + 1) % self.avg_points_count
-                    else:
-                        it['values'] = [data.distance_in_mm] * self.avg_points_count
-                        it['index'] = 0
+            self._subscribe('rear', LASER_SENSOR_REAR_OFFSET)
 
-        return result
+    def _subscribe(self, direction, shift):
+        self.distances[direction] = DistanceRing(self.avg_points_count, shift)
+        self.result[direction] = None
+        self.subscribers.append(
+            rospy.Subscriber('/laser_distance_' + direction, LaserDistance, self._on_distance, queue_size=1)
+        )
+
+    def _on_distance(self, data):
+        self.distances[data.direction].push(float(data.distance_in_mm))
+
+    def stop(self):
+        for subscriber in self.subscribers:
+            subscriber.unregister()
+        self.subscribers = []
 
     def get_distances(self):
-        result = {}
+        """
+        returns {direction: mm or None}, the same dict is updated on every call
+        """
+        result = self.result
         for k, it in self.distances.items():
-            if 'values' not in it:
+            value = it.get_average()
+            if value is None or value > 1900.:
                 result[k] = None
             else:
-                value = np.mean(it['values'])
-                if value > 1900.:
-                    result[k] = None
-                else:
-                    result[k] = value + self.distances[k]['shift']
-                    if result[k] < 0:
-                        result[k] = 0.
+                value += it.shift
+                result[k] = value if value >= 0 else 0.
         return result
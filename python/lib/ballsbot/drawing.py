@@ -3,22 +3,34 @@ from matplotlib.figure import Figure
 import matplotlib.patches as patches
 from matplotlib.transforms import Affine2D
 from io import BytesIO
+import numpy as np
 
 from ballsbot.utils import figsize_from_image_size
 
 
+def _poses_to_xy(poses):
+    if isinstance(poses, np.ndarray):  # ballsbot.tracking.POSE_DTYPE records, drawn without copying
+        return poses['x'], poses['y']
+    return [x['x'] for x in poses], [x['y'] for x in poses]
+
+
 def update_image_abs_coords(
         image, poses, lidar_points, self_position, only_nearby_meters, figsize=None,
-        tail_points=None, tail_lines=None, lines=None
+        tail_points=None, tail_lines=None, lines=None, pose=None, history_poses=None
 ):
+    """
+    poses, history_poses: lists of {'x', 'y', ...} or structured arrays with 'x' and 'y' fields
+    tail_points: a list of [x, y] or an (N, 2) array
+    pose: the current pose, the last one of poses by default
+    """
     if figsize is None:
         figsize = figsize_from_image_size(image)
-    poses_x_points = [x['x'] for x in poses]
-    poses_y_points = [x['y'] for x in poses]
-    if len(poses) == 0:
-        pose = {'x': 0., 'y': 0., 'teta': 0.}
-    else:
-        pose = poses[-1]
+    poses_x_points, poses_y_points = _poses_to_xy(poses)
+    if pose is None:
+        if len(poses) == 0:
+            pose = {'x': 0., 'y': 0., 'teta': 0.}
+        else:
+            pose = poses[-1]
 
     fig = Figure(figsize=figsize)
     canvas = FigureCanvas(fig)
@@ -27,11 +39,17 @@ def update_image_abs_coords(
     ax.set_xlim(-only_nearby_meters, only_nearby_meters)
     ax.set_ylim(-only_nearby_meters, only_nearby_meters)
 
+    if history_poses is not None:
+        history_x_points, history_y_points = _poses_to_xy(history_poses)
+        ax.scatter(history_x_points, history_y_points, marker='o', s=1, c='lightgray')
     ax.scatter(poses_x_points, poses_y_points, marker='o', s=1, c='gray')
 
-    if tail_points:
-        tail_x_points = [x[0] for x in tail_points]
-        tail_y_points = [x[1] for x in tail_points]
+    if tail_points is not None and len(tail_points) > 0:
+        if isinstance(tail_points, np.ndarray):  # (N, 2) e.g. submap points
+            tail_x_points, tail_y_points = tail_points[:, 0], tail_points[:, 1]
+        else:
+            tail_x_points = [x[0] for x in tail_points]
+            tail_y_points = [x[1] for x in tail_points]
         ax.scatter(tail_x_points, tail_y_points, marker='o', s=5, c='lightblue')
     if tail_lines:
         for a_line in tail_lines:
@@ -2,11 +2,13 @@ from math import cos, sin, pi
 import numpy as np
 import ballsbot.drawing as drawing
 import sys
+import threading
 from time import time
 from random import random
 
 from ballsbot.utils import keep_rps
 from ballsbot.config import LIDAR_CALIBRATION
+from ballsbot_cpp import ballsbot_cpp
 
 sys.path.append('/opt/ros/melodic/lib/python2.7/dist-packages')
 sys.path.append('/usr/lib/python2.7/dist-packages')
@@ -21,22 +23,110 @@ def radial_to_cartesian(magnitude, angle):
     return [x, y]
 
 
-def apply_transformation_to_cloud(a_cloud, tr):
-    result = []
-
-    tx, ty, fi = tr
-    rotate_m = np.array([
-        [cos(fi), -sin(fi)],
-        [sin(fi), cos(fi)]
-    ])
-    move_m = np.array([tx, ty]).reshape((2, 1))
-
-    for point in a_cloud:
-        point = np.array(point).reshape((2, 1))
-        point = rotate_m @ point + move_m
-        result.append(point[:, 0].tolist())
+def apply_transformation_to_cloud(a_cloud, tr, columnar=False):
+    result = ballsbot_cpp.apply_transformation(a_cloud, tr)
+    if columnar:
+        return result
+    return result.tolist()
+
+
+class LidarScan:
+    """
+    columnar lidar scan: parallel float32 arrays of ranges, corrected angles and intensities
+    """
+
+    def __init__(self, ranges, angles, intensities, cos_angles=None, sin_angles=None):
+        self.ranges = ranges
+        self.angles = angles
+        self.intensities = intensities
+        if cos_angles is None:
+            cos_angles = np.cos(angles)
+        if sin_angles is None:
+            sin_angles = np.sin(angles)
+        self.cos_angles = cos_angles
+        self.sin_angles = sin_angles
+        self._cartesian = None
+
+    @classmethod
+    def empty(cls):
+        empty_array = np.empty((0,), dtype=np.float32)
+        return cls(empty_array, empty_array, empty_array, empty_array, empty_array)
+
+    @classmethod
+    def from_radial_points(cls, points):
+        ranges = np.fromiter((x['distance'] for x in points), dtype=np.float32, count=len(points))
+        angles = np.fromiter((x['angle'] for x in points), dtype=np.float32, count=len(points))
+        return cls(ranges, angles, np.ones_like(ranges))
+
+    def __len__(self):
+        return len(self.ranges)
+
+    def select(self, mask):
+        return LidarScan(
+            self.ranges[mask], self.angles[mask], self.intensities[mask],
+            self.cos_angles[mask], self.sin_angles[mask]
+        )
 
-    return result
+    def limit(self, range_limit):
+        if range_limit is None:
+            return self
+        return self.select(self.ranges <= range_limit)
+
+    def to_cartesian(self):
+        """
+        returns (N, 2) float64 array, cached
+        """
+        if self._cartesian is None:
+            result = np.empty((len(self.ranges), 2), dtype=np.float64)
+            np.multiply(self.ranges, self.cos_angles, out=result[:, 0])
+            np.multiply(self.ranges, self.sin_angles, out=result[:, 1])
+            self._cartesian = result
+        return self._cartesian
+
+    def to_radial_points(self):
+        return [{'distance': d, 'angle': a} for d, a in zip(self.ranges.tolist(), self.angles.tolist())]
+
+
+class ScanRing:
+    """
+    fixed-size ring of (ts, LidarScan), filled by the subscriber thread
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self.items = [None] * size
+        self.index = 0
+        self.count = 0
+        self.condition = threading.Condition()
+
+    def __len__(self):
+        return self.count
+
+    def push(self, ts, scan):
+        with self.condition:
+            self.items[self.index] = (ts, scan)
+            self.index = (self.index + 1) % self.size
+            self.count = min(self.count + 1, self.size)
+            self.condition.notify_all()
+
+    def latest(self, timeout=None):
+        """
+        returns (ts, LidarScan) or None, waits up to timeout seconds for the first scan
+        """
+        with self.condition:
+            if self.count == 0 and timeout is not None:
+                self.condition.wait_for(lambda: self.count > 0, timeout=timeout)
+            if self.count == 0:
+                return None
+            return self.items[(self.index - 1) % self.size]
+
+    def get_all(self):
+        """
+        returns [(ts, LidarScan), ...], oldest first
+        """
+        with self.condition:
+            start = (self.index - self.count) % self.size
+            return [self.items[(start + i) % self.size] for i in range(self.count)]
 
 
 class TestLidarData:
@@ -50,14 +140,24 @@ class TestLidarData:
 
 
 class Lidar:
+    SCAN_RING_SIZE = 8
+    FIRST_SCAN_TIMEOUT = 5
+    MAX_SCAN_AGE = 1.  # seconds, a few rotations of the lidar
+
     def __init__(self, test_run=False):
         self.calibration = self._default_calibration()
         self.angle_min = -pi
         self.angle_max = pi
+        self.scan = LidarScan.empty()
         self.radial_points = []
         self.points = []
         self.points_ts = time()
         self.test_run = test_run
+        self._angle_tables_key = None
+        self._angle_tables = None
+        self.scans = ScanRing(self.SCAN_RING_SIZE)
+        self._subscriber = None
+        self._stale_scan_reported = False
 
     def _default_calibration(self):
         return LIDAR_CALIBRATION
@@ -81,6 +181,21 @@ class Lidar:
 
         return data
 
+    def _subscribe(self):
+        if self._subscriber is None:
+            self._subscriber = rospy.Subscriber('/scan', LaserScan, self._on_scan, queue_size=1)
+
+    def _on_scan(self, data):
+        ts = time()
+        self.angle_min = data.angle_min
+        self.angle_max = data.angle_max
+        self.scans.push(ts, self._raw_to_scan(data))
+
+    def stop(self):
+        if self._subscriber is not None:
+            self._subscriber.unregister()
+            self._subscriber = None
+
     def _fix_angle(self, my_angle, angle_fix=None):
         if angle_fix is None:
             angle_fix = self.calibration['angle_fix']
@@ -91,42 +206,107 @@ class Lidar:
             my_angle = self.angle_min + my_angle - self.angle_max
         return my_angle
 
-    def get_radial_lidar_points(self, range_limit=None, cached=True):
+    def _fix_angles(self, angles, angle_fix=None):
+        if angle_fix is None:
+            angle_fix = self.calibration['angle_fix']
+        angles = angles - angle_fix
+        angles_span = self.angle_max - self.angle_min
+        angles[angles < self.angle_min] += angles_span
+        angles[angles > self.angle_max] -= angles_span
+        return angles
+
+    def _get_angle_tables(self, angle_min, angle_increment, points_count):
+        """
+        returns corrected angles, cos and sin per beam, rebuilt only when scan geometry or calibration changes
+        """
+        key = (angle_min, self.angle_max, angle_increment, points_count, self.calibration['angle_fix'])
+        if key != self._angle_tables_key:
+            angles = self._fix_angles(angle_min + np.arange(points_count) * angle_increment)
+            self._angle_tables = (
+                angles.astype(np.float32),
+                np.cos(angles).astype(np.float32),
+                np.sin(angles).astype(np.float32),
+            )
+            self._angle_tables_key = key
+        return self._angle_tables
+
+    def _raw_to_scan(self, data):
+        intensities = np.asarray(data.intensities, dtype=np.float32)
+        points_count = len(intensities)
+        ranges = np.asarray(data.ranges, dtype=np.float32)[:points_count]
+        angles, cos_angles, sin_angles = self._get_angle_tables(data.angle_min, data.angle_increment, points_count)
+        mask = intensities > 0
+        return LidarScan(ranges[mask], angles[mask], intensities[mask], cos_angles[mask], sin_angles[mask])
+
+    def get_radial_lidar_points(self, range_limit=None, cached=True, columnar=False):
+        """
+        columnar=True returns LidarScan instead of a list of {'distance', 'angle'} dicts
+        """
         if not cached:
             self._get_radial_lidar_points()
+        if columnar:
+            return self.scan.limit(range_limit)
         if range_limit is None:
+            if self.radial_points is None:
+                self.radial_points = self.scan.to_radial_points()
             return self.radial_points
-        return list(filter(lambda x: x['distance'] <= range_limit, self.radial_points))
+        return self.scan.limit(range_limit).to_radial_points()
 
     def _get_radial_lidar_points(self):
-        data = self._get_raw_lidar_points()
-        self.points_ts = time()
-        if data is None:
-            self.radial_points = []
-            return self.radial_points
-        points = []
-        angle = data.angle_min
-        for i in range(len(data.intensities)):
-            if data.intensities[i] > 0:
-                points.append({'distance': data.ranges[i], 'angle': self._fix_angle(angle)})
-            angle += data.angle_increment
-
-        self.radial_points = points
-        self.points = []
-        return points
+        """
+        returns the newest scan without waiting for the next rotation, an empty one when it is older than MAX_SCAN_AGE
+        """
+        if self.test_run:
+            scan = self._raw_to_scan(self._get_raw_lidar_points())
+            self.points_ts = time()
+        else:
+            self._subscribe()
+            try:
+                latest = self.scans.latest(timeout=self.FIRST_SCAN_TIMEOUT)
+            except KeyboardInterrupt:
+                latest = None
+            now = time()
+            if latest is not None and now - latest[0] > self.MAX_SCAN_AGE:
+                if not self._stale_scan_reported:
+                    print('lidar: the latest scan is {:.1f} s old, /scan stopped?'.format(now - latest[0]),
+                          file=sys.stderr)
+                    self._stale_scan_reported = True
+                latest = None
+            elif latest is not None:
+                self._stale_scan_reported = False
+            if latest is None:
+                scan = LidarScan.empty()
+                self.points_ts = now
+            else:
+                self.points_ts, scan = latest
+
+        self.scan = scan
+        self.radial_points = None
+        self.points = None
+        return scan
 
     @staticmethod
     def radial_points_to_cartesian(points):
+        if isinstance(points, LidarScan):
+            return points.to_cartesian()
         return [radial_to_cartesian(x['distance'], x['angle']) for x in points]
 
-    def get_lidar_points(self):
-        if len(self.points) == 0 and len(self.radial_points) > 0:
-            self.points = self.radial_points_to_cartesian(self.radial_points)  # FIXME race condition?
-        return self.points
+    def get_lidar_points(self, columnar=False):
+        """
+        columnar=True returns (N, 2) array instead of a list of [x, y]
+        """
+        scan = self.scan
+        if columnar:
+            return scan.to_cartesian()
+        points = self.points
+        if points is None:
+            points = scan.to_cartesian().tolist()
+            self.points = points
+        return points
 
     def _get_lidar_points(self):
-        points = self._get_radial_lidar_points()
-        points = self.radial_points_to_cartesian(points)
+        scan = self._get_radial_lidar_points()
+        points = scan.to_cartesian().tolist()
         self.points = points
         return points
 
@@ -0,0 +1,373 @@
+"""
+pose graph back end: keyframe poses linked by odometry edges, by scan matching edges to the previous
+keyframe and by loop closures (scan matching to older keyframes found nearby), optimized with sparse
+gauss-newton; online the work is done by a background thread, the decision loop only queues keyframes
+and reads the latest correction
+"""
+from math import floor, pi
+import queue
+import threading
+
+import numpy as np
+from scipy.sparse import coo_matrix, identity
+from scipy.sparse.linalg import spsolve
+
+from ballsbot.submaps import moved_enough, voxel_downsample
+from ballsbot.tracing import get_tracer
+from ballsbot_cpp import ballsbot_cpp
+
+
+def _wrap(angles):
+    return (angles + pi) % (2 * pi) - pi
+
+
+def compose(a, b):
+    """
+    (x, y, teta) of pose b given in the frame of pose a, in the frame a is given in
+    """
+    c, s = np.cos(a[2]), np.sin(a[2])
+    return np.array([a[0] + c * b[0] - s * b[1], a[1] + s * b[0] + c * b[1], _wrap(a[2] + b[2])])
+
+
+def between(a, b):
+    """
+    pose b in the frame of pose a
+    """
+    c, s = np.cos(a[2]), np.sin(a[2])
+    dx, dy = b[0] - a[0], b[1] - a[1]
+    return np.array([c * dx + s * dy, -s * dx + c * dy, _wrap(b[2] - a[2])])
+
+
+def _inverse(pose):
+    return between(pose, np.zeros((3,)))
+
+
+def _to_array(pose):
+    return np.array([float(pose['x']), float(pose['y']), float(pose['teta'])])
+
+
+def _to_dict(pose):
+    return {'x': float(pose[0]), 'y': float(pose[1]), 'teta': float(pose[2])}
+
+
+class KeyframeIndex:
+    """
+    keyframe numbers by square cells of cell_size meters
+    """
+
+    def __init__(self, cell_size=2.):
+        self.cell_size = cell_size
+        self.cells = {}
+
+    def _cell(self, x, y):
+        return int(floor(x / self.cell_size)), int(floor(y / self.cell_size))
+
+    def add(self, number, x, y):
+        self.cells.setdefault(self._cell(x, y), []).append(number)
+
+    def rebuild(self, positions):
+        self.cells = {}
+        for number, (x, y) in enumerate(positions):
+            self.add(number, x, y)
+
+    def query(self, x, y, radius, positions):
+        """
+        numbers of keyframes within radius of (x, y), the nearest first
+        """
+        min_x, min_y = self._cell(x - radius, y - radius)
+        max_x, max_y = self._cell(x + radius, y + radius)
+        result = []
+        for cell_x in range(min_x, max_x + 1):
+            for cell_y in range(min_y, max_y + 1):
+                result.extend(self.cells.get((cell_x, cell_y), ()))
+        if not result:
+            return []
+        result = np.array(result)
+        distances = np.hypot(positions[result, 0] - x, positions[result, 1] - y)
+        order = np.argsort(distances)
+        return result[order][distances[order] <= radius].tolist()
+
+
+class PoseGraph:
+    def __init__(self):
+        self._poses = np.zeros((64, 3), dtype=np.float64)
+        self.count = 0
+        self.edges = []  # (from node, to node, measured pose of "to" in the frame of "from", information (3,))
+
+    @property
+    def poses(self):
+        return self._poses[:self.count]
+
+    def add_node(self, pose):
+        if self.count == len(self._poses):
+            self._poses = np.concatenate((self._poses, np.zeros_like(self._poses)))
+        self._poses[self.count] = pose
+        self.count += 1
+        return self.count - 1
+
+    def add_edge(self, from_node, to_node, measurement, information):
+        self.edges.append((from_node, to_node, np.asarray(measurement, dtype=np.float64),
+                           np.asarray(information, dtype=np.float64)))
+
+    def _linearize(self, poses, from_nodes, to_nodes, measurements, sqrt_information):
+        """
+        weighted errors (3 * edges,) and their sparse jacobian by the poses of all nodes but the first one
+        """
+        a, b = poses[from_nodes], poses[to_nodes]
+        c, s = np.cos(a[:, 2]), np.sin(a[:, 2])
+        dx, dy = b[:, 0] - a[:, 0], b[:, 1] - a[:, 1]
+        errors = np.stack((
+            c * dx + s * dy - measurements[:, 0],
+            -s * dx + c * dy - measurements[:, 1],
+            _wrap(b[:, 2] - a[:, 2] - measurements[:, 2]),
+        ), axis=1) * sqrt_information
+
+        edges_count = len(from_nodes)
+        jacobian_from = np.zeros((edges_count, 3, 3))
+        jacobian_from[:, 0, 0] = -c
+        jacobian_from[:, 0, 1] = -s
+        jacobian_from[:, 0, 2] = -s * dx + c * dy
+        jacobian_from[:, 1, 0] = s
+        jacobian_from[:, 1, 1] = -c
+        jacobian_from[:, 1, 2] = -c * dx - s * dy
+        jacobian_from[:, 2, 2] = -1.
+        jacobian_to = np.zeros((edges_count, 3, 3))
+        jacobian_to[:, 0, 0] = c
+        jacobian_to[:, 0, 1] = s
+        jacobian_to[:, 1, 0] = -s
+        jacobian_to[:, 1, 1] = c
+        jacobian_to[:, 2, 2] = 1.
+
+        rows = np.broadcast_to(3 * np.arange(edges_count)[:, None, None] + np.arange(3)[None, :, None],
+                               (edges_count, 3, 3))
+        data, all_rows, all_cols = [], [], []
+        for nodes, block in ((from_nodes, jacobian_from), (to_nodes, jacobian_to)):
+            cols = 3 * (nodes[:, None, None] - 1) + np.arange(3)[None, None, :]
+            cols = np.broadcast_to(cols, (edges_count, 3, 3))
+            free = np.broadcast_to((nodes > 0)[:, None, None], (edges_count, 3, 3))
+            data.append((block * sqrt_information[:, :, None])[free])
+            all_rows.append(rows[free])
+            all_cols.append(cols[free])
+        jacobian = coo_matrix(
+            (np.concatenate(data), (np.concatenate(all_rows), np.concatenate(all_cols))),
+            shape=(3 * edges_count, 3 * (len(poses) - 1)),
+        ).tocsr()
+        return errors.reshape(-1), jacobian
+
+    def optimize(self, iterations=10, tolerance=1e-4):
+        """
+        gauss-newton with the first pose fixed, returns (optimized copy of the poses, weighted squared error
+        before the last step), the graph is not changed
+        """
+        if self.count < 2 or not self.edges:
+            return self.poses.copy(), 0.
+        from_nodes = np.array([x[0] for x in self.edges])
+        to_nodes = np.array([x[1] for x in self.edges])
+        measurements = np.array([x[2] for x in self.edges])
+        sqrt_information = np.sqrt(np.array([x[3] for x in self.edges]))
+
+        poses = self.poses.copy()
+        damping = identity(3 * (len(poses) - 1), format='csc') * 1e-9
+        error = 0.
+        for _ in range(iterations):
+            errors, jacobian = self._linearize(poses, from_nodes, to_nodes, measurements, sqrt_information)
+            error = float(errors @ errors)
+            delta = spsolve((jacobian.T @ jacobian).tocsc() + damping, -(jacobian.T @ errors))
+            poses[1:] += delta.reshape((-1, 3))
+            poses[:, 2] = _wrap(poses[:, 2])
+            if np.abs(delta).max() < tolerance:
+                break
+        return poses, error
+
+
+class PoseGraphOptimizer:
+    MIN_MATCH_SCORE = 0.6
+
+    def __init__(self, keyframe_distance=0.3, keyframe_rotation=pi / 12, voxel_size=0.05,
+                 loop_closure_radius=2., loop_closure_min_gap=30, loop_closure_candidates=3, optimize_every=10,
+                 odometry_information=(25., 25., 100.), scan_matching_information=(400., 400., 1600.),
+                 scan_matcher=None, max_queued=64, autostart=True):
+        """
+        keyframes are scans taken keyframe_distance meters or keyframe_rotation radians away from the previous one,
+        loop closures are tried with the nearest loop_closure_candidates keyframes within loop_closure_radius
+        and at least loop_closure_min_gap keyframes older
+        scan_matcher: optional ballsbot_cpp.ScanMatcher, a default one searches 1 m and 0.5 rad around the estimate
+        information: inverse variances of (x, y, teta) of the edges
+        """
+        self.keyframe_distance = keyframe_distance
+        self.keyframe_rotation = keyframe_rotation
+        self.voxel_size = voxel_size
+        self.loop_closure_radius = loop_closure_radius
+        self.loop_closure_min_gap = loop_closure_min_gap
+        self.loop_closure_candidates = loop_closure_candidates
+        self.optimize_every = optimize_every
+        self.odometry_information = odometry_information
+        self.scan_matching_information = scan_matching_information
+        if scan_matcher is None:
+            scan_matcher = ballsbot_cpp.ScanMatcher(linear_window=1., angular_window=0.5)
+        self.scan_matcher = scan_matcher
+
+        self.graph = PoseGraph()
+        self.index = KeyframeIndex(loop_closure_radius)
+        self.raw_poses = []  # keyframe poses as received
+        self.clouds = []  # voxel-downsampled keyframe clouds in the car frame
+        self.keyframes_since_optimization = 0
+        self.last_keyframe_pose = None
+        self.lock = threading.Lock()
+        self.correction = np.zeros((3,))  # moves raw poses to the optimized frame
+        self.tracer = get_tracer('pose_graph')
+
+        self.keyframes = queue.Queue(maxsize=max_queued)
+        self.dropped = 0
+        self.thread = None
+        if autostart:
+            self.start()
+
+    def start(self):
+        self.thread = threading.Thread(target=self._loop, daemon=True)
+        self.thread.start()
+
+    def close(self):
+        if self.thread is not None:
+            self.keyframes.put(None)
+            self.thread.join()
+            self.thread = None
+
+    def select_keyframe(self, pose):
+        if not moved_enough(pose, self.last_keyframe_pose, self.keyframe_distance, self.keyframe_rotation):
+            return False
+        self.last_keyframe_pose = _to_dict(_to_array(pose))
+        return True
+
+    def add_scan(self, pose, points):
+        """
+        pose: {'x', 'y', 'teta'} from the tracker, points: (N, 2) in the car frame;
+        never blocks, keyframes are dropped (and counted) when the background thread lags
+        """
+        if pose is None or not self.select_keyframe(pose):
+            return False
+        try:
+            self.keyframes.put_nowait((_to_array(pose), points))
+        except queue.Full:
+            self.dropped += 1
+            self.tracer.count('keyframes_dropped')
+            return False
+        return True
+
+    def correct(self, pose):
+        """
+        pose from the tracker moved by the correction of the latest optimized keyframe
+        """
+        if pose is None:
+            return None
+        with self.lock:
+            correction = self.correction
+        return _to_dict(compose(correction, _to_array(pose)))
+
+    def get_poses(self):
+        """
+        copy of the optimized keyframe poses, (N, 3)
+        """
+        with self.lock:
+            return self.graph.poses.copy()
+
+    def _loop(self):
+        while True:
+            keyframe = self.keyframes.get()
+            if keyframe is None:
+                break
+            self.process_keyframe(*keyframe)
+
+    def _match(self, reference_node, cloud, guess):
+        """
+        pose of cloud's keyframe in the frame of the reference keyframe, None when the match is poor
+        """
+        self.scan_matcher.set_reference(self.clouds[reference_node])
+        x, y, teta, converged, score = self.scan_matcher.match(cloud, guess)
+        if not converged or score < self.MIN_MATCH_SCORE:
+            return None
+        return np.array([x, y, teta])
+
+    def process_keyframe(self, raw_pose, points):
+        """
+        adds a node with odometry and scan matching edges, tries loop closures, optimizes when needed
+        """
+        cloud, _ = voxel_downsample(points, self.voxel_size)
+        node = self.graph.count
+        if node == 0:
+            with self.lock:
+                self.graph.add_node(raw_pose)
+            self.raw_poses.append(raw_pose)
+            self.clouds.append(cloud)
+            self.index.add(node, raw_pose[0], raw_pose[1])
+            return
+
+        self.tracer.begin()
+        odometry = between(self.raw_poses[-1], raw_pose)
+        estimate = compose(self.graph.poses[-1], odometry)
+        with self.lock:
+            self.graph.add_node(estimate)
+        self.graph.add_edge(node - 1, node, odometry, self.odometry_information)
+        matched = self._match(node - 1, cloud, odometry)
+        if matched is not None:
+            self.graph.add_edge(node - 1, node, matched, self.scan_matching_information)
+        else:
+            self.tracer.count('scan_match_rejected')
+        self.tracer.mark('scan_matching')
+
+        loop_closures = 0
+        positions = self.graph.poses
+        candidates = [
+            candidate
+            for candidate in self.index.query(estimate[0], estimate[1], self.loop_closure_radius, positions)
+            if candidate <= node - self.loop_closure_min_gap
+        ][:self.loop_closure_candidates]  # every attempt rebuilds the matcher's field and searches 1 m around
+        for candidate in candidates:
+            matched = self._match(candidate, cloud, between(positions[candidate], estimate))
+            if matched is not None:
+                self.graph.add_edge(candidate, node, matched, self.scan_matching_information)
+                loop_closures += 1
+        self.tracer.count('loop_closure_attempts', len(candidates))
+        self.tracer.count('loop_closures', loop_closures)
+        self.tracer.mark('loop_closure')
+
+        self.raw_poses.append(raw_pose)
+        self.clouds.append(cloud)
+        self.index.add(node, estimate[0], estimate[1])
+        self.keyframes_since_optimization += 1
+        if loop_closures or self.keyframes_since_optimization >= self.optimize_every:
+            self.optimize()
+            self.tracer.mark('optimization')
+        self.tracer.end()
+
+    def optimize(self):
+        poses, _ = self.graph.optimize()  # readers of get_poses and correct are not blocked meanwhile
+        with self.lock:
+            self.graph.poses[:] = poses
+            self.correction = compose(poses[-1], _inverse(self.raw_poses[-1]))
+        self.index.rebuild(poses[:, :2])
+        self.keyframes_since_optimization = 0
+
+
+def optimize_poses(poses, clouds, **kwargs):
+    """
+    offline run over recorded tracker poses and their (N, 2) car frame clouds, returns the corrected poses;
+    kwargs are PoseGraphOptimizer ones
+    """
+    optimizer = PoseGraphOptimizer(autostart=False, **kwargs)
+    keyframes = []
+    for pose, cloud in zip(poses, clouds):
+        if pose is not None and cloud is not None and len(cloud) > 0 and optimizer.select_keyframe(pose):
+            optimizer.process_keyframe(_to_array(pose), cloud)
+        keyframes.append(optimizer.graph.count - 1)
+    if optimizer.graph.count > 0:
+        optimizer.optimize()
+    corrections = [
+        compose(optimized, _inverse(raw)) for optimized, raw in zip(optimizer.graph.poses, optimizer.raw_poses)
+    ]
+    return [
+        None if pose is None else
+        _to_dict(_to_array(pose)) if keyframe < 0 else
+        _to_dict(compose(corrections[keyframe], _to_array(pose)))
+        for pose, keyframe in zip(poses, keyframes)
+    ]
@@ -0,0 +1,207 @@
+"""
+keyframe submaps: scans taken after the car moved or turned enough are merged, in world coordinates,
+into voxel-downsampled submaps of keyframes_per_submap keyframes; the oldest submaps are evicted
+to .npz files with points quantized relative to the submap origin
+"""
+from collections import OrderedDict
+from math import pi, sqrt
+import os
+import threading
+
+import numpy as np
+
+from ballsbot.lidar import apply_transformation_to_cloud
+
+SUBMAP_QUANTUM = 0.01  # meters, int16 coordinates of evicted submaps reach +-327 m from the origin
+
+
+def voxel_downsample(points, voxel_size, weights=None):
+    """
+    points: (N, 2), returns (centroids (M, 2), weights (M,)) of the points of every voxel,
+    weights are point counts or sums of the given weights
+    """
+    points = np.asarray(points, dtype=np.float64).reshape((-1, 2))
+    if weights is None:
+        weights = np.ones((len(points),), dtype=np.float64)
+    if len(points) == 0:
+        return points, weights
+    cells = np.floor(points / voxel_size).astype(np.int64)
+    keys = (cells[:, 0] << 32) ^ (cells[:, 1] & 0xffffffff)
+    _, inverse = np.unique(keys, return_inverse=True)
+    inverse = inverse.reshape(-1)
+    result_weights = np.bincount(inverse, weights=weights)
+    centroids = np.empty((len(result_weights), 2), dtype=np.float64)
+    centroids[:, 0] = np.bincount(inverse, weights=points[:, 0] * weights) / result_weights
+    centroids[:, 1] = np.bincount(inverse, weights=points[:, 1] * weights) / result_weights
+    return centroids, result_weights
+
+
+def _angle_difference(one, two):
+    result = (one - two) % (2 * pi)
+    return min(result, 2 * pi - result)
+
+
+def moved_enough(pose, last_pose, distance, rotation):
+    """
+    True when there is no last_pose or pose is distance meters or rotation radians away from it
+    """
+    if last_pose is None:
+        return True
+    return (
+            sqrt((pose['x'] - last_pose['x']) ** 2 + (pose['y'] - last_pose['y']) ** 2) >= distance or
+            _angle_difference(pose['teta'], last_pose['teta']) >= rotation
+    )
+
+
+class Submap:
+    def __init__(self, submap_id, voxel_size):
+        self.submap_id = submap_id
+        self.voxel_size = voxel_size
+        self.keyframe_poses = []  # [(x, y, teta), ...]
+        self.points = np.empty((0, 2), dtype=np.float64)
+        self.weights = np.empty((0,), dtype=np.float64)
+        self.finished = False
+
+    def __len__(self):
+        return len(self.points)
+
+    def add(self, pose, world_points):
+        self.keyframe_poses.append((pose['x'], pose['y'], pose['teta']))
+        self.points, self.weights = voxel_downsample(
+            np.concatenate((self.points, world_points)),
+            self.voxel_size,
+            np.concatenate((self.weights, np.ones((len(world_points),), dtype=np.float64))),
+        )
+
+    def bounds(self):
+        """
+        (min x, min y, max x, max y) of points and keyframe poses
+        """
+        poses = np.asarray(self.keyframe_poses, dtype=np.float64).reshape((-1, 3))[:, :2]
+        everything = np.concatenate((self.points, poses))
+        return tuple(everything.min(axis=0)) + tuple(everything.max(axis=0))
+
+    def save(self, file_path):
+        origin = np.asarray(self.keyframe_poses[0][:2], dtype=np.float64)
+        np.savez_compressed(
+            file_path,
+            submap_id=np.int64(self.submap_id),
+            voxel_size=np.float64(self.voxel_size),
+            origin=origin,
+            keyframe_poses=np.asarray(self.keyframe_poses, dtype=np.float64),
+            points=np.round((self.points - origin) / SUBMAP_QUANTUM).astype(np.int16),
+            weights=np.minimum(np.round(self.weights), np.iinfo(np.uint16).max).astype(np.uint16),
+        )
+
+    @classmethod
+    def load(cls, file_path):
+        with np.load(file_path) as data:
+            result = cls(int(data['submap_id']), float(data['voxel_size']))
+            result.keyframe_poses = [tuple(x) for x in data['keyframe_poses'].tolist()]
+            result.points = data['points'].astype(np.float64) * SUBMAP_QUANTUM + data['origin']
+            result.weights = data['weights'].astype(np.float64)
+        result.finished = True
+        return result
+
+
+class SubmapManager:
+    def __init__(self, voxel_size=0.05, keyframe_distance=0.3, keyframe_rotation=pi / 12, keyframes_per_submap=10,
+                 submaps_in_memory=4, storage_dir=None):
+        """
+        storage_dir: evicted submaps are written there as submap_<id>.npz, dropped when None
+        """
+        self.voxel_size = voxel_size
+        self.keyframe_distance = keyframe_distance
+        self.keyframe_rotation = keyframe_rotation
+        self.keyframes_per_submap = keyframes_per_submap
+        self.submaps_in_memory = submaps_in_memory
+        self.storage_dir = storage_dir
+        if storage_dir is not None:
+            os.makedirs(storage_dir, exist_ok=True)
+        self.lock = threading.Lock()  # scans come from the tracker thread, points are read from others
+        self.submaps = OrderedDict()  # submap id: Submap, the oldest first
+        self.evicted = OrderedDict()  # submap id: file path or None
+        self.last_keyframe_pose = None
+        self.next_submap_id = 0
+
+    def is_keyframe(self, pose):
+        return moved_enough(pose, self.last_keyframe_pose, self.keyframe_distance, self.keyframe_rotation)
+
+    def add_scan(self, pose, points):
+        """
+        pose: {'x', 'y', 'teta'}, points: (N, 2) in the car frame
+        returns True when the scan was taken as a keyframe
+        """
+        if not self.is_keyframe(pose):
+            return False
+        self.last_keyframe_pose = {'x': float(pose['x']), 'y': float(pose['y']), 'teta': float(pose['teta'])}
+        world_points = apply_transformation_to_cloud(
+            points, [pose['x'], pose['y'], pose['teta']], columnar=True
+        )
+
+        with self.lock:
+            active = self._get_active()
+            if active is None or active.finished:
+                active = self._start_submap()
+            active.add(self.last_keyframe_pose, world_points)
+            if len(active.keyframe_poses) >= self.keyframes_per_submap:
+                active.finished = True
+                self._start_submap().add(self.last_keyframe_pose, world_points)  # neighbour submaps overlap
+        return True
+
+    def _start_submap(self):
+        submap = Submap(self.next_submap_id, self.voxel_size)
+        self.next_submap_id += 1
+        self.submaps[submap.submap_id] = submap
+        while len(self.submaps) > self.submaps_in_memory:
+            self._evict(next(iter(self.submaps)))
+        return submap
+
+    def _evict(self, submap_id):
+        submap = self.submaps.pop(submap_id)
+        file_path = None
+        if self.storage_dir is not None:
+            file_path = os.path.join(self.storage_dir, 'submap_{}.npz'.format(submap_id))
+            submap.save(file_path)
+        self.evicted[submap_id] = file_path
+
+    def get_active(self):
+        with self.lock:
+            return self._get_active()
+
+    def _get_active(self):
+        if not self.submaps:
+            return None
+        return next(reversed(self.submaps.values()))
+
+    def get_submap(self, submap_id):
+        """
+        a submap in memory or loaded from storage_dir, None when it was dropped
+        """
+        with self.lock:
+            submap = self.submaps.get(submap_id)
+            file_path = self.evicted.get(submap_id)
+        if submap is not None:
+            return submap
+        if file_path is None:
+            return None
+        return Submap.load(file_path)
+
+    def get_points(self, pose=None, radius=None):
+        """
+        (N, 2) world points of the submaps in memory, of those with bounds within radius of pose when given
+        """
+        parts = []
+        with self.lock:
+            for submap in self.submaps.values():
+                if len(submap) == 0:
+                    continue
+                if pose is not None and radius is not None:
+                    min_x, min_y, max_x, max_y = submap.bounds()
+                    if (pose['x'] < min_x - radius or pose['x'] > max_x + radius or
+                            pose['y'] < min_y - radius or pose['y'] > max_y + radius):
+                        continue
+                parts.append(submap.points)
+        if not parts:
+            return np.empty((0, 2), dtype=np.float64)
+        return np.concatenate(parts)
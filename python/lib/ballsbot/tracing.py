@@ -0,0 +1,156 @@
+from math import log2
+from time import perf_counter
+import json
+
+
+class LatencyHistogram:
+    """
+    fixed-memory log-scale histogram of durations in seconds, 8 buckets per octave from 1 us to ~16 s
+    """
+    MIN_VALUE = 1e-6
+    BUCKETS_PER_OCTAVE = 8
+    BUCKETS_COUNT = 24 * BUCKETS_PER_OCTAVE
+
+    def __init__(self):
+        self.counts = [0] * self.BUCKETS_COUNT
+        self.count = 0
+        self.total = 0.
+        self.max_value = 0.
+
+    def add(self, value):
+        if value > self.MIN_VALUE:
+            index = int(log2(value / self.MIN_VALUE) * self.BUCKETS_PER_OCTAVE)
+            if index >= self.BUCKETS_COUNT:
+                index = self.BUCKETS_COUNT - 1
+        else:
+            index = 0
+        self.counts[index] += 1
+        self.count += 1
+        self.total += value
+        if value > self.max_value:
+            self.max_value = value
+
+    def merge(self, other):
+        for index, bucket_count in enumerate(other.counts):
+            self.counts[index] += bucket_count
+        self.count += other.count
+        self.total += other.total
+        self.max_value = max(self.max_value, other.max_value)
+
+    def bucket_upper_bound(self, index):
+        return self.MIN_VALUE * 2 ** ((index + 1) / self.BUCKETS_PER_OCTAVE)
+
+    def percentile(self, q):
+        """
+        q in [0, 100], returns the upper bound of the bucket holding the q-th percentile, None when empty
+        """
+        if self.count == 0:
+            return None
+        rank = q / 100. * self.count
+        seen = 0
+        for index, bucket_count in enumerate(self.counts):
+            seen += bucket_count
+            if bucket_count and seen >= rank:
+                return min(self.bucket_upper_bound(index), self.max_value)
+        return self.max_value
+
+    def to_dict(self):
+        def to_ms(value):
+            return None if value is None else value * 1000.
+
+        return {
+            'count': self.count,
+            'mean_ms': to_ms(self.total / self.count) if self.count else None,
+            'p50_ms': to_ms(self.percentile(50)),
+            'p95_ms': to_ms(self.percentile(95)),
+            'p99_ms': to_ms(self.percentile(99)),
+            'max_ms': to_ms(self.max_value) if self.count else None,
+        }
+
+
+class Tracer:
+    """
+    per-stage latencies of a loop: begin() at the start of a tick, mark(stage) after each stage
+    """
+
+    def __init__(self, name, enabled=True):
+        self.name = name
+        self.enabled = enabled
+        self.histograms = {}
+        self.counters = {}
+        self.tick_start = None
+        self.last_mark = None
+
+    def begin(self):
+        if self.enabled:
+            self.tick_start = self.last_mark = perf_counter()
+
+    def mark(self, stage):
+        """
+        records the time since the previous mark (or begin) of the current tick
+        """
+        if not self.enabled or self.last_mark is None:
+            return
+        now = perf_counter()
+        self.record(stage, now - self.last_mark)
+        self.last_mark = now
+
+    def end(self, stage='tick'):
+        """
+        records the whole tick duration
+        """
+        if not self.enabled or self.tick_start is None:
+            return
+        self.record(stage, perf_counter() - self.tick_start)
+        self.tick_start = self.last_mark = None
+
+    def record(self, stage, value):
+        histogram = self.histograms.get(stage)
+        if histogram is None:
+            histogram = self.histograms[stage] = LatencyHistogram()
+        histogram.add(value)
+
+    def merge(self, other):
+        """
+        adds histograms and counters of another tracer, e.g. one returned by a worker process
+        """
+        for stage, histogram in other.histograms.items():
+            if stage not in self.histograms:
+                self.histograms[stage] = LatencyHistogram()
+            self.histograms[stage].merge(histogram)
+        for name, value in other.counters.items():
+            self.count(name, value)
+
+    def count(self, name, value=1):
+        self.counters[name] = self.counters.get(name, 0) + value
+
+    def reset(self):
+        self.histograms = {}
+        self.counters = {}
+
+    def to_dict(self):
+        return {
+            'stages': {k: v.to_dict() for k, v in self.histograms.items()},
+            'counters': dict(self.counters),
+        }
+
+
+_tracers = {}
+
+
+def get_tracer(name):
+    tracer = _tracers.get(name)
+    if tracer is None:
+        tracer = _tracers[name] = Tracer(name)
+    return tracer
+
+
+def dump_tracers(file_path=None):
+    """
+    returns {tracer name: {'stages': ..., 'counters': ...}}, writes it as json when file_path is given
+    """
+    result = {k: v.to_dict() for k, v in _tracers.items()}
+    if file_path is not None:
+        with open(file_path, 'w') as a_file:
+            a_file.write(json.dumps(result))
+    return result
@@ -0,0 +1,300 @@
+"""
+append-only chunked binary track log
+
+file: FILE_HEADER, then chunks of CHUNK_HEADER + payload (optionally zlib-compressed)
+payload of a chunk with K frames: K RECORD_DTYPE records, then float32 ranges and float32 angles
+of all the frames' points, each frame taking its records' points_count values
+"""
+from math import isnan
+from time import time
+import mmap
+import queue
+import struct
+import threading
+import zlib
+
+import numpy as np
+
+from ballsbot.lidar import LidarScan
+
+FILE_MAGIC = b'BBTRACK\x00'
+FILE_VERSION = 1
+FILE_HEADER = struct.Struct('<8sI')
+CHUNK_MAGIC = b'CHNK'
+CHUNK_HEADER = struct.Struct('<4sIIIIdd')  # magic, flags, frames count, raw size, stored size, first ts, last ts
+CHUNK_COMPRESSED = 1
+
+WEIGHT_KEYS = (
+    (0., 1.), (1., 1.), (-1., 1.), (0.5, 1.), (-0.5, 1.),
+    (0., -1.), (1., -1.), (-1., -1.), (0.5, -1.), (-0.5, -1.),
+)
+RECORD_DTYPE = np.dtype([
+    ('ts', '<f8'),
+    ('x', '<f8'),
+    ('y', '<f8'),
+    ('teta', '<f8'),
+    ('speed', '<f8'),
+    ('direction', '<f8'),
+    ('flags', '<u4'),
+    ('points_count', '<u4'),
+    ('weights', '<f4', (len(WEIGHT_KEYS),)),
+])
+HAS_POSE = 1
+HAS_SPEED = 2
+HAS_DIRECTION = 4
+HAS_WEIGHTS = 8
+HAS_POINTS = 16
+
+
+def _points_to_columns(points):
+    if isinstance(points, LidarScan):
+        return points.ranges.astype(np.float32, copy=False), points.angles.astype(np.float32, copy=False)
+    ranges = np.fromiter((x['distance'] for x in points), dtype=np.float32, count=len(points))
+    angles = np.fromiter((x['angle'] for x in points), dtype=np.float32, count=len(points))
+    return ranges, angles
+
+
+def encode_chunk(frames, compress=False):
+    """
+    frames: [{'ts', 'pose', 'speed', 'direction', 'weights', 'points'}, ...], missing or None fields are allowed
+    returns chunk bytes
+    """
+    records = np.zeros((len(frames),), dtype=RECORD_DTYPE)
+    ranges = []
+    angles = []
+    for i, frame in enumerate(frames):
+        record = records[i]
+        flags = 0
+        record['ts'] = frame.get('ts') or 0.
+        pose = frame.get('pose')
+        if pose is not None:
+            flags |= HAS_POSE
+            record['x'] = pose['x']
+            record['y'] = pose['y']
+            record['teta'] = pose['teta']
+        if frame.get('speed') is not None:
+            flags |= HAS_SPEED
+            record['speed'] = frame['speed']
+        if frame.get('direction') is not None:
+            flags |= HAS_DIRECTION
+            record['direction'] = frame['direction']
+        weights = frame.get('weights')
+        if weights is not None:
+            flags |= HAS_WEIGHTS
+            record['weights'] = [weights.get(k, np.nan) for k in WEIGHT_KEYS]
+        points = frame.get('points')
+        if points is not None:
+            flags |= HAS_POINTS
+            frame_ranges, frame_angles = _points_to_columns(points)
+            record['points_count'] = len(frame_ranges)
+            ranges.append(frame_ranges)
+            angles.append(frame_angles)
+        record['flags'] = flags
+
+    parts = [records.tobytes()]
+    if ranges:
+        parts.append(np.concatenate(ranges).tobytes())
+        parts.append(np.concatenate(angles).tobytes())
+    payload = b''.join(parts)
+    raw_size = len(payload)
+    flags = 0
+    if compress:
+        payload = zlib.compress(payload, 1)
+        flags |= CHUNK_COMPRESSED
+    first_ts = float(records['ts'][0]) if len(records) else 0.
+    last_ts = float(records['ts'][-1]) if len(records) else 0.
+    header = CHUNK_HEADER.pack(CHUNK_MAGIC, flags, len(frames), raw_size, len(payload), first_ts, last_ts)
+    return header + payload
+
+
+class TrackWriter:
+    """
+    streams frames to a track log: append() only queues, a background thread encodes and writes chunks
+    """
+
+    def __init__(self, file_path, chunk_frames=32, compress=False, max_queued=1024):
+        self.file_path = file_path
+        self.chunk_frames = chunk_frames
+        self.compress = compress
+        self.frames = queue.Queue(maxsize=max_queued)
+        self.dropped = 0
+        self.a_file = open(file_path, 'wb')
+        self.a_file.write(FILE_HEADER.pack(FILE_MAGIC, FILE_VERSION))
+        self.thread = threading.Thread(target=self._write_loop, daemon=True)
+        self.thread.start()
+
+    def append(self, frame):
+        """
+        frame: {'pose', 'speed', 'direction', 'weights', 'points' (LidarScan or radial points)},
+        'ts' is set to now if missing; never blocks, frames are dropped (and counted) when the writer lags
+        """
+        if frame.get('ts') is None:
+            frame = dict(frame, ts=time())
+        try:
+            self.frames.put_nowait(frame)
+        except queue.Full:
+            self.dropped += 1
+
+    def close(self):
+        self.frames.put(None)
+        self.thread.join()
+        self.a_file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        self.close()
+
+    def _write_loop(self):
+        pending = []
+        while True:
+            frame = self.frames.get()
+            if frame is not None:
+                pending.append(frame)
+            if pending and (frame is None or len(pending) >= self.chunk_frames):
+                self.a_file.write(encode_chunk(pending, self.compress))
+                self.a_file.flush()
+                pending = []
+            if frame is None:
+                break
+
+
+def is_track_log(file_path):
+    with open(file_path, 'rb') as a_file:
+        return a_file.read(len(FILE_MAGIC)) == FILE_MAGIC
+
+
+def convert_track_info(track_info, file_path, compress=False):
+    """
+    writes Explorer.track_info frames (e.g. loaded from a json recording) as a track log
+    """
+    with open(file_path, 'wb') as a_file:
+        a_file.write(FILE_HEADER.pack(FILE_MAGIC, FILE_VERSION))
+        chunk_frames = 32
+        for i in range(0, len(track_info), chunk_frames):
+            a_file.write(encode_chunk(track_info[i:i + chunk_frames], compress))
+
+
+class TrackReader:
+    """
+    memory-mapped track log reader, frames are decoded on access
+    """
+
+    def __init__(self, file_path):
+        self.a_file = open(file_path, 'rb')
+        self.mm = mmap.mmap(self.a_file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version = FILE_HEADER.unpack_from(self.mm, 0)
+        if magic != FILE_MAGIC or version != FILE_VERSION:
+            raise ValueError('{} is not a track log'.format(file_path))
+        self.chunks = self._read_chunks_index()
+        self.chunk_first_frames = np.cumsum([0] + [x['frames_count'] for x in self.chunks])
+        self.chunk_last_ts = np.array([x['last_ts'] for x in self.chunks], dtype=np.float64)
+        self._decoded_chunk = (None, None)
+
+    def _read_chunks_index(self):
+        """
+        returns [{'offset', 'flags', 'frames_count', 'raw_size', 'stored_size', 'first_ts', 'last_ts'}, ...],
+        a truncated last chunk (the writer was killed) is ignored
+        """
+        chunks = []
+        offset = FILE_HEADER.size
+        while offset + CHUNK_HEADER.size <= len(self.mm):
+            magic, flags, frames_count, raw_size, stored_size, first_ts, last_ts = \
+                CHUNK_HEADER.unpack_from(self.mm, offset)
+            payload_offset = offset + CHUNK_HEADER.size
+            if magic != CHUNK_MAGIC or payload_offset + stored_size > len(self.mm):
+                break
+            chunks.append({
+                'offset': payload_offset,
+                'flags': flags,
+                'frames_count': frames_count,
+                'raw_size': raw_size,
+                'stored_size': stored_size,
+                'first_ts': first_ts,
+                'last_ts': last_ts,
+            })
+            offset = payload_offset + stored_size
+        return chunks
+
+    def __len__(self):
+        return int(self.chunk_first_frames[-1])
+
+    def close(self):
+        self._decoded_chunk = (None, None)  # views of the mmap
+        self.mm.close()
+        self.a_file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        self.close()
+
+    def _decode_chunk(self, chunk_number):
+        """
+        returns (records, ranges, angles, points offsets), uncompressed chunks are not copied
+        """
+        if self._decoded_chunk[0] == chunk_number:
+            return self._decoded_chunk[1]
+        chunk = self.chunks[chunk_number]
+        payload = memoryview(self.mm)[chunk['offset']:chunk['offset'] + chunk['stored_size']]
+        if chunk['flags'] & CHUNK_COMPRESSED:
+            payload = zlib.decompress(payload)
+        records = np.frombuffer(payload, dtype=RECORD_DTYPE, count=chunk['frames_count'])
+        points_total = int(records['points_count'].sum())
+        points_offset = records.nbytes
+        ranges = np.frombuffer(payload, dtype=np.float32, count=points_total, offset=points_offset)
+        angles = np.frombuffer(payload, dtype=np.float32, count=points_total, offset=points_offset + 4 * points_total)
+        points_offsets = np.concatenate(([0], np.cumsum(records['points_count'])))
+        decoded = (records, ranges, angles, points_offsets)
+        self._decoded_chunk = (chunk_number, decoded)
+        return decoded
+
+    def find_frame(self, ts):
+        """
+        returns the number of the first frame recorded at or after ts, len(self) when there is none
+        """
+        chunk_number = int(np.searchsorted(self.chunk_last_ts, ts, side='left'))
+        if chunk_number == len(self.chunks):
+            return len(self)
+        records = self._decode_chunk(chunk_number)[0]
+        return int(self.chunk_first_frames[chunk_number]) + int(np.searchsorted(records['ts'], ts, side='left'))
+
+    def get_frame(self, frame_number, columnar=True):
+        """
+        returns {'ts', 'pose', 'speed', 'direction', 'weights', 'points'} like Explorer.track_info items,
+        points as LidarScan when columnar, else radial points; frames do not refer to the mmap,
+        so they stay valid after close()
+        """
+        if frame_number < 0:
+            frame_number += len(self)
+        if not 0 <= frame_number < len(self):
+            raise IndexError(frame_number)
+        chunk_number = int(np.searchsorted(self.chunk_first_frames, frame_number, side='right')) - 1
+        records, ranges, angles, points_offsets = self._decode_chunk(chunk_number)
+        index = frame_number - int(self.chunk_first_frames[chunk_number])
+        record = records[index]
+        flags = int(record['flags'])
+
+        result = {
+            'ts': float(record['ts']),
+            'pose': None,
+            'speed': float(record['speed']) if flags & HAS_SPEED else None,
+            'direction': float(record['direction']) if flags & HAS_DIRECTION else None,
+            'weights': None,
+            'points': None,
+        }
+        if flags & HAS_POSE:
+            result['pose'] = {'x': float(record['x']), 'y': float(record['y']), 'teta': float(record['teta'])}
+        if flags & HAS_WEIGHTS:
+            result['weights'] = {
+                k: v for k, v in zip(WEIGHT_KEYS, record['weights'].tolist()) if not isnan(v)
+            }
+        if flags & HAS_POINTS:
+            begin, end = int(points_offsets[index]), int(points_offsets[index + 1])
+            scan = LidarScan(
+                ranges[begin:end].copy(), angles[begin:end].copy(), np.ones((end - begin,), dtype=np.float32)
+            )
+            result['points'] = scan if columnar else scan.to_radial_points()
+        return result
@@ -1,20 +1,123 @@
-from math import pi, ceil
+from collections import deque
+from math import pi, ceil, cos, sin
 import sys
 import json
 
+import numpy as np
+
 from ballsbot.utils import keep_rps
-# from ballsbot.ndt import NDT
+from ballsbot.tracing import get_tracer
 import ballsbot.drawing as drawing
 from ballsbot.lidar import apply_transformation_to_cloud
+from ballsbot.submaps import SubmapManager
+from ballsbot_cpp import ballsbot_cpp
+
+
+POSE_DTYPE = np.dtype([
+    ('ts', '<f8'),
+    ('x', '<f8'),
+    ('y', '<f8'),
+    ('teta', '<f8'),
+])
+
+
+class PoseRing:
+    """
+    preallocated ring of POSE_DTYPE records, a record is written before the counter makes it visible
+    """
+
+    def __init__(self, size):
+        self.records = np.zeros((size,), dtype=POSE_DTYPE)
+        self.count = 0
+
+    def append(self, ts, x, y, teta):
+        self.records[self.count % len(self.records)] = (ts, x, y, teta)
+        self.count += 1
+
+    def __len__(self):
+        return min(self.count, len(self.records))
+
+    def view(self):
+        """
+        kept records without copying, not in time order once the ring has wrapped
+        """
+        return self.records[:len(self)]
+
+    def latest(self):
+        count = self.count
+        if count == 0:
+            return None
+        return self.records[(count - 1) % len(self.records)]
+
+    def ordered(self):
+        """
+        a copy of kept records, the oldest first
+        """
+        count = self.count
+        if count <= len(self.records):
+            return self.records[:count].copy()
+        start = count % len(self.records)
+        return np.concatenate((self.records[start:], self.records[:start]))
+
+
+class PoseHistory:
+    """
+    recent poses, every long_term_every-th pose for a longer history, and scans attached to the last poses
+    """
+
+    def __init__(self, size=4096, long_term_every=20, long_term_size=4 * 3600, scans_size=64):
+        self.recent = PoseRing(size)
+        self.long_term_every = long_term_every
+        self.long_term = PoseRing(long_term_size) if long_term_every else None
+        self.scans = deque(maxlen=scans_size)  # (pose number, points)
+
+    def __len__(self):
+        return self.recent.count
+
+    def append(self, ts, x, y, teta):
+        if self.long_term is not None and self.recent.count % self.long_term_every == 0:
+            self.long_term.append(ts, x, y, teta)
+        self.recent.append(ts, x, y, teta)
+
+    def attach_scan(self, points):
+        self.scans.append((self.recent.count - 1, points))
+
+    def get_scan(self, pose_number):
+        for number, points in self.scans:
+            if number == pose_number:
+                return points
+        return None
+
+    def latest(self):
+        return self.recent.latest()
+
+    def to_list(self):
+        """
+        [{'ts', 'x', 'y', 'teta'}, ...] of long-term poses older than the recent ones, then the recent ones
+        """
+        recent = self.recent.ordered()
+        parts = [recent]
+        if self.long_term is not None and len(recent):
+            long_term = self.long_term.ordered()
+            parts.insert(0, long_term[long_term['ts'] < recent['ts'][0]])
+        return [
+            {'ts': float(ts), 'x': float(x), 'y': float(y), 'teta': float(teta)}
+            for ts, x, y, teta in np.concatenate(parts).tolist()
+        ]
 
 
 class TrackerLight:
-    def __init__(self, imu, odometry, fps=20):
+    def __init__(self, imu, odometry, fps=20, track_writer=None, history=None):
+        """
+        track_writer: optional ballsbot.track_log.TrackWriter, every new pose is streamed to it
+        history: optional PoseHistory, default one keeps ~3.5 min of 20 fps poses and 4 hours of a pose per second
+        """
         self.imu = imu
         self.odometry = odometry
         self.fps = fps
-        self.poses = []
+        self.poses = PoseHistory() if history is None else history
         self.errors = []
+        self.track_writer = track_writer
 
     def start(self):
         previous = None
@@ -25,11 +128,8 @@ class TrackerLight:
             current = self._get_current()
 
             if previous is None:
-                self.poses.append({
-                    'x': current['odometry_dx'],
-                    'y': current['odometry_dy'],
-                    'teta': current['teta'],
-                })
+                self.poses.append(current['ts'], current['odometry_dx'], current['odometry_dy'], current['teta'])
+                self._upgrade_current(current)
             else:
                 dt = current['ts'] - previous['ts']
                 if dt == 0.:
@@ -48,15 +148,12 @@ class TrackerLight:
                     print('_get_transformation failed with {}'.format(e), file=sys.stderr)
                     raise
 
-                prev_pose = self.poses[-1]
-                self.poses.append({
-                    'ts': current['ts'],
-                    'x': prev_pose['x'] + dx,
-                    'y': prev_pose['y'] + dy,
-                    'teta': teta,
-                })
+                prev_pose = self.poses.latest()
+                self.poses.append(current['ts'], prev_pose['x'] + dx, prev_pose['y'] + dy, teta)
                 self._upgrade_current(current)
 
+            if self.track_writer is not None:
+                self.track_writer.append({'ts': current['ts'], 'pose': self.get_current_pose()})
             previous = current
 
     def _get_current(self):
@@ -76,86 +173,168 @@ class TrackerLight:
         raw_result = (dx_raw, dy_raw, current['teta'])
         return raw_result
 
+    def _draw_poses(self, image, lidar_points, self_position, only_nearby_meters, tail_points=None):
+        long_term = self.poses.long_term
+        drawing.update_image_abs_coords(
+            image, self.poses.recent.view(), lidar_points, self_position, only_nearby_meters,
+            tail_points=tail_points, pose=self.poses.latest(),
+            history_poses=None if long_term is None else long_term.view(),
+        )
+
     def update_picture(self, image, only_nearby_meters=10):
-        drawing.update_image_abs_coords(image, self.poses, [], None, only_nearby_meters)
+        self._draw_poses(image, [], None, only_nearby_meters)
 
     def poses_to_a_file(self, file_path):
         with open(file_path, 'w') as a_file:
-            a_file.write(json.dumps(self.poses))
+            a_file.write(json.dumps(self.poses.to_list()))
 
     def get_current_pose(self):
-        return self.poses[-1]
+        """
+        {'x', 'y', 'teta'} of the latest pose, None before the first one
+        """
+        pose = self.poses.latest()
+        if pose is None:
+            return None
+        return {'x': float(pose['x']), 'y': float(pose['y']), 'teta': float(pose['teta'])}
 
 
 class Tracker(TrackerLight):
-    def __init__(self, imu, lidar, odometry, fps=2, max_distance=15., fix_pose_with_lidar=False, keep_readings=False):
+    MIN_MATCH_SCORE = 0.5
+
+    def __init__(self, imu, lidar, odometry, fps=2, max_distance=15., fix_pose_with_lidar=False, keep_readings=False,
+                 local_map_scans=3, scan_matcher=None, submaps=None, pose_graph=None):
+        """
+        fix_pose_with_lidar: correct odometry by matching every scan to a local map of the last
+            local_map_scans to 2 * local_map_scans - 1 scans
+        keep_readings: merge keyframe scans into submaps, the nearby ones are drawn and extend the local map
+        scan_matcher: optional ballsbot_cpp.ScanMatcher, a default one searches 0.3 m and 0.2 rad around odometry
+        submaps: optional ballsbot.submaps.SubmapManager used with keep_readings
+        pose_graph: optional ballsbot.posegraph.PoseGraphOptimizer fed with poses and scans
+        """
         super().__init__(imu, odometry, fps)
         self.lidar = lidar
         self.max_distance = max_distance
-        if fix_pose_with_lidar:
-            raise NotImplementedError()
         self.fix_pose_with_lidar = fix_pose_with_lidar
-        # self.ndt = NDT(grid_size=8., box_size=1., iterations_count=20, optim_step=(0.05, 0.05, 0.01), eps=0.01)
+        if fix_pose_with_lidar and scan_matcher is None:
+            scan_matcher = ballsbot_cpp.ScanMatcher()
+        self.scan_matcher = scan_matcher
+        self.local_map = deque(maxlen=local_map_scans)  # scans of the last poses in world coordinates
+        self.scans_since_map_reset = 0
         self.keep_readings = keep_readings
+        if keep_readings and submaps is None:
+            submaps = SubmapManager()
+        self.submaps = submaps
+        self.pose_graph = pose_graph
+        self.tracer = get_tracer('tracker')
 
     def _get_current(self):
         result = super(Tracker, self)._get_current()
-        result['points'] = self.lidar.get_lidar_points()
+        result['points'] = self.lidar.get_lidar_points(columnar=True)
         result['ts'] = self.lidar.points_ts
         return result
 
     def _upgrade_current(self, current):
-        self.poses[-1]['points'] = current['points']
+        self.poses.attach_scan(current['points'])
+        if self.keep_readings:
+            self.submaps.add_scan(self.poses.latest(), current['points'])
+        if self.pose_graph is not None:
+            self.pose_graph.add_scan(self.poses.latest(), current['points'])
+        if self.fix_pose_with_lidar:
+            self._update_local_map(current['points'])
+
+    def _update_local_map(self, points):
+        """
+        the matcher's likelihood field grows scan by scan and is rebuilt from the last local_map_scans scans
+        (and the nearby submaps with keep_readings) when as many were added since the previous rebuild
+        """
+        pose = self.poses.latest()
+        world_points = apply_transformation_to_cloud(points, [pose['x'], pose['y'], pose['teta']], columnar=True)
+        self.local_map.append(world_points)
+        if self.scans_since_map_reset >= self.local_map.maxlen:
+            reference = list(self.local_map)
+            if self.keep_readings:
+                reference.append(self.submaps.get_points(pose, self.max_distance))
+            self.scan_matcher.set_reference(np.concatenate(reference))
+            self.scans_since_map_reset = 1
+        else:
+            self.scan_matcher.add_to_reference(world_points)
+            self.scans_since_map_reset += 1
+
+    def _match_scan(self, current, initial_guess):
+        """
+        returns (dx, dy, dteta, converged, score) moving the current scan, turned to world orientation,
+        from the previous pose onto the local map
+        """
+        prev_pose = self.poses.latest()
+        cloud = apply_transformation_to_cloud(current['points'], [0., 0., prev_pose['teta']], columnar=True)
+        dx, dy, dteta = initial_guess
+        x, y, dteta, converged, score = self.scan_matcher.match(
+            cloud, [prev_pose['x'] + dx, prev_pose['y'] + dy, dteta]
+        )
+        return x - prev_pose['x'], y - prev_pose['y'], dteta, converged, score
+
+    @staticmethod
+    def _normalize_teta(teta):
+        if teta >= 2 * pi:
+            teta -= 2 * pi
+        elif teta <= -2 * pi:
+            teta += 2 * pi
+        return teta
 
     def _get_transformation(self, dt, current, previous):
         raw_result = super(Tracker, self)._get_transformation(dt, current, previous)
         if not self.fix_pose_with_lidar:
             return raw_result
 
-        # dteta_raw = current['teta'] - previous['teta']
-        # dx_raw = current['odometry_dx']
-        # dy_raw = current['odometry_dy']
-        #
-        # dx, dy, dteta, converged, score = self.ndt.get_optimal_transformation(
-        #     previous['points'],
-        #     current['points'],
-        #     start_point=[dx_raw, dy_raw, dteta_raw]
-        # )
-        #
-        # if converged != 1.:
-        #     return raw_result
-        #
-        # if score > 0.5:
-        #     return raw_result
-        #
-        # steps = ceil(dt / self.fps)
-        #
-        # max_dteta = steps * pi / 8
-        # if max_dteta > 2 * pi:
-        #     max_dteta = 2 * pi
-        # if abs(dteta - dteta_raw) > max_dteta:
-        #     return raw_result
-        #
-        # prev_pose = self.poses[-1]
-        # max_dxy = dt * 0.2  # m/s
-        # if abs(dx_raw - dx) > max_dxy or abs(prev_pose['x'] + dx) > self.max_distance:
-        #     return raw_result
-        # if abs(dy_raw - dy) > max_dxy or abs(prev_pose['y'] + dy) > self.max_distance:
-        #     return raw_result
-        #
-        # teta = prev_pose['teta'] + dteta
-        # if teta >= 2 * pi:
-        #     teta -= 2 * pi
-        # elif teta <= -2 * pi:
-        #     teta += 2 * pi
-        #
-        # return dx, dy, teta
+        # the imu heading drifts away from the corrected one, odometry moves along the imu heading
+        prev_pose = self.poses.latest()
+        heading_offset = prev_pose['teta'] - previous['teta']
+        cos_offset, sin_offset = cos(heading_offset), sin(heading_offset)
+        dteta_raw = current['teta'] - previous['teta']
+        dx_raw = current['odometry_dx'] * cos_offset - current['odometry_dy'] * sin_offset
+        dy_raw = current['odometry_dx'] * sin_offset + current['odometry_dy'] * cos_offset
+        odometry_result = (dx_raw, dy_raw, self._normalize_teta(prev_pose['teta'] + dteta_raw))
+
+        self.tracer.begin()
+        dx, dy, dteta, converged, score = self._match_scan(current, [dx_raw, dy_raw, dteta_raw])
+        self.tracer.mark('scan_matching')
+
+        if not converged:
+            self.tracer.count('scan_match_not_converged')
+            return odometry_result
+
+        if score < self.MIN_MATCH_SCORE:
+            self.tracer.count('scan_match_low_score')
+            return odometry_result
+
+        steps = ceil(dt * self.fps)
+
+        max_dteta = steps * pi / 8
+        if max_dteta > 2 * pi:
+            max_dteta = 2 * pi
+        if abs(dteta - dteta_raw) > max_dteta:
+            self.tracer.count('scan_match_rejected')
+            return odometry_result
+
+        max_dxy = dt * 0.2  # m/s
+        if abs(dx_raw - dx) > max_dxy or abs(prev_pose['x'] + dx) > self.max_distance:
+            self.tracer.count('scan_match_rejected')
+            return odometry_result
+        if abs(dy_raw - dy) > max_dxy or abs(prev_pose['y'] + dy) > self.max_distance:
+            self.tracer.count('scan_match_rejected')
+            return odometry_result
+
+        return dx, dy, self._normalize_teta(prev_pose['teta'] + dteta)
 
     def update_picture(self, image, only_nearby_meters=10):
-        pose = self.poses[-1]
+        pose = self.poses.latest()
         points = apply_transformation_to_cloud(
-            self.lidar.get_lidar_points(),
-            [pose['x'], pose['y'], pose['teta']]
+            self.lidar.get_lidar_points(columnar=True),
+            [pose['x'], pose['y'], pose['teta']],
+            columnar=True
         )
         self_position = self.lidar.calibration_to_xywh(self.lidar.calibration)
-        drawing.update_image_abs_coords(image, self.poses, points, self_position, only_nearby_meters)
+        tail_points = None
+        if self.keep_readings:
+            tail_points = self.submaps.get_points(pose, only_nearby_meters)
+        self._draw_poses(image, points, self_position, only_nearby_meters, tail_points)
@@ -3,8 +3,8 @@ import threading
 import atexit
 import cv2
 
+from ballsbot.tracing import get_tracer
 
-# import inspect
 
 class PropagatingThread(threading.Thread):
     def run(self):
@@ -23,15 +23,20 @@ class PropagatingThread(threading.Thread):
             raise self.exc
 
 
-def keep_rps(ts, fps=1.):
+def keep_rps(ts, fps=1., tracer=None):
+    """
+    overruns (no time left to sleep) are counted by the tracer, the shared 'keep_rps' one by default
+    """
     new_ts = time()
     if ts is not None:
         to_sleep = ts - new_ts + 1. / fps
         if to_sleep > 0:
-            # print('{} slipping for {:0.03f}'.format(inspect.stack()[1][3], to_sleep))
             sleep(to_sleep)
-        # else:
-        #     print('{} no slipping ({} - {} + {} = {} < 0)'.format(inspect.stack()[1][3], ts, new_ts, 1./fps, to_sleep))
+        else:
+            if tracer is None:
+                tracer = get_tracer('keep_rps')
+            tracer.count('keep_rps_overruns')
+            tracer.record('keep_rps_overrun', -to_sleep)
     return new_ts
 
 
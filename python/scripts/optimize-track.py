@@ -0,0 +1,69 @@
+"""
+offline pose graph optimization of a recorded session: prints loop closures and pose corrections,
+optionally writes the corrected poses
+
+python optimize-track.py ../tracks/session.bbt --output session-poses.json
+"""
+import argparse
+import json
+from math import hypot
+import os
+import sys
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'lib'))
+
+from ballsbot.ai.explorer_mock import LidarMock
+from ballsbot.ai.replay import open_track, StopReplay
+from ballsbot.posegraph import optimize_poses
+from ballsbot.tracing import get_tracer
+
+
+def read_track(file_path):
+    """
+    returns recorded poses and (N, 2) car frame clouds, None for frames without them
+    """
+    _, make_feed = open_track(file_path)
+    poses, clouds = [], []
+    with make_feed() as feed:
+        lidar = LidarMock(feed)
+        try:
+            while True:
+                frame = feed.get_current_frame()
+                poses.append(frame['pose'])
+                clouds.append(None if frame['points'] is None else lidar.get_lidar_points(columnar=True))
+                feed.next_frame()
+        except StopReplay:
+            pass
+    return poses, clouds
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('track', help='a track log or an Explorer.track_info json file')
+    parser.add_argument('--loop-closure-radius', type=float, default=2., help='meters')
+    parser.add_argument('--loop-closure-min-gap', type=int, default=30, help='keyframes')
+    parser.add_argument('--output', help='write the corrected poses to this json')
+    args = parser.parse_args()
+
+    poses, clouds = read_track(args.track)
+    corrected = optimize_poses(poses, clouds, loop_closure_radius=args.loop_closure_radius,
+                               loop_closure_min_gap=args.loop_closure_min_gap)
+    corrections = [
+        hypot(a['x'] - b['x'], a['y'] - b['y']) for a, b in zip(poses, corrected) if a is not None
+    ]
+    stats = get_tracer('pose_graph').to_dict()
+    print('{} frames, {} loop closures, pose corrections up to {:.3f} m'.format(
+        len(poses), stats['counters'].get('loop_closures', 0), max(corrections, default=0.)
+    ))
+    for stage, stage_stats in stats['stages'].items():
+        print('  {:<20} n={:<8} p50 {:8.3f} ms  p95 {:8.3f} ms'.format(
+            stage, stage_stats['count'], stage_stats['p50_ms'], stage_stats['p95_ms']
+        ))
+
+    if args.output is not None:
+        with open(args.output, 'w') as hf:
+            hf.write(json.dumps(corrected))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,35 +1,63 @@
+"""
+replays saved Explorer.track_info files through the mocked bot and reports per-stage latencies,
+native vs python time and regressions against a baseline
+
+python profile-explorer.py ../track_info_01.json --save-baseline baseline.json
+python profile-explorer.py ../track_info_01.json --baseline baseline.json
+"""
+import argparse
 import json
+import os
 import sys
 
-sys.path.append('/home/jumper/projects/ballsbot/lib')
-
-from ballsbot.ai.explorer_mock import get_mocked_bot, TrackFeedBase
-
-
-class StopException(Exception):
-    pass
-
-
-class TrackFeed(TrackFeedBase):
-    def __init__(self, file_path):
-        with open(file_path, 'r') as hf:
-            self.track_info = json.loads(hf.read())
-        self.frame_number = 0
-
-    def get_current_frame(self):
-        return self.track_info[self.frame_number]
-
-    def next_frame(self):
-        self.frame_number += 1
-        if self.frame_number == len(self.track_info):
-            raise StopException()
-
-
-for _ in range(3):
-    feed = TrackFeed('../track_info_01.json')
-    bot = get_mocked_bot(feed)
-
-    try:
-        bot.run()
-    except StopException:
-        pass
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'lib'))
+
+from ballsbot.ai.replay import benchmark, compare_with_baseline
+
+
+def print_report(result):
+    for track_path, track_result in result.items():
+        print('{} ({} frames, decisions {})'.format(
+            track_path, track_result['frames'], track_result['decisions'] or 'NOT DETERMINISTIC'
+        ))
+        for stage, stats in track_result['stages'].items():
+            print('  {:<20} n={:<6} p50 {:8.3f} ms  p95 {:8.3f} ms  p99 {:8.3f} ms'.format(
+                stage, stats['count'], stats['p50_ms'], stats['p95_ms'], stats['p99_ms']
+            ))
+        functions = track_result.get('functions')
+        if functions is not None:
+            for side in ('native', 'python'):
+                print('  {} {:.3f} s'.format(side, functions[side]['total_s']))
+                for it in functions[side]['functions'][:5]:
+                    print('    {:8.4f} s {:>8} calls  {}'.format(it['own_s'], it['calls'], it['function']))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('tracks', nargs='+', help='track logs or Explorer.track_info json files')
+    parser.add_argument('--repeats', type=int, default=3)
+    parser.add_argument('--no-profile', action='store_true', help='skip the cProfile replay')
+    parser.add_argument('--baseline', help='compare with this benchmark json')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='allowed slowdown, 0.2 is 20%%')
+    parser.add_argument('--save-baseline', help='write the results to this json')
+    args = parser.parse_args()
+
+    result = benchmark(args.tracks, repeats=args.repeats, profile=not args.no_profile)
+    print_report(result)
+
+    if args.save_baseline is not None:
+        with open(args.save_baseline, 'w') as hf:
+            hf.write(json.dumps(result, indent=1))
+
+    if args.baseline is not None:
+        with open(args.baseline, 'r') as hf:
+            baseline = json.loads(hf.read())
+        regressions = compare_with_baseline(result, baseline, tolerance=args.tolerance)
+        for it in regressions:
+            print('REGRESSION {}'.format(json.dumps(it)))
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
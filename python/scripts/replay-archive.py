@@ -0,0 +1,89 @@
+"""
+replays a whole archive of recorded sessions in a process pool, reports decision agreement
+with the recordings and with a baseline run, and merged per-stage latencies
+
+python replay-archive.py ../tracks/ --save-baseline archive-baseline.json
+python replay-archive.py ../tracks/ --baseline archive-baseline.json --processes 8
+"""
+import argparse
+import json
+import os
+import sys
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'lib'))
+
+from ballsbot.ai.replay import run_replays, decision_agreement, compare_with_baseline
+
+
+def find_tracks(paths):
+    result = []
+    for path in paths:
+        if os.path.isdir(path):
+            result.extend(
+                os.path.join(path, x) for x in sorted(os.listdir(path)) if x.endswith(('.bbt', '.json'))
+            )
+        else:
+            result.append(path)
+    return result
+
+
+def format_fraction(value):
+    return 'n/a' if value is None else '{:.1%}'.format(value)
+
+
+def print_report(result):
+    for track_path, session in result['sessions'].items():
+        print('{} ({} ticks, decisions {}, agreement with the recording {})'.format(
+            track_path, session['frames'], session['decisions'], format_fraction(session['recorded_agreement'])
+        ))
+    print('{} sessions, {} ticks in {:.1f} s, agreement with the recordings {}'.format(
+        len(result['sessions']), result['frames'], result['elapsed_s'], format_fraction(result['recorded_agreement'])
+    ))
+    for stage, stats in result['stages'].items():
+        print('  {:<20} n={:<8} p50 {:8.3f} ms  p95 {:8.3f} ms  p99 {:8.3f} ms'.format(
+            stage, stats['count'], stats['p50_ms'], stats['p95_ms'], stats['p99_ms']
+        ))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('tracks', nargs='+', help='track logs, Explorer.track_info json files or directories of them')
+    parser.add_argument('--processes', type=int, default=None, help='worker processes, all cpus by default')
+    parser.add_argument('--windows', type=int, default=1, help='split every session into this many jobs')
+    parser.add_argument('--warmup', type=int, default=20, help='frames replayed before every window')
+    parser.add_argument('--grid-config', type=json.loads, default=None,
+                        help='ballsbot_cpp.Grid keyword arguments as json, e.g. \'{"cell_size": 0.5}\'')
+    parser.add_argument('--baseline', help='compare with this replay-archive json')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='allowed slowdown, 0.2 is 20%%')
+    parser.add_argument('--save-baseline', help='write the results to this json')
+    args = parser.parse_args()
+
+    result = run_replays(find_tracks(args.tracks), processes=args.processes, windows=args.windows,
+                         warmup=args.warmup, grid_config=args.grid_config)
+    print_report(result)
+
+    if args.save_baseline is not None:
+        with open(args.save_baseline, 'w') as hf:
+            hf.write(json.dumps(result))
+
+    if args.baseline is not None:
+        with open(args.baseline, 'r') as hf:
+            baseline = json.loads(hf.read())
+        if (baseline['windows'], baseline['warmup']) != (result['windows'], result['warmup']):
+            print('WARNING: baseline was replayed with other --windows / --warmup, decisions differ anyway')
+        sessions, agreement = decision_agreement(result, baseline)
+        for track_path, value in sessions.items():
+            if value != 1.:
+                print('DECISIONS {} agree with baseline on {}'.format(track_path, format_fraction(value)))
+        print('agreement with baseline {}'.format(format_fraction(agreement)))
+        regressions = compare_with_baseline(
+            {'all sessions': result}, {'all sessions': baseline}, tolerance=args.tolerance
+        )
+        for it in regressions:
+            print('REGRESSION {}'.format(json.dumps(it)))
+        if regressions or agreement not in (None, 1.):
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,31 @@
+import numpy as np
+import pytest
+
+from ballsbot_cpp import ballsbot_cpp
+
+POSE = {'x': 0., 'y': 0., 'teta': 0.}
+
+
+def test_clouds_of_any_dtype_and_layout_are_the_same():
+    cloud = np.random.default_rng(1).uniform(-3., 3., (500, 2))
+    expected = ballsbot_cpp.apply_transformation(cloud, [1., 2., 0.3])
+    for other in (cloud.tolist(), np.asfortranarray(cloud), np.repeat(cloud, 2, axis=0)[::2]):
+        assert np.allclose(ballsbot_cpp.apply_transformation(other, [1., 2., 0.3]), expected)
+    assert np.allclose(
+        ballsbot_cpp.apply_transformation(cloud.astype(np.float32), [1., 2., 0.3]), expected, atol=1e-5
+    )
+
+
+@pytest.mark.parametrize('cloud', [np.zeros((4,)), np.zeros((2, 3)), [1., 2., 3., 4.]])
+def test_clouds_not_of_n_by_2_points_are_rejected(cloud):
+    with pytest.raises(ValueError):
+        ballsbot_cpp.apply_transformation(cloud, [0., 0., 0.])
+    if not isinstance(cloud, list):
+        with pytest.raises(ValueError):
+            ballsbot_cpp.Grid().update_grid(cloud, POSE)
+
+
+def test_empty_clouds():
+    assert ballsbot_cpp.apply_transformation([], [0., 0., 0.]).shape == (0, 2)
+    assert ballsbot_cpp.apply_transformation(np.empty((0,)), [0., 0., 0.]).shape == (0, 2)
+    ballsbot_cpp.Grid().update_grid(np.empty((0, 2), dtype=np.float32), POSE)
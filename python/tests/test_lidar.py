@@ -0,0 +1,27 @@
+import os
+import sys
+
+import numpy as np
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'lib'))
+
+import ballsbot.lidar as lidar
+
+
+def test_stale_scans_are_not_returned(monkeypatch):
+    now = [100.]
+    monkeypatch.setattr(lidar, 'time', lambda: now[0])
+    a_lidar = lidar.Lidar()
+    scan = lidar.LidarScan.from_radial_points([{'distance': 1., 'angle': 0.}, {'distance': 2., 'angle': 1.}])
+    a_lidar.scans.push(now[0], scan)
+
+    now[0] += a_lidar.MAX_SCAN_AGE / 2
+    assert len(a_lidar.get_radial_lidar_points(cached=False, columnar=True)) == 2
+    assert a_lidar.points_ts == 100.
+
+    now[0] += a_lidar.MAX_SCAN_AGE
+    assert len(a_lidar.get_radial_lidar_points(cached=False, columnar=True)) == 0
+    assert a_lidar.get_lidar_points(columnar=True).shape == (0, 2)
+
+    a_lidar.scans.push(now[0], scan)
+    assert np.allclose(a_lidar.get_radial_lidar_points(cached=False, columnar=True).ranges, [1., 2.])
@@ -0,0 +1,38 @@
+import os
+import sys
+
+import numpy as np
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'lib'))
+
+from ballsbot.ai.replay import JsonTrackFeed, profile_functions
+from ballsbot.cloud_generator import Scene, NoiseModel, get_trajectory
+
+
+def get_track_info():
+    scene = Scene.from_polygons([
+        [[-1., 2.], [9., 2.], [9., -2.], [-1., -2.]],
+        [[4., 0.5], [5., 0.5], [5., -0.5], [4., -0.5]],
+    ])
+    rng = np.random.default_rng(1)
+    return [
+        {
+            'speed': 0.3,
+            'pose': {'x': pose['x'], 'y': pose['y'], 'teta': pose['teta']},
+            'points': scene.scan(pose, noise=NoiseModel(), rng=rng).to_radial_points(),
+            'direction': 1.,
+            'weights': None,
+        }
+        for pose in get_trajectory([[0., 0.], [3., 0.]], speed=0.3, fps=4)
+    ]
+
+
+def test_profile_functions_counts_grid_calls_as_native():
+    track_info = get_track_info()
+    result = profile_functions(lambda: JsonTrackFeed(track_info), top=None)
+
+    native = [x['function'] for x in result['native']['functions']]
+    python = [x['function'] for x in result['python']['functions']]
+    assert any('update_grid' in x for x in native), native
+    assert not any('update_grid' in x for x in python)
+    assert result['native']['total_s'] > 0.
@@ -0,0 +1,117 @@
+from math import hypot, pi, remainder
+import os
+import sys
+
+import numpy as np
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'lib'))
+
+import ballsbot.tracking as tracking
+from ballsbot.cloud_generator import Scene, NoiseModel, get_trajectory
+
+GYRO_DRIFT = 0.02  # radians per step
+
+
+class StopTracking(Exception):
+    pass
+
+
+class SyntheticRun:
+    """
+    lidar, imu with a drifting heading and odometry following it, replaying a trajectory in a scene
+    """
+
+    def __init__(self, scene, poses):
+        self.poses = poses
+        rng = np.random.default_rng(1)
+        self.clouds = []
+        for pose in poses:
+            scan = scene.scan(pose, noise=NoiseModel(), rng=rng)
+            ranges = np.asarray(scan.ranges, dtype=np.float64)
+            angles = scan.get_angles()
+            ok = np.isfinite(ranges)
+            self.clouds.append(np.ascontiguousarray(
+                np.stack((ranges[ok] * np.cos(angles[ok]), ranges[ok] * np.sin(angles[ok])), axis=1)
+            ))
+        self.step = -1
+        self.calibration = None
+        self.points_ts = 0.
+
+    def get_teta_ts(self):
+        """
+        the tracker reads the imu first, so it moves the run to the next pose
+        """
+        self.step += 1
+        if self.step >= len(self.poses):
+            raise StopTracking()
+        return self.step * 0.5
+
+    def get_teta(self):
+        return self.poses[self.step]['teta'] + GYRO_DRIFT * self.step
+
+    def get_lidar_points(self, columnar=False):
+        self.points_ts = self.step * 0.5
+        return self.clouds[self.step]
+
+    def get_dx_dy(self, dt, teta):
+        """
+        the true displacement turned by the heading error, as if integrated along the imu heading
+        """
+        previous, current = self.poses[self.step - 1], self.poses[self.step]
+        dx, dy = current['x'] - previous['x'], current['y'] - previous['y']
+        error = GYRO_DRIFT * self.step
+        return dx * np.cos(error) - dy * np.sin(error), dx * np.sin(error) + dy * np.cos(error)
+
+
+def test_tracker_keeps_heading_correction_when_a_match_fails(monkeypatch):
+    monkeypatch.setattr(tracking, 'keep_rps', lambda ts, fps=1.: ts)
+    scene = Scene.from_polygons([
+        [[-1., 1.], [7., 1.], [7., -7.], [-1., -7.]],
+        [[2., -2.], [4., -2.], [4., -4.], [2., -4.]],
+        [[5.5, -6.], [6., -6.], [6., -5.5]],
+    ])
+    poses = get_trajectory([[0.5, -1.], [5.5, -1.], [5.5, -5.5]], speed=0.4, fps=2)
+    run = SyntheticRun(scene, poses)
+    tracker = tracking.Tracker(run, run, run, fix_pose_with_lidar=True)
+
+    failing_steps = {len(poses) // 2, len(poses) - 3}  # on the straight segment and after the corner
+    match_scan = tracker._match_scan
+
+    def failing_match_scan(current, initial_guess):
+        dx, dy, dteta, converged, score = match_scan(current, initial_guess)
+        if run.step in failing_steps:
+            converged = False
+        return dx, dy, dteta, converged, score
+
+    tracker._match_scan = failing_match_scan
+    try:
+        tracker.start()
+    except StopTracking:
+        pass
+
+    tracked = tracker.poses.to_list()
+    assert len(tracked) == len(poses)
+    for step, (pose, truth) in enumerate(zip(tracked, poses)):
+        heading_error = abs(remainder(pose['teta'] - truth['teta'], 2 * pi))
+        assert heading_error < 0.05, step
+        position_error = hypot(pose['x'] - (truth['x'] - poses[0]['x']), pose['y'] - (truth['y'] - poses[0]['y']))
+        assert position_error < 0.2, step
+    for step in failing_steps:
+        assert GYRO_DRIFT * step > 0.3  # falling back to the imu heading would fail the checks above
+
+
+def test_tracker_light_streams_every_pose(monkeypatch):
+    monkeypatch.setattr(tracking, 'keep_rps', lambda ts, fps=1.: ts)
+    poses = get_trajectory([[0., 0.], [2., 0.]], speed=0.4, fps=2)
+    run = SyntheticRun(Scene.from_polygons([[[-1., 1.], [3., 1.], [3., -1.], [-1., -1.]]]), poses)
+
+    writer = []
+    tracker = tracking.TrackerLight(run, run, fps=2, track_writer=writer)
+    try:
+        tracker.start()
+    except StopTracking:
+        pass
+
+    assert [x['ts'] for x in writer] == [x['ts'] for x in tracker.poses.to_list()]
+    assert len(writer) == len(poses)
+    assert writer[0]['pose'] == {'x': 0., 'y': 0., 'teta': poses[0]['teta']}